@@ -1,6 +1,7 @@
 from plenario.database import session, app_engine, Base
 import plenario.models
 import plenario.settings
+from sqlalchemy import inspect
 from sqlalchemy.exc import IntegrityError
 import datetime
 from argparse import ArgumentParser
@@ -11,7 +12,8 @@ from plenario.tasks import hello_world
 
 
 def init_db(args={}):
-    if args.everything:
+    steps = [args.tables, args.weather, args.census, args.celery, args.indexes, args.rollups]
+    if args.everything or not any(steps):
         init_master_meta_user()
         init_weather()
         init_census()
@@ -25,6 +27,10 @@ def init_db(args={}):
             init_census()
         if args.celery:
             init_celery()
+        if args.indexes:
+            init_indexes()
+        if args.rollups:
+            init_rollups()
 
 
 def init_master_meta_user():
@@ -69,6 +75,41 @@ def init_census():
 def init_celery():
     hello_world.delay()
 
+
+def init_indexes():
+    print 'adding indexes missing from existing tables'
+    inspector = inspect(app_engine)
+    existing_tables = inspector.get_table_names()
+    if 'weather_stations' in existing_tables:
+        # Registers the weather observation tables with Base.metadata
+        WeatherETL().make_tables()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = [ix['name'] for ix in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                print 'creating index %s on %s' % (index.name, table.name)
+                index.create(bind=app_engine)
+
+def init_rollups():
+    print 'counting existing datasets into dat_master_daily and dat_master_grid'
+    plenario.models.MasterDailyCount.__table__.create(bind=app_engine, checkfirst=True)
+    plenario.models.MasterGridCount.__table__.create(bind=app_engine, checkfirst=True)
+    plenario.models.RolledUpDataset.__table__.create(bind=app_engine, checkfirst=True)
+    names = [r[0] for r in session.query(plenario.models.MetaTable.dataset_name)]
+    for name in names:
+        print 'counting %s' % name
+        plenario.models.MasterDailyCount.rebuild(name, session)
+        resolutions = plenario.models.MasterGridCount.rebuild(name, session)
+        plenario.models.RolledUpDataset.mark(name, resolutions, session)
+        session.commit()
+
+    print 'filling meta_ready from celery task results'
+    plenario.models.ReadyDataset.__table__.create(bind=app_engine, checkfirst=True)
+    plenario.models.ReadyDataset.rebuild(session)
+    session.commit()
+
 def build_arg_parser():
     '''Creates an argument parser for this script. This is helpful in the event
     that a user needs to only run a portion of the setup script.
@@ -77,17 +118,23 @@ def build_arg_parser():
     creates tables, initializes NOAA weather station data and US Census block \
     data.'
     parser = ArgumentParser(description=description)
-    parser.add_argument('-t', '--tables', dest='tables', help='Set up the \
+    parser.add_argument('-t', '--tables', dest='tables', action='store_true', help='Set up the \
             master, meta and user tables')
-    parser.add_argument('-w', '--weather', dest='weather', help='Set up NOAA \
+    parser.add_argument('-w', '--weather', dest='weather', action='store_true', help='Set up NOAA \
             weather station data. This includes the daily and hourly weather \
             observations.')
-    parser.add_argument('-c', '--census', dest='census', help='Set up and \
+    parser.add_argument('-c', '--census', dest='census', action='store_true', help='Set up and \
             populate US Census blocks.')
-    parser.add_argument('-cl', '--celery', dest='celery', help='Say hello \
+    parser.add_argument('-cl', '--celery', dest='celery', action='store_true', help='Say hello \
             world from Celery')
-    parser.add_argument('-e', '--everything', dest='everything', help='Run \
-            everything in the script.', default=True)
+    parser.add_argument('-i', '--indexes', dest='indexes', action='store_true', help='Add indexes \
+            that are missing from tables created by an older version.')
+    parser.add_argument('-r', '--rollups', dest='rollups', action='store_true', help='Build the \
+            daily and grid count rollups and the ready dataset catalog for datasets \
+            ingested by an older version.')
+    parser.add_argument('-e', '--everything', dest='everything', action='store_true', \
+            help='Run everything in the script. This is the default when no other \
+            option is given.')
     return parser
 
 if __name__ == "__main__":
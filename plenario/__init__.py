@@ -1,6 +1,6 @@
 from flask import Flask, render_template, redirect, url_for, request
 from raven.contrib.flask import Sentry
-from plenario.database import session as db_session
+from plenario.database import session as db_session, read_session
 from plenario.models import bcrypt
 from plenario.api import api, cache
 from plenario.auth import auth, login_manager
@@ -51,6 +51,7 @@ def create_app():
     @app.teardown_appcontext
     def shutdown_session(exception=None):
         db_session.remove()
+        read_session.remove()
 
     @app.errorhandler(404)
     def page_not_found(e):
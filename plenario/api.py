@@ -1,6 +1,4 @@
 from functools import update_wrapper
-import os
-import math
 from datetime import date, datetime, timedelta
 import json
 from operator import itemgetter
@@ -8,33 +6,86 @@ from itertools import groupby
 from cStringIO import StringIO
 import csv
 from collections import OrderedDict
-import tempfile
+import base64
+from hashlib import sha1
+import time
+import os
+import numpy
+import threading
+from multiprocessing.pool import ThreadPool
 
-from flask import make_response, request, current_app, Blueprint
+from flask import make_response, request, current_app, Blueprint, Response, \
+    stream_with_context, send_file, url_for
 from flask.ext.cache import Cache
+from werkzeug.urls import url_encode
 from dateutil.parser import parse
 from datetime_truncate import truncate
-from sqlalchemy import func, Table, text
+from sqlalchemy import func, text, tuple_, cast, case, literal_column
+from sqlalchemy.dialects.postgresql import TIMESTAMP
 from sqlalchemy.exc import NoSuchTableError
-from sqlalchemy.types import NullType
-from shapely.wkb import loads
-from shapely.geometry import box, asShape
-
-from plenario.models import MasterTable, MetaTable, ShapeMetadata
-from plenario.database import session, app_engine as engine, Base
-from plenario.utils.helpers import slugify, increment_datetime_aggregate
+from sqlalchemy.types import NullType, BigInteger, Text
+from shapely.geometry import asShape
+
+from plenario.models import MasterTable, MasterDailyCount, MasterGridCount, MetaTable, \
+    ShapeMetadata, DatasetGeneration, ReadyDataset, RolledUpDataset
+from plenario.database import read_session as session, read_engine
+from plenario.utils.helpers import slugify, increment_datetime_aggregate, \
+    getSizeInDegrees
+from plenario.utils.streaming import iter_json, iter_ndjson, iter_geojson, iter_csv, \
+    iter_copy, iter_gzip, ENCODERS
+from plenario.utils.schema import schema_registry
+from plenario.utils.cache_keys import cache_key
+from plenario.utils.coalesce import CoalescingCache
+from plenario.utils.columnar import COLUMNAR_TYPES, CONTENT_TYPES, encode_rows, encode_columns
+from plenario.utils.timing import start_timer, current_timer, timed, timed_iter, \
+    endpoint_stats
 from plenario.settings import CACHE_CONFIG, DATA_DIR
 import plenario.settings
-from plenario.utils.ogr2ogr import OgrExport, OgrError
+from plenario.utils.artifacts import shape_exports, SHAPE_EXPORT_FORMATS
+from plenario.tasks import run_query_job, JOB_DIR, JOB_ENVIRON_KEY
 
 cache = Cache(config=CACHE_CONFIG)
 
 API_VERSION = '/v1'
 RESPONSE_LIMIT = 1000
+# Background jobs write to a file rather than a response, so they can return far more rows
+JOB_RESPONSE_LIMIT = 1000000
+# Rows fetched per round trip on a server-side cursor
+STREAM_BATCH_SIZE = 100
 CACHE_TIMEOUT = 60*60*6
-VALID_DATA_TYPE = ['csv', 'json', 'geojson']
+# How long past CACHE_TIMEOUT a response can be served while it is refreshed
+STALE_TIMEOUT = 60*30
+# How long a request waits on another worker running the same query
+CACHE_LOCK_TIMEOUT = 60*5
+# Runs each cached query once, however many requests are waiting on it.
+response_cache = CoalescingCache(cache, stale_timeout=STALE_TIMEOUT, lock_timeout=CACHE_LOCK_TIMEOUT,
+                                 timer=timed)
+# Endpoints a batch can query, how many queries a batch can hold,
+# and how many threads per process run them (each takes a connection from app_engine's pool)
+BATCH_ENDPOINTS = ['timeseries', 'detail-aggregate', 'detail', 'grid']
+BATCH_MAX_QUERIES = 30
+BATCH_WORKERS = 4
+# How long (in seconds) a process trusts the dataset generations it last read
+GENERATION_TTL = 5
+VALID_DATA_TYPE = ['csv', 'json', 'geojson'] + COLUMNAR_TYPES
+# Responses that are worth compressing, and the smallest body to bother with
+COMPRESSIBLE_TYPES = ['application/json', 'application/x-ndjson', 'text/csv',
+                      'application/vnd.mapbox-vector-tile']
+MIN_COMPRESS_SIZE = 1024
 VALID_AGG = ['day', 'week', 'month', 'quarter', 'year']
 
+# Vector tiles
+# Half the width of the world in web mercator meters
+WEB_MERCATOR_MAX = 20037508.342789244
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_MAX_ZOOM = 22
+# Zoom level from which tiles carry individual points rather than grid counts
+TILE_POINT_ZOOM = 14
+# Grid cells across a tile below TILE_POINT_ZOOM
+TILE_GRID_CELLS = 64
+TILE_MAX_FEATURES = 10000
+
 WEATHER_COL_LOOKUP = {
     'daily': {
         'temp_lo': 'temp_min',
@@ -96,10 +147,485 @@ def crossdomain(origin=None, methods=None, headers=None,
     return decorator
 
 def make_cache_key(*args, **kwargs):
-    path = request.path
-    args = str(hash(frozenset(request.args.items())))
-    # print 'cache_key:', (path+args)
-    return (path + args).encode('utf-8')
+    defaults = obs_date_defaults(request.endpoint, request.args)
+    generations = query_generations(request.endpoint, request.view_args, request.args)
+    key = cache_key(request.path, request.args, defaults=defaults, generations=generations)
+    # Compressed and uncompressed copies of a response are cached separately.
+    encoding = response_encoding()
+    if encoding:
+        key = '%s:%s' % (key, encoding)
+    return key
+
+def response_encoding():
+    """
+    :return: The Content-Encoding to compress the response with, or None
+    """
+    if not request.headers.get('Accept-Encoding'):
+        return None
+    # Prefer brotli when both are accepted equally.
+    return request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in ENCODERS])
+
+def compressed(f):
+    """
+    Compress responses with gzip (or brotli) when the client accepts it.
+    Streamed responses are compressed as they are written.
+    Sits under the cache, so what gets cached is the compressed body.
+    """
+    def wrapped_function(*args, **kwargs):
+        resp = make_response(f(*args, **kwargs))
+        resp.vary.add('Accept-Encoding')
+        encoding = response_encoding()
+        if not encoding or resp.status_code != 200 or \
+                resp.direct_passthrough or 'Content-Encoding' in resp.headers or \
+                resp.mimetype not in COMPRESSIBLE_TYPES:
+            return resp
+        if resp.is_streamed:
+            resp.response = ENCODERS[encoding](resp.response)
+            resp.headers.pop('Content-Length', None)
+        else:
+            body = resp.get_data()
+            if len(body) < MIN_COMPRESS_SIZE:
+                return resp
+            resp.set_data(''.join(ENCODERS[encoding]([body])))
+        resp.headers['Content-Encoding'] = encoding
+        return resp
+    return update_wrapper(wrapped_function, f)
+
+_generation_memo = {'values': None, 'fetched_at': 0}
+
+def dataset_versions():
+    """
+    :return: dict of dataset_name -> (generation, last_update),
+             re-read from meta_generation at most every GENERATION_TTL seconds
+    """
+    now = time.time()
+    memo = _generation_memo
+    if memo['values'] is None or now - memo['fetched_at'] > GENERATION_TTL:
+        memo['values'] = DatasetGeneration.get_all(session)
+        memo['fetched_at'] = now
+    return memo['values']
+
+def dataset_generations():
+    """
+    :return: dict of dataset_name -> generation
+    """
+    return {name: version[0] for name, version in dataset_versions().items()}
+
+def generation_name(table_name):
+    """
+    Tables are named 'dat_<dataset_name>', except for weather_stations.
+    """
+    if table_name.startswith('dat_'):
+        return table_name[len('dat_'):]
+    return table_name
+
+def query_datasets(endpoint, view_args, params):
+    """
+    The datasets an API request reads from.
+
+    :return: list of dataset names (as in meta_generation),
+             or None if there is no telling which datasets are involved
+    """
+    view_args = view_args or {}
+    names = None
+    if endpoint == 'api.dataset':
+        if params.get('dataset_name__in'):
+            names = params['dataset_name__in'].split(',')
+    elif endpoint in ('api.detail', 'api.detail_aggregate', 'api.grid', 'api.dataset_fields',
+                      'api.tile'):
+        names = [params.get('dataset_name') or view_args.get('dataset_name')]
+        if params.get('weather'):
+            names.extend(['weather_observations_daily', 'weather_observations_hourly'])
+    elif endpoint == 'api.weather':
+        names = ['weather_observations_%s' % view_args.get('table'), 'weather_stations']
+    elif endpoint == 'api.weather_stations':
+        names = ['weather_stations']
+    if names is None:
+        return None
+    return [name for name in set(names) if name]
+
+def query_generations(endpoint, view_args, params):
+    """
+    The generations of the datasets an API request reads from.
+
+    :return: list of (dataset_name, generation) pairs
+    """
+    generations = dataset_generations()
+    names = query_datasets(endpoint, view_args, params)
+    # No way to tell which datasets are involved, so any of them changing counts.
+    if names is None:
+        return generations.items()
+    return [(name, generations.get(name, 0)) for name in names]
+
+def query_last_modified(endpoint, view_args, params):
+    """
+    When the data an API request reads from last changed.
+
+    :return: naive UTC datetime, or None if some of the datasets have no last_update
+    """
+    versions = dataset_versions()
+    names = query_datasets(endpoint, view_args, params)
+    if names is None:
+        names = versions.keys()
+    updates = [versions.get(name, (0, None))[1] for name in names]
+    if not updates or None in updates:
+        return None
+    # last_update is written in local time.
+    return datetime.utcfromtimestamp(time.mktime(max(updates).timetuple()))
+
+def conditional(f):
+    """
+    Answer conditional GETs before the view (or the cache) does any work.
+
+    The ETag covers the same things as the cache key: the normalized query
+    and the generations of the datasets it reads. Last-Modified is when the
+    most recently updated of those datasets changed.
+    """
+    def wrapped_function(*args, **kwargs):
+        etag = sha1(make_cache_key()).hexdigest()
+        last_modified = query_last_modified(request.endpoint, request.view_args, request.args)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = last_modified is not None and \
+                request.if_modified_since is not None and \
+                last_modified <= request.if_modified_since
+        if not_modified:
+            resp = current_app.response_class(status=304)
+            resp.headers['Access-Control-Allow-Origin'] = '*'
+            resp.vary.add('Accept-Encoding')
+        else:
+            resp = make_response(f(*args, **kwargs))
+            # Errors and queued jobs don't get validators.
+            if resp.status_code != 200:
+                return resp
+        resp.set_etag(etag)
+        if last_modified is not None:
+            resp.last_modified = last_modified
+        return resp
+    return update_wrapper(wrapped_function, f)
+
+def reflected_table(table_name):
+    """
+    Look a table up in the schema registry,
+    reflecting it again if its dataset has been updated since.
+    """
+    generation = dataset_generations().get(generation_name(table_name))
+    return schema_registry.get(table_name, generation=generation)
+
+def obs_date_defaults(endpoint, params):
+    """
+    The obs_date filters an endpoint applies when a request leaves them out.
+
+    :param endpoint: Name of the endpoint, like 'api.detail'
+    :param params: MultiDict of query parameters
+    :return: dict of obs_date filters that are missing from params
+    """
+    now = datetime.now()
+    defaults = {}
+    if endpoint in ('api.dataset', 'api.detail_aggregate'):
+        if not params.get('obs_date__ge'):
+            defaults['obs_date__ge'] = (now - timedelta(days=90)).strftime('%Y-%m-%d')
+        if not params.get('obs_date__le'):
+            defaults['obs_date__le'] = now.strftime('%Y-%m-%d')
+    elif endpoint == 'api.detail':
+        if not [k for k in params.keys() if k.startswith('obs_date')]:
+            defaults['obs_date__ge'] = (now - timedelta(days=30)).strftime('%Y-%m-%d')
+    return defaults
+
+def is_streaming_request():
+    """
+    True when the client asked for the response to be streamed (stream=true).
+    Streamed responses go straight from a database cursor to the client,
+    so there is nothing for the cache to hold onto.
+    """
+    return request.args.get('stream', '').lower() == 'true'
+
+def is_async_request():
+    """
+    True when the client asked for the query to run as a background job (async=true).
+    """
+    return request.args.get('async', '').lower() == 'true'
+
+def is_query_job():
+    """
+    True when the request is being replayed by a background job (see tasks.run_query_job).
+    """
+    return bool(request.environ.get(JOB_ENVIRON_KEY))
+
+def detail_limit():
+    """
+    :return: The most rows /detail returns for the current request
+    """
+    return JOB_RESPONSE_LIMIT if is_query_job() else RESPONSE_LIMIT
+
+def skip_cache():
+    # Jobs skip the cache too, or they could pick up the 202 that queued them.
+    return is_streaming_request() or is_async_request() or is_query_job()
+
+def queueable(validate):
+    """
+    Let clients run an expensive query as a background job by adding async=true.
+    Instead of the results they get back a 202 with URLs to poll the job
+    and to download its results once it is done.
+
+    :param validate: Called with a copy of the query parameters before a job is queued.
+                     Returns the error response for a malformed query (or None),
+                     so that those fail right away instead of inside the job.
+    """
+    def decorator(f):
+        def wrapped_function(*args, **kwargs):
+            if is_async_request():
+                error = validate(request.args.copy())
+                if error is not None:
+                    return error
+                return submit_query_job('Query submitted.')
+            return f(*args, **kwargs)
+        return update_wrapper(wrapped_function, f)
+    return decorator
+
+def submit_query_job(message):
+    """
+    Queue the current request as a background job.
+    :return: 202 response pointing to the job
+    """
+    job_args = request.args.copy()
+    job_args.pop('async', None)
+    if request.endpoint == 'api.detail':
+        # Write rows to the file as they come off the cursor.
+        job_args['stream'] = 'true'
+    job = run_query_job.delay(request.path, list(job_args.iteritems(multi=True)))
+
+    resp = {
+        'meta': {
+            'status': 'ok',
+            'message': message,
+        },
+        'objects': [{
+            'job_id': job.id,
+            'status_url': url_for('api.job_status', job_id=job.id),
+            'download_url': url_for('api.job_download', job_id=job.id),
+        }]
+    }
+    resp = make_response(json.dumps(resp), 202)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+def admit_query(query):
+    """
+    Check what the planner expects a query to cost before running it.
+
+    Queries estimated to cost more than QUERY_MAX_COST are refused,
+    and those over QUERY_ASYNC_COST are sent off to run as a background job.
+    Either check is off when its setting is None.
+
+    :param query: SQLAlchemy query, ready to run
+    :return: None if the query can run now, otherwise the response to send instead
+    """
+    max_cost = current_app.config.get('QUERY_MAX_COST')
+    async_cost = current_app.config.get('QUERY_ASYNC_COST')
+    if max_cost is None and async_cost is None:
+        return None
+
+    cost, rows = explain_query(query)
+    if max_cost is not None and cost > max_cost:
+        resp = {
+            'meta': {
+                'status': 'error',
+                'message': 'This query is too expensive to run. Try narrowing its filters.',
+                'estimated_cost': cost,
+                'estimated_rows': rows,
+            },
+            'objects': [],
+        }
+        resp = make_response(json.dumps(resp), 400)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+    if async_cost is not None and cost > async_cost and not is_query_job():
+        return submit_query_job('This query is expensive, so it will run in the background.')
+    return None
+
+def explain_query(query):
+    """
+    :return: (total cost, rows) the planner estimates for query
+    """
+    compiled = query.statement.compile(dialect=session.get_bind().dialect)
+    plan = session.connection().execute('EXPLAIN (FORMAT JSON) ' + unicode(compiled),
+                                        compiled.params).scalar()
+    # Older versions of psycopg2 don't decode json.
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Total Cost'], plan[0]['Plan']['Plan Rows']
+
+@api.route(API_VERSION + '/api/jobs/<job_id>/')
+@crossdomain(origin="*")
+def job_status(job_id):
+    result = run_query_job.AsyncResult(job_id)
+    job = {
+        'job_id': job_id,
+        'status': result.state,
+    }
+    if result.successful():
+        job['download_url'] = url_for('api.job_download', job_id=job_id)
+    elif result.failed():
+        job['message'] = repr(result.result)
+
+    resp = {
+        'meta': {
+            'status': 'ok',
+            'message': '',
+        },
+        'objects': [job]
+    }
+    resp = make_response(json.dumps(resp), 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+@api.route(API_VERSION + '/api/jobs/<job_id>/download')
+@crossdomain(origin="*")
+def job_download(job_id):
+    resp = {
+        'meta': {
+            'status': 'error',
+            'message': '',
+        },
+        'objects': []
+    }
+    result = run_query_job.AsyncResult(job_id)
+    if not result.successful():
+        resp['meta']['message'] = 'Job {} has no results yet. Its status is {}.'.format(job_id, result.state)
+        status_code = 404
+    else:
+        job = result.result
+        path = os.path.join(JOB_DIR, job['filename'])
+        if os.path.isfile(path):
+            download = send_file(path,
+                                 mimetype=job['content_type'],
+                                 as_attachment=True,
+                                 attachment_filename=job['filename'])
+            # Pass on the status of the query itself, so a bad query still reads as a 400.
+            download.status_code = job['status_code']
+            return download
+        resp['meta']['message'] = 'The results of job {} have expired.'.format(job_id)
+        status_code = 410
+
+    resp = make_response(json.dumps(resp), status_code)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+@api.route(API_VERSION + '/api/batch', methods=['POST', 'OPTIONS'])
+@crossdomain(origin="*", methods=['POST'], headers=['Content-Type'])
+def batch():
+    """
+    Run several queries in one request, like the handful of counts a dashboard needs.
+    Expects a JSON body like
+
+        {"queries": [{"id": "crimes", "endpoint": "detail-aggregate",
+                      "params": {"dataset_name": "crimes_2001_to_present", "agg": "week"}},
+                     ...]}
+
+    and runs the queries side by side on a small pool of threads.
+    Each one goes through the endpoint as usual (cache and all),
+    and its result comes back under its id (or its position in the list),
+    so ids have to be unique within a batch.
+    """
+    resp = {
+        'meta': {
+            'status': 'error',
+            'message': '',
+        },
+        'objects': {},
+    }
+    body = request.get_json(force=True, silent=True) or {}
+    queries = body.get('queries') if isinstance(body, dict) else None
+    status_code = 400
+    if not isinstance(queries, list) or not queries:
+        resp['meta']['message'] = "Expected a JSON body with a list of 'queries'"
+    elif len(queries) > BATCH_MAX_QUERIES:
+        resp['meta']['message'] = 'A batch can have at most %s queries' % BATCH_MAX_QUERIES
+    else:
+        specs = []
+        seen_ids = set()
+        for i, query in enumerate(queries):
+            if not isinstance(query, dict) or query.get('endpoint') not in BATCH_ENDPOINTS:
+                resp['meta']['message'] = 'Query %s must have an endpoint, one of %s' % \
+                    (i, ', '.join(sorted(BATCH_ENDPOINTS)))
+                break
+            query_id = unicode(query.get('id', i))
+            if query_id in seen_ids:
+                resp['meta']['message'] = "Query %s reuses the id '%s'" % (i, query_id)
+                break
+            seen_ids.add(query_id)
+            path = API_VERSION + '/api/%s/' % query['endpoint']
+            specs.append((query_id, path, query.get('params') or {}))
+        else:
+            app = current_app._get_current_object()
+            results = batch_pool().map(lambda spec: run_batch_query(app, *spec), specs)
+            resp['objects'] = dict(results)
+            resp['meta']['status'] = 'ok'
+            status_code = 200
+
+    resp = make_response(json.dumps(resp, default=dthandler), status_code)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+_batch_pool = []
+_batch_pool_lock = threading.Lock()
+
+def batch_pool():
+    # Start the threads on first use, so they aren't forked along with the worker.
+    with _batch_pool_lock:
+        if not _batch_pool:
+            _batch_pool.append(ThreadPool(BATCH_WORKERS))
+        return _batch_pool[0]
+
+def run_batch_query(app, query_id, path, params):
+    """
+    Run one query of a batch as a request of its own.
+    :return: (query_id, {'status_code': ..., 'response': ...})
+    """
+    try:
+        with app.test_request_context(path, query_string=url_encode(params)):
+            sub_resp = app.full_dispatch_request()
+            data = sub_resp.get_data()
+            if sub_resp.mimetype == 'application/json':
+                data = json.loads(data)
+            return query_id, {'status_code': sub_resp.status_code, 'response': data}
+    except Exception as e:
+        # Nothing above us sees the exception, so log it and pass it on to Sentry here.
+        app.logger.exception('Batch query %s (%s) failed', query_id, path)
+        sentry = app.extensions.get('sentry')
+        if sentry is not None:
+            sentry.captureException()
+        return query_id, {'status_code': 500, 'response': 'Query failed: %s' % e}
+
+@api.before_request
+def start_timing():
+    start_timer()
+
+@api.after_request
+def report_timing(resp):
+    """
+    Break down where the time went in a Server-Timing header,
+    and in the meta of JSON responses when asked to with timing=true.
+    Streamed responses are only added to the endpoint stats once they are done.
+    """
+    timer = current_timer()
+    if timer is None:
+        return resp
+    resp.headers['Server-Timing'] = timer.server_timing()
+    if request.args.get('timing', '').lower() == 'true' and resp.mimetype == 'application/json' \
+            and not resp.is_streamed and 'Content-Encoding' not in resp.headers:
+        try:
+            body = json.loads(resp.get_data())
+            body['meta']['timing'] = timer.milliseconds()
+            resp.set_data(json.dumps(body))
+        except (ValueError, KeyError, TypeError):
+            pass
+    endpoint = request.endpoint
+    resp.call_on_close(lambda: endpoint_stats.record(endpoint, timer))
+    return resp
 
 @api.route(API_VERSION + '/api/flush-cache')
 def flush_cache():
@@ -109,7 +635,9 @@ def flush_cache():
     return resp
 
 @api.route(API_VERSION + '/api/datasets')
-#@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+#@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def meta():
     status_code = 200
@@ -137,10 +665,10 @@ def meta():
         # We need to get the bbox separately so we can request it as json
         q = text('{0} AND m.dataset_name=:dataset_name'.format(q))
 
-        with engine.begin() as c:
+        with read_engine().begin() as c:
             metas = list(c.execute(q, dataset_name=dataset_name))
     else:
-        with engine.begin() as c:
+        with read_engine().begin() as c:
             metas = list(c.execute(q))
 
     for m in metas:
@@ -157,13 +685,13 @@ def meta():
 
 
 @api.route(API_VERSION + '/api/fields/<dataset_name>/')
-@cache.cached(timeout=CACHE_TIMEOUT)
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def dataset_fields(dataset_name):
     try:
-        table = Table('dat_%s' % dataset_name, Base.metadata,
-            autoload=True, autoload_with=engine,
-            extend_existing=True)
+        table = reflected_table('dat_%s' % dataset_name)
         data = {
             'meta': {
                 'status': 'ok',
@@ -236,48 +764,25 @@ def get_all_shape_datasets():
 def find_intersecting_shapes(geojson):
     """
     Respond with all shape datasets that intersect with the geojson provided.
-    Also include how many geom rows of the dataset intersect.
+    Also include how many geom rows of the dataset intersect, unless the count=false query parameter is given.
     :param geojson: URL encoded geojson.
     """
     fragment = extract_first_geometry_fragment(geojson)
+    # Listing the datasets without counts lets each one stop at its first hit.
+    count = request.args.get('count', 'true').lower() != 'false'
 
     try:
-        # First, do a bounding box check on all shape datasets.
-        query = '''
-        SELECT m.dataset_name
-        FROM meta_shape as m
-        WHERE m.bbox &&
-            (SELECT ST_GeomFromGeoJSON('{geojson_fragment}'));
-        '''.format(geojson_fragment=fragment)
-
-        intersecting_datasets = engine.execute(query)
-        bounding_box_intersection_names = [dataset.dataset_name for dataset in intersecting_datasets]
+        intersections = ShapeMetadata.find_intersecting(fragment, caller_session=session, count=count)
     except Exception as e:
-        print 'Error finding candidates'
+        print 'Error finding intersecting shapes'
         raise e
 
-    try:
-        # Then, for the candidates, get a count of the rows that intersect.
-        response_objects = []
-        for dataset_name in bounding_box_intersection_names:
-            num_intersections_query = '''
-            SELECT count(g.geom) as num_geoms
-            FROM {dataset_name} as g
-            WHERE ST_Intersects(g.geom, ST_GeomFromGeoJSON('{geojson_fragment}'))
-            '''.format(dataset_name=dataset_name, geojson_fragment=fragment)
-
-            num_intersections = engine.execute(num_intersections_query)\
-                                      .first().num_geoms
-
-            if num_intersections > 0:
-                response_objects.append({
-                    'dataset_name': dataset_name,
-                    'num_geoms': num_intersections
-                })
-
-    except Exception as e:
-        print 'Error narrowing candidates'
-        raise e
+    response_objects = []
+    for dataset_name, num_geoms in intersections:
+        obj = {'dataset_name': dataset_name}
+        if count:
+            obj['num_geoms'] = num_geoms
+        response_objects.append(obj)
 
     response_skeleton = {
                 'meta': {
@@ -333,33 +838,24 @@ def export_shape(dataset_name):
     if not export_format:
         export_format = u'json'
     export_format = unicode.lower(export_format)
-
-    # Make a filename that we are reasonably sure to be unique and not occupied by anyone else.
-    sacrifice_file = tempfile.NamedTemporaryFile()
-    export_path = sacrifice_file.name
-    sacrifice_file.close()  # Removes file from system.
+    if export_format not in SHAPE_EXPORT_FORMATS:
+        export_format = u'json'
 
     try:
-        # Write to that filename
-        OgrExport(export_format=export_format, table_name=dataset_name, export_path=export_path).write_file()
-        # Dump it in the response
-        with open(export_path, 'r') as to_export:
-            resp = make_response(to_export.read(), 200)
-
-        # Make the downloaded filename look nice
-        resp.headers['Content-Type'] = _shape_format_to_content_header(export_format)
-        disp_header = 'attachment; filename={name}.{ext}'.format(name=shape_dataset.human_name,
-                                                                 ext=_shape_format_to_file_extension(export_format))
-        resp.headers['Content-Disposition'] = disp_header
-        return resp
+        # Exports are written once per generation of the dataset and kept on disk.
+        generation = DatasetGeneration.get(dataset_name, session)
+        export_path = shape_exports.get(dataset_name, generation, export_format)
+        # Stream the file from disk rather than reading it all into memory.
+        filename = u'{name}.{ext}'.format(name=shape_dataset.human_name,
+                                          ext=_shape_format_to_file_extension(export_format))
+        return send_file(export_path,
+                         mimetype=_shape_format_to_content_header(export_format),
+                         as_attachment=True,
+                         attachment_filename=filename)
     except Exception as e:
         error_message = 'Failed to export shape dataset {}'.format(dataset_name)
         print repr(e)
         return make_response(error_message, 500)
-    finally:
-        # Don't leave that file hanging around.
-        if os.path.isfile(export_path):
-            os.remove(export_path)
 
 
 def _shape_format_to_content_header(requested_format):
@@ -382,15 +878,16 @@ def _shape_format_to_file_extension(requested_format):
 
 
 @api.route(API_VERSION + '/api/weather-stations/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def weather_stations():
     #print "weather_stations()"
     raw_query_params = request.args.copy()
     #print "weather_stations(): raw_query_params=", raw_query_params
 
-    stations_table = Table('weather_stations', Base.metadata, 
-        autoload=True, autoload_with=engine, extend_existing=True)
+    stations_table = reflected_table('weather_stations')
     valid_query, query_clauses, resp, status_code = make_query(stations_table,raw_query_params)
     if valid_query:
         resp['meta']['status'] = 'ok'
@@ -398,12 +895,12 @@ def weather_stations():
         for clause in query_clauses:
             print "weather_stations(): filtering on clause", clause
             base_query = base_query.filter(clause)
+        base_query = base_query.add_columns(*point_columns(stations_table.c.location))
         values = [r for r in base_query.all()]
         fieldnames = [f for f in stations_table.columns.keys()]
         for value in values:
             d = {f:getattr(value, f) for f in fieldnames}
-            loc = str(value.location)
-            d['location'] = loads(loc.decode('hex')).__geo_interface__
+            d['location'] = point_geojson(value, 'location')
             resp['objects'].append(d)
     resp['meta']['query'] = raw_query_params
     resp = make_response(json.dumps(resp, default=dthandler), status_code)
@@ -411,35 +908,57 @@ def weather_stations():
     return resp
 
 @api.route(API_VERSION + '/api/weather/<table>/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
+@compressed
 @crossdomain(origin="*")
 def weather(table):
     raw_query_params = request.args.copy()
+    datatype = raw_query_params.pop('data_type', 'json').lower()
+    if datatype not in ('json', 'ndjson'):
+        resp = {'meta': {'status': 'error', 'message': "'%s' is an invalid output format" % datatype},
+                'objects': []}
+        resp = make_response(json.dumps(resp), 400)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
 
-    weather_table = Table('dat_weather_observations_%s' % table, Base.metadata,
-        autoload=True, autoload_with=engine, extend_existing=True)
-    stations_table = Table('weather_stations', Base.metadata, 
-        autoload=True, autoload_with=engine, extend_existing=True)
+    weather_table = reflected_table('dat_weather_observations_%s' % table)
+    stations_table = reflected_table('weather_stations')
     valid_query, query_clauses, resp, status_code = make_query(weather_table,raw_query_params)
     if valid_query:
         resp['meta']['status'] = 'ok'
-        base_query = session.query(weather_table, stations_table)\
+        base_query = session.query(weather_table, stations_table,
+                                   *point_columns(stations_table.c.location))\
             .join(stations_table, 
             weather_table.c.wban_code == stations_table.c.wban_code)
         for clause in query_clauses:
             base_query = base_query.filter(clause)
 
         try:
-            base_query = base_query.order_by(getattr(weather_table.c, 'date').desc())
+            date_col = getattr(weather_table.c, 'date')
         except AttributeError:
-            base_query = base_query.order_by(getattr(weather_table.c, 'datetime').desc())
+            date_col = getattr(weather_table.c, 'datetime')
+        # Break ties on station so that pages have a stable order to resume from.
+        sort_key = tuple_(date_col, weather_table.c.wban_code)
+        base_query = base_query.order_by(date_col.desc(), weather_table.c.wban_code.desc())
+        if raw_query_params.get('page_token'):
+            after = weather_page_token(raw_query_params['page_token'], date_col)
+            if after is None:
+                resp['meta']['status'] = 'error'
+                resp['meta']['message'] = "'%s' is not a valid page_token" % raw_query_params['page_token']
+                resp = make_response(json.dumps(resp, default=dthandler), 400)
+                resp.headers['Content-Type'] = 'application/json'
+                return resp
+            base_query = base_query.filter(sort_key < tuple_(*after))
         base_query = base_query.limit(RESPONSE_LIMIT) # returning the top 1000 records
-        if raw_query_params.get('offset'):
+        if raw_query_params.get('offset') and not raw_query_params.get('page_token'):
             offset = raw_query_params['offset']
             base_query = base_query.offset(int(offset))
-        values = [r for r in base_query.all()]
         weather_fields = weather_table.columns.keys()
         station_fields = stations_table.columns.keys()
+        if datatype == 'ndjson':
+            return weather_ndjson(base_query, weather_fields, station_fields, date_col)
+        values = [r for r in base_query.all()]
         weather_data = {}
         station_data = {}
         for value in values:
@@ -449,8 +968,7 @@ def weather(table):
                 weather_data[value.wban_code].append(wd)
             else:
                 weather_data[value.wban_code] = [wd]
-            loc = str(value.location)
-            sd['location'] = loads(loc.decode('hex')).__geo_interface__
+            sd['location'] = point_geojson(value, 'location')
             station_data[value.wban_code] = sd
         for station_id in weather_data.keys():
             d = {
@@ -459,14 +977,55 @@ def weather(table):
             }
             resp['objects'].append(d)
         resp['meta']['total'] = sum([len(r['observations']) for r in resp['objects']])
+        if len(values) == RESPONSE_LIMIT:
+            last = values[-1]
+            resp['meta']['next_page_token'] = \
+                make_page_token([getattr(last, date_col.name), last.wban_code])
     resp['meta']['query'] = raw_query_params
     resp = make_response(json.dumps(resp, default=dthandler), status_code)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+def weather_ndjson(base_query, weather_fields, station_fields, date_col):
+    """
+    Write the observations of a weather query one per line, each with its station,
+    reading them off of a server-side cursor.
+    """
+    counter = {'total': 0, 'last': None}
+
+    def next_page_token():
+        if counter['total'] == RESPONSE_LIMIT:
+            last = counter['last']
+            return make_page_token([getattr(last, date_col.name), last.wban_code])
+
+    def objects():
+        rows = base_query.execution_options(stream_results=True).yield_per(STREAM_BATCH_SIZE)
+        for value in timed_iter(rows, 'fetch'):
+            counter['total'] += 1
+            counter['last'] = value
+            sd = {f: getattr(value, f) for f in station_fields}
+            sd['location'] = point_geojson(value, 'location')
+            yield {
+                'station_info': sd,
+                'observation': {f: getattr(value, f) for f in weather_fields},
+            }
+
+    body = iter_ndjson(objects(), default=dthandler, trailer=ndjson_trailer(next_page_token))
+    if is_streaming_request():
+        resp = Response(stream_with_context(timed_iter(body, 'serialize')), 200)
+    else:
+        with timed('serialize'):
+            body = ''.join(body)
+        resp = make_response(body, 200)
+        link_next_page(resp, next_page_token())
+    resp.headers['Content-Type'] = 'application/x-ndjson'
+    return resp
+
 
 @api.route(API_VERSION + '/api/timeseries/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def dataset():
     raw_query_params = request.args.copy()
@@ -479,12 +1038,8 @@ def dataset():
         del raw_query_params['agg']
 
     # if no obs_date given, default to >= 90 days ago
-    if not raw_query_params.get('obs_date__ge'):
-        six_months_ago = datetime.now() - timedelta(days=90)
-        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
-
-    if not raw_query_params.get('obs_date__le'):
-        raw_query_params['obs_date__le'] = datetime.now().strftime('%Y-%m-%d') 
+    for k, v in obs_date_defaults('api.dataset', raw_query_params).items():
+        raw_query_params[k] = v
 
     # set datatype
     datatype = 'json'
@@ -493,24 +1048,11 @@ def dataset():
         del raw_query_params['data_type']
 
     if not raw_query_params.get('dataset_name__in'):
-
-        q = '''
-            SELECT m.dataset_name
-            FROM meta_master AS m 
-            LEFT JOIN celery_taskmeta AS c 
-              ON c.id = (
-                SELECT id FROM celery_taskmeta 
-                WHERE task_id = ANY(m.result_ids) 
-                ORDER BY date_done DESC 
-                LIMIT 1
-              )
-            WHERE m.approved_status = 'true'
-            AND c.status = 'SUCCESS'
-        '''
-        with engine.begin() as c:
-            dataset_names = [d[0] for d in c.execute(q)]
-        
-        raw_query_params['dataset_name__in'] = ','.join(dataset_names)
+        dataset_names, complete = ReadyDataset.catalog(session)
+        # When every approved dataset is ready, dat_master has nothing else in it to filter out.
+        # An empty IN list would filter out everything, so it isn't a filter at all.
+        if not complete and dataset_names:
+            raw_query_params['dataset_name__in'] = ','.join(dataset_names)
 
     mt = MasterTable.__table__
     valid_query, query_clauses, resp, status_code = make_query(mt,raw_query_params)
@@ -532,17 +1074,20 @@ def dataset():
         resp.headers['Content-Type'] = 'application/json'
 
     if valid_query:
-        time_agg = func.date_trunc(agg, mt.c['obs_date'])
-        base_query = session.query(time_agg, 
-            func.count(mt.c['obs_date']),
-            mt.c['dataset_name'])
-        base_query = base_query.filter(mt.c['current_flag'] == True)
-        for clause in query_clauses:
-            base_query = base_query.filter(clause)
-        base_query = base_query.group_by(mt.c['dataset_name'])\
-            .group_by(time_agg)\
-            .order_by(time_agg)
-        values = [o for o in base_query.all()]
+        base_query = rollup_counts(raw_query_params, agg, by_dataset=True)
+        if base_query is None:
+            time_agg = func.date_trunc(agg, mt.c['obs_date'])
+            base_query = session.query(time_agg, 
+                func.count(mt.c['obs_date']),
+                mt.c['dataset_name'])
+            base_query = base_query.filter(mt.c['current_flag'] == True)
+            for clause in query_clauses:
+                base_query = base_query.filter(clause)
+            base_query = base_query.group_by(mt.c['dataset_name'])\
+                .group_by(time_agg)\
+                .order_by(time_agg)
+        with timed('fetch'):
+            values = [o for o in base_query.all()]
 
         # init from and to dates with python datetimes
         from_date = truncate(parse(raw_query_params['obs_date__ge']), agg)
@@ -551,6 +1096,28 @@ def dataset():
         else:
             to_date = datetime.now()
 
+        if datatype == 'csv':
+            # response format
+            # temporal_group,dataset_name_1,dataset_name_2
+            # 2014-02-24 00:00:00,235,653
+            # 2014-03-03 00:00:00,156,624
+            with timed('serialize'):
+                dates, dataset_names, counts = timeseries_matrix(values, from_date, to_date, agg)
+                rows = ([d] + c for d, c in zip(dates, counts.tolist()))
+                body = ''.join(iter_csv(['temporal_group'] + dataset_names, rows))
+            resp = make_response(body, 200)
+            resp.headers['Content-Type'] = 'text/csv'
+            filedate = datetime.now().strftime('%Y-%m-%d')
+            resp.headers['Content-Disposition'] = 'attachment; filename=%s.csv' % (filedate)
+            return resp
+        if datatype in COLUMNAR_TYPES:
+            with timed('serialize'):
+                dates, dataset_names, counts = timeseries_matrix(values, from_date, to_date, agg)
+            body = encode_columns([('temporal_group', datetime)] + [(n, int) for n in dataset_names],
+                                  [dates] + [counts[:, i] for i in range(len(dataset_names))],
+                                  datatype)
+            return columnar_response(body, datatype, 'timeseries')
+
         # build the response
         results = sorted(values, key=itemgetter(2))
         for k,g in groupby(results, key=itemgetter(2)):
@@ -590,51 +1157,118 @@ def dataset():
         resp['meta']['status'] = 'ok'
     
         if datatype == 'json':
-            resp = make_response(json.dumps(resp, default=dthandler), status_code)
+            with timed('serialize'):
+                resp = make_response(json.dumps(resp, default=dthandler), status_code)
             resp.headers['Content-Type'] = 'application/json'
-        elif datatype == 'csv':
- 
-            # response format
-            # temporal_group,dataset_name_1,dataset_name_2
-            # 2014-02-24 00:00:00,235,653
-            # 2014-03-03 00:00:00,156,624
- 
-            fields = ['temporal_group']
-            for o in resp['objects']:
-                fields.append(o['dataset_name'])
- 
-            csv_resp = []
-            i = 0
-            for k,g in groupby(resp['objects'], key=itemgetter('dataset_name')):
-                l_g = list(g)[0]
-                
-                j = 0
-                for row in l_g['items']:
-                    # first iteration, populate the first column with temporal_groups
-                    if i == 0: 
-                        csv_resp.append([row['datetime']])
-                    csv_resp[j].append(row['count'])
-                    j += 1
-                i += 1
-                    
-            csv_resp.insert(0, fields)
-            csv_resp = make_csv(csv_resp)
-            resp = make_response(csv_resp, 200)
-            resp.headers['Content-Type'] = 'text/csv'
-            filedate = datetime.now().strftime('%Y-%m-%d')
-            resp.headers['Content-Disposition'] = 'attachment; filename=%s.csv' % (filedate)
+    return resp
+
+def detail_error(params):
+    valid_query, _, resp, status_code, _ = detail_query(params)
+    if valid_query:
+        return None
+    resp = make_response(json.dumps(resp, default=dthandler), status_code)
+    resp.headers['Content-Type'] = 'application/json'
     return resp
 
 @api.route(API_VERSION + '/api/detail/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
+@compressed
 @crossdomain(origin="*")
+@queueable(detail_error)
 def detail():
     raw_query_params = request.args.copy()
+    valid_query, base_query, resp, status_code, fields = detail_query(raw_query_params)
+    datatype = raw_query_params.get('data_type', 'json').lower()
+    if not valid_query:
+        resp = make_response(json.dumps(resp, default=dthandler), status_code)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+    rejected = admit_query(base_query)
+    if rejected is not None:
+        return rejected
+
+    # Read the page off of a server-side cursor
+    # rather than pulling every row into memory at once.
+    rows = base_query.execution_options(stream_results=True)\
+        .yield_per(STREAM_BATCH_SIZE)
+    rows = timed_iter(rows, 'fetch')
+
+    if datatype in COLUMNAR_TYPES:
+        names = fields['dataset'] + (fields['weather'] or [])
+        body = encode_rows(zip(names, fields['types']),
+                           (detail_csv_row(r, fields) for r in rows), datatype)
+        return columnar_response(body, datatype, raw_query_params['dataset_name'],
+                                 stream=is_streaming_request())
+
+    if datatype == 'csv':
+        body = iter_csv(fields['dataset'] + (fields['weather'] or []),
+                        (detail_csv_row(r, fields) for r in rows))
+        content_type = 'text/csv'
+    elif datatype == 'geojson' and not fields['weather']:
+        features = (detail_feature(detail_row(r, fields)) for r in rows)
+        body = iter_geojson((f for f in features if f), default=dthandler)
+        content_type = 'application/json'
+    else:
+        counter = {'total': 0, 'last': None}
+
+        def objects():
+            for r in rows:
+                counter['total'] += 1
+                counter['last'] = r.master_row_id
+                yield detail_row(r, fields)
+
+        def next_page_token():
+            # A full page in master_row_id order can be resumed from its last row.
+            if counter['total'] == detail_limit() and not raw_query_params.get('order_by'):
+                return make_page_token([counter['last']])
+
+        def meta():
+            resp['meta']['total'] = counter['total']
+            token = next_page_token()
+            if token:
+                resp['meta']['next_page_token'] = token
+            return resp['meta']
+
+        if datatype == 'ndjson':
+            body = iter_ndjson(objects(), default=dthandler,
+                               trailer=ndjson_trailer(next_page_token))
+            content_type = 'application/x-ndjson'
+        else:
+            body = iter_json(objects(), meta, default=dthandler)
+            content_type = 'application/json'
+
+    # Rows are fetched as the body is written, so the time spent
+    # fetching them is counted under 'fetch' rather than 'serialize'.
+    if is_streaming_request():
+        resp = Response(stream_with_context(timed_iter(body, 'serialize')), status_code)
+    else:
+        with timed('serialize'):
+            body = ''.join(body)
+        resp = make_response(body, status_code)
+        if datatype == 'ndjson':
+            link_next_page(resp, next_page_token())
+    resp.headers['Content-Type'] = content_type
+    if datatype == 'csv':
+        filedate = datetime.now().strftime('%Y-%m-%d')
+        resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % \
+            (raw_query_params['dataset_name'], filedate)
+    return resp
+
+def detail_query(raw_query_params):
+    """
+    Build the query behind /detail without running it.
+
+    :param raw_query_params: MultiDict of query parameters. Defaults get filled in
+                             and control parameters stripped out along the way.
+    :return: valid_query, base_query, resp, status_code, fields
+             where resp is the response skeleton (holding an error message if the query is invalid)
+             and fields is a dict of the 'dataset' and 'weather' column names the rows carry,
+             and the 'types' of those columns (dataset columns first).
+    """
     # if no obs_date given, default to >= 30 days ago
-    obs_dates = [i for i in raw_query_params.keys() if i.startswith('obs_date')]
-    if not obs_dates:
-        six_months_ago = datetime.now() - timedelta(days=30)
-        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
+    for k, v in obs_date_defaults('api.detail', raw_query_params).items():
+        raw_query_params[k] = v
     
     include_weather = False
     if raw_query_params.get('weather') is not None:
@@ -643,7 +1277,10 @@ def detail():
     agg, datatype, queries = parse_join_query(raw_query_params)
     order_by = raw_query_params.get('order_by')
     offset = raw_query_params.get('offset')
+    page_token = raw_query_params.get('page_token')
     mt = MasterTable.__table__
+    fields = {'dataset': [], 'weather': None, 'types': []}
+    base_query = None
     valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
     if not raw_query_params.get('dataset_name'):
         valid_query = False
@@ -652,14 +1289,20 @@ def detail():
             'message': "'dataset_name' is required"
         }
         resp['objects'] = []
+        status_code = 400
     if valid_query:
-        resp['meta']['status'] = 'ok'
         dname = raw_query_params['dataset_name']
-        dataset = Table('dat_%s' % dname, Base.metadata,
-            autoload=True, autoload_with=engine,
-            extend_existing=True)
-        dataset_fields = dataset.columns.keys()
-        base_query = session.query(mt, dataset)
+        try:
+            dataset = reflected_table('dat_%s' % dname)
+        except NoSuchTableError:
+            valid_query = False
+            resp['meta']['message'] = "unable to find dataset '%s'" % dname
+            status_code = 400
+    if valid_query:
+        resp['meta']['status'] = 'ok'
+        fields['dataset'] = dataset.columns.keys()
+        fields['types'] = [c.type for c in dataset.columns]
+        base_query = session.query(mt, dataset, *point_columns(mt.c.location_geom))
         if include_weather:
             date_col_name = 'date'
             try:
@@ -673,9 +1316,9 @@ def detail():
                 weather_tname = 'hourly'
             else:
                 weather_tname = 'daily'
-            weather_table = Table('dat_weather_observations_%s' % weather_tname, Base.metadata, 
-                autoload=True, autoload_with=engine, extend_existing=True)
-            weather_fields = weather_table.columns.keys()
+            weather_table = reflected_table('dat_weather_observations_%s' % weather_tname)
+            fields['weather'] = weather_table.columns.keys()
+            fields['types'] += [c.type for c in weather_table.columns]
             base_query = session.query(mt, dataset, weather_table)
         valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
         if valid_query:
@@ -703,187 +1346,315 @@ def detail():
                     base_query = base_query.join(weather_table, mt.c.weather_observation_id == weather_table.c.id)
                     for clause in weather_clauses:
                         base_query = base_query.filter(clause)
+            if valid_query and page_token:
+                # Resume right after the last row of the previous page.
+                # With the (dataset_name, master_row_id) index this costs the same on every page.
+                after = parse_page_token(page_token)
+                if order_by:
+                    valid_query = False
+                    resp['meta']['message'] = "'page_token' can't be combined with 'order_by'"
+                elif not after or len(after) != 1 or not is_integer(after[0]):
+                    valid_query = False
+                    resp['meta']['message'] = "'%s' is not a valid page_token" % page_token
+                else:
+                    base_query = base_query.filter(mt.c.master_row_id > after[0])
+                if not valid_query:
+                    resp['meta']['status'] = 'error'
+                    status_code = 400
             if valid_query:
                 if order_by:
                     col, order = order_by.split(',')
                     base_query = base_query.order_by(getattr(mt.c[col], order)())
                 else:
                     base_query = base_query.order_by(mt.c.master_row_id.asc())
-                base_query = base_query.limit(RESPONSE_LIMIT)
-                if offset:
+                base_query = base_query.limit(detail_limit())
+                if offset and not page_token:
                     base_query = base_query.offset(int(offset))
-                values = [r for r in base_query.all()]
-                for value in values:
-                    d = {f:getattr(value, f) for f in dataset_fields}
-                    if value.location_geom is not None:
-                        d['location_geom'] = loads(value.location_geom.desc, hex=True).__geo_interface__
-                    if include_weather:
-                        d = {
-                            'observation': {f:getattr(value, f) for f in dataset_fields},
-                            'weather': {f:getattr(value, f) for f in weather_fields},
-                        }
-                    resp['objects'].append(d)
                 resp['meta']['query'] = raw_query_params
                 loc = resp['meta']['query'].get('location_geom__within')
                 if loc:
                     resp['meta']['query']['location_geom__within'] = json.loads(loc)
-                resp['meta']['total'] = len(resp['objects'])
-    if datatype == 'json':
-        resp = make_response(json.dumps(resp, default=dthandler), status_code)
-        resp.headers['Content-Type'] = 'application/json'
-    
-    elif datatype == 'geojson' and not include_weather:
-        geojson_resp = {
-          "type": "FeatureCollection",
-          "features": []
+    return valid_query, base_query, resp, status_code, fields
+
+def detail_row(value, fields):
+    """
+    Shape one row of a detail query into the dict we return as JSON.
+    """
+    if fields['weather']:
+        return {
+            'observation': {f:getattr(value, f) for f in fields['dataset']},
+            'weather': {f:getattr(value, f) for f in fields['weather']},
         }
+    d = {f:getattr(value, f) for f in fields['dataset']}
+    location_geom = point_geojson(value, 'location_geom')
+    if location_geom is not None:
+        d['location_geom'] = location_geom
+    return d
 
-        for o in resp['objects']:
-            if o.get('location_geom'):
-                g = {
-                  "type": "Feature",
-                  "geometry": o['location_geom'],
-                  "properties": {f:getattr(value, f) for f in o}
-                }
-                geojson_resp['features'].append(g)
+def point_columns(column):
+    """
+    Select the coordinates of a point column as plain numbers,
+    so rows don't have to be decoded from WKB in Python.
+    Read them back with point_geojson.
+    """
+    return [func.ST_X(column).label('%s_x' % column.name),
+            func.ST_Y(column).label('%s_y' % column.name)]
 
-        resp = make_response(json.dumps(geojson_resp, default=dthandler), status_code)
-        resp.headers['Content-Type'] = 'application/json'
-    elif datatype == 'csv':
-        csv_resp = [dataset_fields]
-        if include_weather:
-            csv_resp = [dataset_fields + weather_fields]
-        for value in values:
-            d = [getattr(value, f) for f in dataset_fields]
-            if include_weather:
-                d.extend([getattr(value, f) for f in weather_fields])
-            csv_resp.append(d)
-        resp = make_response(make_csv(csv_resp), 200)
-        filedate = datetime.now().strftime('%Y-%m-%d')
-        dname = raw_query_params['dataset_name']
-        filedate = datetime.now().strftime('%Y-%m-%d')
-        resp.headers['Content-Type'] = 'text/csv'
-        resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.csv' % (dname, filedate)
-    return resp
+def point_geojson(row, name):
+    """
+    :return: GeoJSON geometry for the point selected with point_columns, or None if it is NULL
+    """
+    x = getattr(row, '%s_x' % name)
+    if x is None:
+        return None
+    return {'type': 'Point', 'coordinates': [x, getattr(row, '%s_y' % name)]}
 
-@api.route(API_VERSION + '/api/detail-aggregate/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+def detail_feature(row):
+    """
+    Turn a dict from detail_row into a GeoJSON Feature.
+    Rows without a location have no place in a FeatureCollection, so return None for them.
+    """
+    if not row.get('location_geom'):
+        return None
+    return {
+        "type": "Feature",
+        "geometry": row['location_geom'],
+        "properties": {k: v for k, v in row.items() if k != 'location_geom'}
+    }
+
+def detail_csv_row(value, fields):
+    return [getattr(value, f) for f in fields['dataset'] + (fields['weather'] or [])]
+
+@api.route(API_VERSION + '/api/export/<dataset_name>')
 @crossdomain(origin="*")
-def detail_aggregate():
+def export_dataset(dataset_name):
+    """
+    Stream a whole dataset (or the part of it matching the same filters as /detail)
+    as CSV (or ndjson with data_type=ndjson), straight out of Postgres with COPY.
+    Add gzip=true to get it gzipped.
+    """
     raw_query_params = request.args.copy()
+    compress = raw_query_params.pop('gzip', '').lower() == 'true'
+    raw_query_params.pop('dataset_name', None)
+    datatype = raw_query_params.pop('data_type', 'csv').lower()
+    agg, _, queries = parse_join_query(raw_query_params)
+
+    resp = {
+        'meta': {
+            'status': 'error',
+            'message': '',
+        },
+        'objects': [],
+    }
+    try:
+        dataset = reflected_table('dat_%s' % dataset_name)
+    except NoSuchTableError:
+        resp['meta']['message'] = "'%s' is not a valid table name" % dataset_name
+        resp = make_response(json.dumps(resp), 404)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+
+    valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
+    base_query = session.query(dataset)
+    if valid_query and datatype not in ('csv', 'ndjson'):
+        valid_query = False
+        status_code = 400
+        resp['meta']['message'] = "'%s' is an invalid output format" % datatype
+    if valid_query and queries['weather']:
+        valid_query = False
+        status_code = 400
+        resp['meta']['message'] = 'Weather filters are not supported on exports'
+    if valid_query and queries['base']:
+        # Filters on dat_master columns (obs_date, location_geom, ...)
+        mt = MasterTable.__table__
+        valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
+        pk = [p.name for p in dataset.primary_key][0]
+        base_query = base_query.join(mt, mt.c.dataset_row_id == dataset.c[pk])\
+            .filter(mt.c.dataset_name == dataset_name)
+        for clause in base_clauses:
+            base_query = base_query.filter(clause)
+    if not valid_query:
+        resp['meta']['status'] = 'error'
+        resp = make_response(json.dumps(resp, default=dthandler), status_code)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+    for clause in detail_clauses:
+        base_query = base_query.filter(clause)
+
+    read_from = read_engine()
+    compiled = base_query.statement.compile(dialect=read_from.dialect)
+    body = iter_copy(read_from, unicode(compiled), compiled.params, datatype)
+    filename = '%s.%s' % (dataset_name, datatype)
+    content_type = 'application/x-ndjson' if datatype == 'ndjson' else 'text/csv'
+    if compress:
+        body = iter_gzip(body)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    resp = Response(body, 200)
+    resp.headers['Content-Type'] = content_type
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return resp
+
+def detail_aggregate_query(raw_query_params):
+    """
+    Check the parameters of /detail-aggregate and build its filters without running anything.
+
+    :param raw_query_params: MultiDict of query parameters. Defaults get filled in along the way.
+    :return: agg, datatype, queries, base_clauses, dataset, detail_clauses, error
+             where error is the 400 response to send back if the query is invalid, and None otherwise.
+    """
     agg, datatype, queries = parse_join_query(raw_query_params)
     if not agg:
         agg = 'day'
 
     # if no obs_date given, default to >= 90 days ago
-    if not raw_query_params.get('obs_date__ge'):
-        six_months_ago = datetime.now() - timedelta(days=90)
-        raw_query_params['obs_date__ge'] = six_months_ago.strftime('%Y-%m-%d')
-
-    if not raw_query_params.get('obs_date__le'):
-        raw_query_params['obs_date__le'] = datetime.now().strftime('%Y-%m-%d') 
+    for k, v in obs_date_defaults('api.detail_aggregate', raw_query_params).items():
+        raw_query_params[k] = v
 
     mt = MasterTable.__table__
+    dataset = None
+    detail_clauses = []
     valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
 
     # check for valid output format
     if datatype not in VALID_DATA_TYPE:
         valid_query = False
-        resp['meta']['status'] = 'error'
         resp['meta']['message'] = "'%s' is an invalid output format" % datatype
-        resp = make_response(json.dumps(resp, default=dthandler), 400)
-        resp.headers['Content-Type'] = 'application/json'
 
     # check for valid temporal aggregate
-    if agg not in VALID_AGG:
+    elif agg not in VALID_AGG:
         valid_query = False
-        resp['meta']['status'] = 'error'
         resp['meta']['message'] = "'%s' is an invalid temporal aggregation" % agg
-        resp = make_response(json.dumps(resp, default=dthandler), 400)
-        resp.headers['Content-Type'] = 'application/json'
 
     if valid_query:
-        time_agg = func.date_trunc(agg, mt.c['obs_date'])
-        base_query = session.query(time_agg, func.count(mt.c.dataset_row_id))
         dname = raw_query_params.get('dataset_name')
-
         try:
-            dataset = Table('dat_%s' % dname, Base.metadata,
-                autoload=True, autoload_with=engine,
-                extend_existing=True)
+            dataset = reflected_table('dat_%s' % dname)
             valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
         except:
             valid_query = False
-            resp['meta']['status'] = 'error'
             if not dname:
                 resp['meta']['message'] = "dataset_name' is required"
             else:
                 resp['meta']['message'] = "unable to find dataset '%s'" % dname
-            resp = make_response(json.dumps(resp, default=dthandler), 400)
-            resp.headers['Content-Type'] = 'application/json'
 
-        if valid_query:
-            pk = [p.name for p in dataset.primary_key][0]
-            base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
-            for clause in base_clauses:
-                base_query = base_query.filter(clause)
-            for clause in detail_clauses:
-                base_query = base_query.filter(clause)
-            values = [r for r in base_query.group_by(time_agg).order_by(time_agg).all()]
-            
-            # init from and to dates ad python datetimes
-            from_date = truncate(parse(raw_query_params['obs_date__ge']), agg)
-            if 'obs_date__le' in raw_query_params.keys():
-                to_date = parse(raw_query_params['obs_date__le'])
-            else:
-                to_date = datetime.now()
+    error = None
+    if not valid_query:
+        resp['meta']['status'] = 'error'
+        error = make_response(json.dumps(resp, default=dthandler), 400)
+        error.headers['Content-Type'] = 'application/json'
+    return agg, datatype, queries, base_clauses, dataset, detail_clauses, error
 
-            items = []
-            dense_matrix = []
-            cursor = from_date
-            v_index = 0
-            while cursor <= to_date:
-                if v_index < len(values) and \
-                    values[v_index][0].replace(tzinfo=None) == cursor:
-                    dense_matrix.append((cursor, values[v_index][1]))
-                    v_index += 1
-                else:
-                    dense_matrix.append((cursor, 0))
+def detail_aggregate_error(params):
+    return detail_aggregate_query(params)[-1]
 
-                cursor = increment_datetime_aggregate(cursor, agg)
+@api.route(API_VERSION + '/api/detail-aggregate/')
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key, unless=skip_cache)
+@compressed
+@crossdomain(origin="*")
+@queueable(detail_aggregate_error)
+def detail_aggregate():
+    raw_query_params = request.args.copy()
+    agg, datatype, queries, base_clauses, dataset, detail_clauses, error = \
+        detail_aggregate_query(raw_query_params)
+    if error is not None:
+        return error
 
-            dense_matrix = OrderedDict(dense_matrix)
-            for k in dense_matrix:
-                i = {
-                    'datetime': k,
-                    'count': dense_matrix[k],
-                    }
-                items.append(i)
+    mt = MasterTable.__table__
+    resp = {
+        'meta': {
+            'status': 'ok',
+            'message': '',
+        },
+        'objects': [],
+    }
+    status_code = 200
+    time_agg = func.date_trunc(agg, mt.c['obs_date'])
+    base_query = session.query(time_agg, func.count(mt.c.dataset_row_id))
+    dname = raw_query_params['dataset_name']
+
+    rollup_query = None
+    if not queries['detail'] and not queries['weather']:
+        rollup_query = rollup_counts(queries['base'], agg,
+                                     by_dataset=False, current_only=False)
+    if rollup_query is not None:
+        with timed('fetch'):
+            values = rollup_query.all()
+    else:
+        pk = [p.name for p in dataset.primary_key][0]
+        base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
+        for clause in base_clauses:
+            base_query = base_query.filter(clause)
+        for clause in detail_clauses:
+            base_query = base_query.filter(clause)
+        base_query = base_query.group_by(time_agg).order_by(time_agg)
+        rejected = admit_query(base_query)
+        if rejected is not None:
+            return rejected
+        with timed('fetch'):
+            values = [r for r in base_query.all()]
+    
+    # init from and to dates ad python datetimes
+    from_date = truncate(parse(raw_query_params['obs_date__ge']), agg)
+    if 'obs_date__le' in raw_query_params.keys():
+        to_date = parse(raw_query_params['obs_date__le'])
+    else:
+        to_date = datetime.now()
+
+    items = []
+    dense_matrix = []
+    cursor = from_date
+    v_index = 0
+    while cursor <= to_date:
+        if v_index < len(values) and \
+            values[v_index][0].replace(tzinfo=None) == cursor:
+            dense_matrix.append((cursor, values[v_index][1]))
+            v_index += 1
+        else:
+            dense_matrix.append((cursor, 0))
 
-            if datatype == 'json':
-                resp['objects'] = items
-                resp['meta']['status'] = 'ok'
-                resp['meta']['query'] = raw_query_params
-                loc = resp['meta']['query'].get('location_geom__within')
-                if loc:
-                    resp['meta']['query']['location_geom__within'] = json.loads(loc)
-                resp['meta']['query']['agg'] = agg
+        cursor = increment_datetime_aggregate(cursor, agg)
 
-                resp = make_response(json.dumps(resp, default=dthandler), status_code)
-                resp.headers['Content-Type'] = 'application/json'
-            elif datatype == 'csv':
-                outp = StringIO()
-                writer = csv.DictWriter(outp, fieldnames=items[0].keys())
-                writer.writeheader()
-                writer.writerows(items)
-                resp = make_response(outp.getvalue(), status_code)
-                resp.headers['Content-Type'] = 'text/csv'
-                filedate = datetime.now().strftime('%Y-%m-%d')
-                resp.headers['Content-Disposition'] = 'attachment; filename=%s.csv' % (filedate)
+    dense_matrix = OrderedDict(dense_matrix)
+    for k in dense_matrix:
+        i = {
+            'datetime': k,
+            'count': dense_matrix[k],
+            }
+        items.append(i)
+
+    if datatype == 'json':
+        resp['objects'] = items
+        resp['meta']['status'] = 'ok'
+        resp['meta']['query'] = raw_query_params
+        loc = resp['meta']['query'].get('location_geom__within')
+        if loc:
+            resp['meta']['query']['location_geom__within'] = json.loads(loc)
+        resp['meta']['query']['agg'] = agg
+
+        with timed('serialize'):
+            resp = make_response(json.dumps(resp, default=dthandler), status_code)
+        resp.headers['Content-Type'] = 'application/json'
+    elif datatype == 'csv':
+        outp = StringIO()
+        writer = csv.DictWriter(outp, fieldnames=items[0].keys())
+        writer.writeheader()
+        writer.writerows(items)
+        resp = make_response(outp.getvalue(), status_code)
+        resp.headers['Content-Type'] = 'text/csv'
+        filedate = datetime.now().strftime('%Y-%m-%d')
+        resp.headers['Content-Disposition'] = 'attachment; filename=%s.csv' % (filedate)
+    elif datatype in COLUMNAR_TYPES:
+        body = encode_rows([('datetime', datetime), ('count', int)],
+                           ((i['datetime'], i['count']) for i in items), datatype)
+        resp = columnar_response(body, datatype, dname)
     return resp
 
 @api.route(API_VERSION + '/api/grid/')
-@cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
 @crossdomain(origin="*")
 def grid():
     raw_query_params = request.args.copy()
@@ -923,43 +1694,151 @@ def grid():
     valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
 
     if valid_query:
-        base_query = session.query(func.count(mt.c.dataset_row_id), 
-                func.ST_SnapToGrid(mt.c.location_geom, size_x, size_y))
         dname = raw_query_params['dataset_name']
-        dataset = Table('dat_%s' % dname, Base.metadata,
-            autoload=True, autoload_with=engine,
-            extend_existing=True)
+        dataset = reflected_table('dat_%s' % dname)
         valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
         if valid_query:
-            pk = [p.name for p in dataset.primary_key][0]
-            base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
-            for clause in base_clauses:
-                base_query = base_query.filter(clause)
-            for clause in detail_clauses:
-                base_query = base_query.filter(clause)
-
-            base_query = base_query.group_by(func.ST_SnapToGrid(mt.c.location_geom, size_x, size_y))
-            values = [d for d in base_query.all()]
+            rollup_query = None
+            if not queries['detail'] and \
+                    (size_x, size_y) == MasterGridCount.cell_size(float(resolution)):
+                rollup_query = rollup_grid(queries['base'], int(float(resolution)))
+            if rollup_query is not None:
+                with timed('fetch'):
+                    values = [(count, cell_x * size_x if cell_x is not None else None,
+                               cell_y * size_y if cell_y is not None else None)
+                              for count, cell_x, cell_y in rollup_query.all()]
+            else:
+                snap = func.ST_SnapToGrid(mt.c.location_geom, size_x, size_y)
+                base_query = session.query(func.count(mt.c.dataset_row_id),
+                                           func.ST_X(snap), func.ST_Y(snap))
+                pk = [p.name for p in dataset.primary_key][0]
+                base_query = base_query.join(dataset, mt.c.dataset_row_id == dataset.c[pk])
+                for clause in base_clauses:
+                    base_query = base_query.filter(clause)
+                for clause in detail_clauses:
+                    base_query = base_query.filter(clause)
+
+                base_query = base_query.group_by(snap)
+                with timed('fetch'):
+                    values = [d for d in base_query.all()]
             resp = {'type': 'FeatureCollection', 'features': []}
-            for value in values:
+            for count, x, y in values:
                 d = {
                     'type': 'Feature', 
                     'properties': {
-                        'count': value[0], 
+                        'count': count, 
                     },
                 }
-                if value[1]:
-                    pt = loads(value[1].decode('hex'))
-                    south, west = (pt.x - (size_x / 2)), (pt.y - (size_y /2))
-                    north, east = (pt.x + (size_x / 2)), (pt.y + (size_y / 2))
-                    d['geometry'] = box(south, west, north, east).__geo_interface__
+                if x is not None:
+                    d['geometry'] = grid_cell(x, y, size_x, size_y)
                 
                 resp['features'].append(d)
     
-    resp = make_response(json.dumps(resp, default=dthandler), status_code)
+    with timed('serialize'):
+        resp = make_response(json.dumps(resp, default=dthandler), status_code)
     resp.headers['Content-Type'] = 'application/json'
     return resp
 
+def grid_cell(x, y, size_x, size_y):
+    """
+    :return: GeoJSON polygon of the grid cell centered on (x, y)
+    """
+    west, east = x - size_x / 2, x + size_x / 2
+    south, north = y - size_y / 2, y + size_y / 2
+    return {
+        'type': 'Polygon',
+        'coordinates': [[[east, south], [east, north], [west, north],
+                         [west, south], [east, south]]],
+    }
+
+@api.route(API_VERSION + '/api/tiles/<dataset_name>/<int:z>/<int:x>/<int:y>.mvt')
+@conditional
+@response_cache.cached(timeout=CACHE_TIMEOUT, key_prefix=make_cache_key)
+@compressed
+@crossdomain(origin="*")
+def tile(dataset_name, z, x, y):
+    """
+    A Mapbox vector tile of a dataset's observations.
+    Tiles at TILE_POINT_ZOOM and up have a 'points' layer with one feature per observation.
+    Tiles below that have a 'grid' layer of cell centers, each with a count.
+    """
+    raw_query_params = request.args.copy()
+    resp = {'meta': {'status': 'error', 'message': ''}, 'objects': []}
+    dataset = None
+    if z > TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        resp['meta']['message'] = "%d/%d/%d is not a valid tile" % (z, x, y)
+    else:
+        try:
+            dataset = reflected_table('dat_%s' % dataset_name)
+        except NoSuchTableError:
+            resp['meta']['message'] = "'%s' is not a valid table name" % dataset_name
+    if dataset is None:
+        resp = make_response(json.dumps(resp), 400)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+
+    agg, datatype, queries = parse_join_query(raw_query_params)
+    mt = MasterTable.__table__
+    valid_query, base_clauses, resp, status_code = make_query(mt, queries['base'])
+    if valid_query:
+        valid_query, detail_clauses, resp, status_code = make_query(dataset, queries['detail'])
+    if not valid_query:
+        resp = make_response(json.dumps(resp, default=dthandler), status_code)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+
+    bounds = tile_bounds(z, x, y)
+    width = bounds[2] - bounds[0]
+    envelope = func.ST_MakeEnvelope(*(bounds + (3857,)))
+    # Take in points just past the edges, so symbols that straddle them aren't cut off.
+    margin = width * TILE_BUFFER / TILE_EXTENT
+    geom = func.ST_Transform(mt.c.location_geom, 3857)
+    if z >= TILE_POINT_ZOOM:
+        layer = 'points'
+        columns = [
+            func.ST_AsMVTGeom(geom, envelope, TILE_EXTENT, TILE_BUFFER, True).label('geom'),
+            mt.c.dataset_row_id,
+            cast(mt.c.obs_date, Text).label('obs_date'),
+        ]
+        group_by = []
+    else:
+        layer = 'grid'
+        cell = width / TILE_GRID_CELLS
+        snapped = func.ST_SnapToGrid(geom, cell, cell)
+        columns = [
+            func.ST_AsMVTGeom(snapped, envelope, TILE_EXTENT, TILE_BUFFER, True).label('geom'),
+            func.count(mt.c.dataset_row_id).label('count'),
+        ]
+        group_by = [snapped]
+
+    pk = [p.name for p in dataset.primary_key][0]
+    features = session.query(*columns)\
+        .join(dataset, mt.c.dataset_row_id == dataset.c[pk])\
+        .filter(mt.c.dataset_name == dataset_name)\
+        .filter(mt.c.location_geom.intersects(
+            func.ST_Transform(func.ST_Expand(envelope, margin), 4326)))
+    for clause in base_clauses + detail_clauses:
+        features = features.filter(clause)
+    if group_by:
+        features = features.group_by(*group_by)
+    features = features.limit(TILE_MAX_FEATURES).subquery('features')
+
+    mvt = session.query(func.ST_AsMVT(literal_column('features'), layer, TILE_EXTENT, 'geom'))\
+        .select_from(features).scalar()
+
+    resp = make_response(str(mvt or ''), 200)
+    resp.headers['Content-Type'] = 'application/vnd.mapbox-vector-tile'
+    return resp
+
+def tile_bounds(z, x, y):
+    """
+    :return: (xmin, ymin, xmax, ymax) of a tile in web mercator (EPSG:3857) meters
+    """
+    size = 2 * WEB_MERCATOR_MAX / 2 ** z
+    xmin = -WEB_MERCATOR_MAX + x * size
+    ymax = WEB_MERCATOR_MAX - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
 # helper functions
 def make_query(table, raw_query_params):
     table_keys = table.columns.keys()
@@ -985,6 +1864,14 @@ def make_query(table, raw_query_params):
         args_keys.remove('order_by')
     if 'weather' in args_keys:
         args_keys.remove('weather')
+    if 'stream' in args_keys:
+        args_keys.remove('stream')
+    if 'async' in args_keys:
+        args_keys.remove('async')
+    if 'timing' in args_keys:
+        args_keys.remove('timing')
+    if 'page_token' in args_keys:
+        args_keys.remove('page_token')
     for query_param in args_keys:
         try:
             field, operator = query_param.split('__')
@@ -1046,25 +1933,243 @@ def make_query(table, raw_query_params):
     #print "make_query(): query_clauses=", query_clauses
     return valid_query, query_clauses, resp, status_code
 
-def getSizeInDegrees(meters, latitude):
+def rollup_counts(params, agg, by_dataset=True, current_only=True):
+    """
+    Count rows from the day-level rollup (dat_master_daily) rather than dat_master.
+
+    The rollup can answer filters on dataset_name and census_block,
+    and obs_date bounds that fall on day boundaries.
+
+    :param params: dict of filters on dat_master columns
+    :param agg: Temporal aggregation, one of VALID_AGG
+    :param by_dataset: Whether to break the counts down by dataset
+    :param current_only: Whether to only count rows with current_flag set
+    :return: Query for (date_trunc, count[, dataset_name]) rows ordered by date,
+             or None if a filter needs columns the rollup doesn't have
+             or a dataset it counts hasn't been rolled up yet.
+    """
+    rt = MasterDailyCount.__table__
+    filters = rollup_filters(rt, params, ['dataset_name', 'census_block'])
+    if filters is None or not rollups_cover(params):
+        return None
+    clauses, row_count = filters
+
+    time_agg = func.date_trunc(agg, cast(rt.c.obs_day, TIMESTAMP))
+    columns = [time_agg, cast(func.sum(row_count), BigInteger)]
+    if by_dataset:
+        columns.append(rt.c.dataset_name)
+    query = session.query(*columns)
+    if current_only:
+        query = query.filter(rt.c.current_flag == True)
+    for clause in clauses:
+        query = query.filter(clause)
+    if by_dataset:
+        query = query.group_by(rt.c.dataset_name)
+    return query.group_by(time_agg).order_by(time_agg)
+
+def rollup_grid(params, resolution):
+    """
+    Count rows per grid cell from the precomputed grid (dat_master_grid) rather than dat_master.
 
-    earth_circumference = 40041000.0 # meters, average circumference
-    degrees_per_meter = 360.0 / earth_circumference
-    
-    degrees_at_equator = meters * degrees_per_meter
+    :param params: dict of filters on dat_master columns
+    :param resolution: Cell width in meters
+    :return: Query for (count, cell_x, cell_y) rows, or None if the resolution
+             isn't precomputed for every dataset counted,
+             or a filter needs columns the rollup doesn't have.
+    """
+    if resolution not in MasterGridCount.RESOLUTIONS:
+        return None
+    gt = MasterGridCount.__table__
+    filters = rollup_filters(gt, params, ['dataset_name'])
+    if filters is None or not rollups_cover(params, grid_resolution=resolution):
+        return None
+    clauses, row_count = filters
+    query = session.query(cast(func.sum(row_count), BigInteger), gt.c.cell_x, gt.c.cell_y)\
+        .filter(gt.c.resolution == resolution)
+    for clause in clauses:
+        query = query.filter(clause)
+    return query.group_by(gt.c.cell_x, gt.c.cell_y)
+
+def rollups_cover(params, grid_resolution=None):
+    """
+    :param params: dict of filters on dat_master columns
+    :param grid_resolution: Also require the grid rollup at this resolution
+    :return: True when every dataset the filters take in has been rolled up
+    """
+    names = None
+    for key, value in params.items():
+        if key == 'dataset_name' or key == 'dataset_name__eq':
+            names = [value]
+        elif key == 'dataset_name__in':
+            names = value.split(',')
+    return RolledUpDataset.covers(names, session, grid_resolution)
 
-    latitude_correction = 1.0 / math.cos(latitude * (math.pi / 180.0))
-    
-    degrees_x = degrees_at_equator * latitude_correction
-    degrees_y = degrees_at_equator
+def rollup_filters(rt, params, fields):
+    """
+    Translate filters on dat_master into filters on a rollup table
+    with obs_day, row_count and midnight_row_count columns.
+
+    :param rt: Rollup table
+    :param params: dict of filters on dat_master columns
+    :param fields: Columns other than obs_date that the rollup shares with dat_master
+    :return: (clauses, row_count) where row_count is the expression to sum,
+             or None if a filter can't be answered from the rollup.
+    """
+    row_count = rt.c.row_count
+    clauses = []
+    other_params = {}
+    for key, value in params.items():
+        try:
+            field, operator = key.split('__')
+        except ValueError:
+            field, operator = key, 'eq'
+        if key in ('offset', 'limit', 'order_by', 'weather', 'stream', 'async', 'timing', 'page_token'):
+            continue
+        if field == 'obs_date':
+            day = parse_day(value)
+            if day is None:
+                return None
+            if operator == 'ge':
+                clauses.append(rt.c.obs_day >= day)
+            elif operator == 'lt':
+                clauses.append(rt.c.obs_day < day)
+            elif operator == 'le':
+                # Only rows stamped at exactly midnight make it in from the last day.
+                clauses.append(rt.c.obs_day <= day)
+                row_count = case([(rt.c.obs_day == day, rt.c.midnight_row_count)],
+                                 else_=row_count)
+            else:
+                return None
+        elif field in fields \
+                and operator != 'within' and not operator.startswith('time_of_day'):
+            other_params[key] = value
+        else:
+            return None
+
+    valid_query, other_clauses, resp, status_code = make_query(rt, other_params)
+    if not valid_query:
+        return None
+    return clauses + other_clauses, row_count
+
+def parse_day(value):
+    """
+    :return: The date value names if it falls exactly on midnight, otherwise None
+    """
+    try:
+        dt = parse(value)
+    except (ValueError, OverflowError, TypeError):
+        return None
+    if dt.tzinfo is not None or dt.time() != datetime.min.time():
+        return None
+    return dt.date()
+
+def make_page_token(values):
+    """
+    Encode the sort key of the last row on a page as an opaque continuation token.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, default=dthandler))
+
+def parse_page_token(token):
+    """
+    :return: The list of sort key values encoded by make_page_token,
+             or None if the token can't be decoded.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+def link_next_page(resp, page_token):
+    """
+    Point a Link header at the page after this one, if there is one.
+    ndjson has no envelope to carry next_page_token in, so buffered pages use this instead.
+    """
+    if not page_token:
+        return
+    args = request.args.copy()
+    args.pop('offset', None)
+    args['page_token'] = page_token
+    resp.headers['Link'] = '<%s?%s>; rel="next"' % (request.base_url, url_encode(args))
+
+def ndjson_trailer(next_page_token):
+    """
+    Streamed responses send their headers before the last row is read,
+    so their next_page_token follows the rows, on a line of its own.
+    """
+    if not is_streaming_request():
+        return None
+    def trailer():
+        token = next_page_token()
+        if token:
+            return {'next_page_token': token}
+    return trailer
+
+def weather_page_token(token, date_col):
+    """
+    :return: The (date, wban_code) a weather page_token resumes after,
+             or None if it isn't a valid token for date_col.
+    """
+    after = parse_page_token(token)
+    if not after or len(after) != 2 \
+            or not all(isinstance(v, basestring) for v in after):
+        return None
+    last_date, last_wban = after
+    try:
+        last_date = parse(last_date)
+    except (ValueError, OverflowError, TypeError):
+        return None
+    if date_col.name == 'date':
+        last_date = last_date.date()
+    return last_date, last_wban
+
+def is_integer(value):
+    # bool is an int too, but never a row id.
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def columnar_response(body, datatype, name, stream=False):
+    """
+    :param body: chunks of an Arrow or Parquet document
+    :param stream: Write out each chunk as it is encoded, rather than buffering the whole document
+    """
+    if stream:
+        resp = Response(stream_with_context(timed_iter(body, 'serialize')), 200)
+    else:
+        with timed('serialize'):
+            body = ''.join(body)
+        resp = make_response(body, 200)
+    resp.headers['Content-Type'] = CONTENT_TYPES[datatype]
+    filedate = datetime.now().strftime('%Y-%m-%d')
+    resp.headers['Content-Disposition'] = 'attachment; filename=%s_%s.%s' % (name, filedate, datatype)
+    return resp
 
-    return degrees_x, degrees_y
+def timeseries_matrix(values, from_date, to_date, agg):
+    """
+    Pivot (date, count, dataset_name) rows onto one date axis shared by every dataset.
 
-def make_csv(data):
-    outp = StringIO()
-    writer = csv.writer(outp)
-    writer.writerows(data)
-    return outp.getvalue()
+    :return: (dates, dataset_names, counts) where counts is an array
+             with a row per date and a column per dataset, zero where there were no rows
+    """
+    dates = []
+    cursor = from_date
+    while cursor <= to_date:
+        dates.append(cursor)
+        cursor = increment_datetime_aggregate(cursor, agg)
+    dataset_names = sorted(set(v[2] for v in values))
+
+    date_index = {d: i for i, d in enumerate(dates)}
+    dataset_index = {name: i for i, name in enumerate(dataset_names)}
+    cells = [(date_index.get(d.replace(tzinfo=None)), dataset_index[name], count)
+             for d, count, name in values]
+    cells = [cell for cell in cells if cell[0] is not None]
+
+    counts = numpy.zeros((len(dates), len(dataset_names)), dtype=numpy.int64)
+    if cells:
+        rows, cols, cell_counts = zip(*cells)
+        counts[list(rows), list(cols)] = cell_counts
+    return dates, dataset_names, counts
 
 def parse_join_query(params):
     queries = {
@@ -1096,6 +2201,8 @@ def parse_join_query(params):
             agg = value
         elif key == 'data_type':
             datatype = value.lower()
+        elif key in ('async', 'timing'):
+            continue
         else:
             queries['detail'][key] = value
     return agg, datatype, queries
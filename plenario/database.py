@@ -1,21 +1,165 @@
+import itertools
+import os
+import threading
+import time
+
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy.pool import NullPool
 from sqlalchemy.ext.declarative import declarative_base
 
+import plenario.settings
 from plenario.settings import DATABASE_CONN
 
+# Read replicas are optional. Without any, everything goes to DATABASE_CONN.
+DATABASE_REPLICAS = getattr(plenario.settings, 'DATABASE_REPLICAS', [])
+# Replicas further behind than this many seconds are skipped
+REPLICA_MAX_LAG = getattr(plenario.settings, 'REPLICA_MAX_LAG', 60)
+# How often (in seconds) to check on each replica
+REPLICA_CHECK_INTERVAL = 10
+# Seconds to wait on a replica that doesn't answer
+REPLICA_CONNECT_TIMEOUT = 3
+
 
 app_engine = create_engine(DATABASE_CONN, convert_unicode=True)
 task_engine = create_engine(
     DATABASE_CONN,
     convert_unicode=True,
     poolclass=NullPool)
+replica_engines = [create_engine(conn, convert_unicode=True,
+                                 connect_args={'connect_timeout': REPLICA_CONNECT_TIMEOUT})
+                   for conn in DATABASE_REPLICAS]
+
+
+class ReplicaRouter(object):
+    """
+    Hands out read replicas in turn, skipping those that are down or lagging,
+    and falls back to the primary when none are fit to use.
+
+    Replicas are checked on a background thread (one per process),
+    so a replica that doesn't answer never holds up a request.
+    Until a replica's first check comes back, reads go elsewhere.
+    """
+
+    def __init__(self, primary, replicas, max_lag, check_interval):
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._turn = itertools.cycle(range(len(replicas)))
+        self._lock = threading.Lock()
+        # engine -> (healthy, checked_at)
+        self._health = {}
+        self._checker_pid = None
+
+    def read_engine(self):
+        self._start_checker()
+        for _ in self.replicas:
+            with self._lock:
+                replica = self.replicas[next(self._turn)]
+            if self.is_healthy(replica):
+                return replica
+        return self.primary
+
+    def is_healthy(self, replica):
+        with self._lock:
+            healthy, checked_at = self._health.get(replica, (False, 0))
+        # Don't trust a result the checker should long since have replaced.
+        return healthy and time.time() - checked_at < 3 * self.check_interval
+
+    def check_all(self):
+        for replica in self.replicas:
+            healthy = self.check(replica)
+            with self._lock:
+                self._health[replica] = (healthy, time.time())
+
+    def check(self, replica):
+        try:
+            with replica.connect() as conn:
+                lag = conn.execute(self._lag_query(conn)).scalar()
+        except Exception as e:
+            print 'Replica {} is unavailable: {}'.format(replica.url.host, repr(e))
+            return False
+        return lag is None or lag <= self.max_lag
+
+    @staticmethod
+    def _lag_query(conn):
+        """
+        Seconds since the last replayed transaction, or 0 when the replica has
+        replayed everything it received. (An idle primary commits nothing,
+        which would otherwise make an up to date replica look further and further behind.)
+        NULL when the server isn't replaying anything, as on a primary.
+        """
+        if conn.dialect.server_version_info >= (10,):
+            received, replayed = 'pg_last_wal_receive_lsn()', 'pg_last_wal_replay_lsn()'
+        else:
+            received, replayed = 'pg_last_xlog_receive_location()', 'pg_last_xlog_replay_location()'
+        return '''
+            SELECT CASE
+              WHEN {received} = {replayed} THEN 0
+              ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END
+        '''.format(received=received, replayed=replayed)
+
+    def _start_checker(self):
+        # Threads don't survive a fork, so each worker process starts its own.
+        if not self.replicas:
+            return
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+        checker = threading.Thread(target=self._check_forever)
+        checker.daemon = True
+        checker.start()
+
+    def _check_forever(self):
+        while True:
+            self.check_all()
+            time.sleep(self.check_interval)
+
+
+router = ReplicaRouter(app_engine, replica_engines, REPLICA_MAX_LAG, REPLICA_CHECK_INTERVAL)
+
+def read_engine():
+    """
+    :return: Engine to run a read-only query on, a replica if one is up
+    """
+    return router.read_engine()
+
+
+class RoutingSession(Session):
+    """
+    Session that reads from a replica and sends anything it flushes to the primary.
+    It sticks with one replica until it is closed, so a request sees one consistent snapshot.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RoutingSession, self).__init__(*args, **kwargs)
+        self._read_bind = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing:
+            return app_engine
+        if self._read_bind is None:
+            self._read_bind = router.read_engine()
+        return self._read_bind
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self._read_bind = None
+
 
 session = scoped_session(sessionmaker(bind=app_engine,
                                       autocommit=False,
                                       autoflush=False))
 
+# For the API, which only reads and can stand to be a moment behind.
+# Anything that needs to see its own writes (like the admin views) uses session.
+read_session = scoped_session(sessionmaker(class_=RoutingSession,
+                                           autocommit=False,
+                                           autoflush=False))
+
 task_session = scoped_session(sessionmaker(bind=task_engine,
                                       autocommit=False,
                                       autoflush=False))
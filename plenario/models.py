@@ -2,14 +2,14 @@ from uuid import uuid4
 from datetime import datetime
 
 from sqlalchemy import Column, Integer, String, Boolean, Date, DateTime, \
-    Text, BigInteger, func
+    Text, BigInteger, Index, func, text, and_
 from sqlalchemy.dialects.postgresql import TIMESTAMP, DOUBLE_PRECISION, ARRAY
 from geoalchemy2 import Geometry
 from sqlalchemy.orm import synonym
 from flask_bcrypt import Bcrypt
 
 from plenario.database import session, Base
-from plenario.utils.helpers import slugify
+from plenario.utils.helpers import slugify, getSizeInDegrees
 
 bcrypt = Bcrypt()
 
@@ -69,10 +69,317 @@ class MasterTable(Base):
     dataset_row_id = Column(Integer)
     location_geom = Column(Geometry('POINT', srid=4326))
 
+    # Lets /detail page through a dataset by master_row_id (see api.make_page_token)
+    # at the same cost no matter how deep the page is.
+    __table_args__ = (
+        Index('ix_dat_master_dataset_name_master_row_id', 'dataset_name', 'master_row_id'),
+    )
+
     def __repr__(self):
         return '<Master %r (%r)>' % (self.dataset_row_id, self.dataset_name)
 
 
+class MasterDailyCount(Base):
+    """
+    Row counts from dat_master, rolled up by dataset, day and census block.
+
+    /timeseries and /detail-aggregate count from here instead of scanning
+    dat_master whenever their filters only touch these columns.
+    Rebuilt for a dataset each time it is ingested.
+    """
+    __tablename__ = 'dat_master_daily'
+    id = Column(BigInteger, primary_key=True)
+    dataset_name = Column(String(100), nullable=False)
+    obs_day = Column(Date, nullable=False)
+    census_block = Column(String(15))
+    current_flag = Column(Boolean)
+    row_count = Column(BigInteger, nullable=False)
+    # Rows stamped exactly at midnight. A filter like obs_date <= '2015-01-31'
+    # only takes in these rows from its last day.
+    midnight_row_count = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        Index('ix_dat_master_daily_dataset_name_obs_day', 'dataset_name', 'obs_day'),
+    )
+
+    def __repr__(self):
+        return '<MasterDailyCount %r %r (%r)>' % (self.dataset_name, self.obs_day, self.row_count)
+
+    @classmethod
+    def rebuild(cls, dataset_name, caller_session):
+        """
+        Recount a dataset from dat_master. The caller is responsible for committing.
+        """
+        cls.remove(dataset_name, caller_session)
+        ins = text("""
+            INSERT INTO dat_master_daily
+              (dataset_name, obs_day, census_block, current_flag,
+               row_count, midnight_row_count)
+            SELECT
+              dataset_name,
+              CAST(obs_date AS DATE),
+              census_block,
+              current_flag,
+              COUNT(*),
+              SUM(CASE WHEN obs_date = date_trunc('day', obs_date) THEN 1 ELSE 0 END)
+            FROM dat_master
+            WHERE dataset_name = :dname
+              AND obs_date IS NOT NULL
+            GROUP BY dataset_name, CAST(obs_date AS DATE), census_block, current_flag
+        """)
+        caller_session.execute(ins, {'dname': dataset_name})
+
+    @classmethod
+    def remove(cls, dataset_name, caller_session):
+        caller_session.execute(cls.__table__.delete()
+                               .where(cls.__table__.c.dataset_name == dataset_name))
+
+
+class MasterGridCount(Base):
+    """
+    Row counts from dat_master, rolled up by dataset, day and grid cell
+    at a fixed set of resolutions.
+
+    /grid reads from here when the requested cell size is one of the
+    precomputed ones. A cell (cell_x, cell_y) is centered on
+    (cell_x * size_x, cell_y * size_y), the same point ST_SnapToGrid
+    would snap its rows to.
+    """
+    __tablename__ = 'dat_master_grid'
+    id = Column(BigInteger, primary_key=True)
+    dataset_name = Column(String(100), nullable=False)
+    # Cell width in meters
+    resolution = Column(Integer, nullable=False)
+    obs_day = Column(Date)
+    # NULL for rows without a location
+    cell_x = Column(Integer)
+    cell_y = Column(Integer)
+    row_count = Column(BigInteger, nullable=False)
+    midnight_row_count = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        Index('ix_dat_master_grid_dataset_name_resolution_obs_day',
+              'dataset_name', 'resolution', 'obs_day'),
+    )
+
+    # Resolutions to precompute: the choices the explorer offers
+    RESOLUTIONS = (100, 200, 300, 400, 500, 1000)
+    # A resolution is only kept for a dataset when it has at most this many
+    # rows for each dat_master row. Small cells over a single day hold so few
+    # rows each that the grid would be about as big as dat_master.
+    MAX_ROW_RATIO = 0.25
+    # Cells are sized at the default map center, which /grid uses when a request gives no center[].
+    CENTER_LATITUDE = 41.880517
+
+    def __repr__(self):
+        return '<MasterGridCount %r %r (%r, %r)>' % (self.dataset_name, self.resolution,
+                                                     self.cell_x, self.cell_y)
+
+    @classmethod
+    def cell_size(cls, resolution):
+        """
+        :return: (size_x, size_y) of a cell in degrees
+        """
+        return getSizeInDegrees(float(resolution), cls.CENTER_LATITUDE)
+
+    @classmethod
+    def rebuild(cls, dataset_name, caller_session):
+        """
+        Recount a dataset from dat_master at every resolution where that pays off.
+        The caller is responsible for committing.
+
+        :return: The resolutions that were kept
+        """
+        cls.remove(dataset_name, caller_session)
+        source_rows = caller_session.execute(
+            'SELECT COUNT(*) FROM dat_master WHERE dataset_name = :dname',
+            {'dname': dataset_name}).scalar()
+        ins = text("""
+            INSERT INTO dat_master_grid
+              (dataset_name, resolution, obs_day, cell_x, cell_y,
+               row_count, midnight_row_count)
+            SELECT
+              dataset_name,
+              :resolution,
+              CAST(obs_date AS DATE),
+              CAST(round(ST_X(location_geom) / :size_x) AS INTEGER),
+              CAST(round(ST_Y(location_geom) / :size_y) AS INTEGER),
+              COUNT(*),
+              SUM(CASE WHEN obs_date = date_trunc('day', obs_date) THEN 1 ELSE 0 END)
+            FROM dat_master
+            WHERE dataset_name = :dname
+            GROUP BY 1, 3, 4, 5
+        """)
+        kept = []
+        gt = cls.__table__
+        for resolution in cls.RESOLUTIONS:
+            size_x, size_y = cls.cell_size(resolution)
+            rows = caller_session.execute(ins, {'dname': dataset_name,
+                                                'resolution': resolution,
+                                                'size_x': size_x,
+                                                'size_y': size_y}).rowcount
+            if rows <= cls.MAX_ROW_RATIO * source_rows:
+                kept.append(resolution)
+            else:
+                caller_session.execute(gt.delete().where(and_(gt.c.dataset_name == dataset_name,
+                                                              gt.c.resolution == resolution)))
+        return kept
+
+    @classmethod
+    def remove(cls, dataset_name, caller_session):
+        caller_session.execute(cls.__table__.delete()
+                               .where(cls.__table__.c.dataset_name == dataset_name))
+
+
+class RolledUpDataset(Base):
+    """
+    Datasets whose rows have been counted into dat_master_daily and dat_master_grid.
+
+    Datasets ingested before the rollups existed aren't in them until
+    init_db.py --rollups backfills them. Until then the API counts
+    those datasets from dat_master.
+    """
+    __tablename__ = 'meta_rollup'
+    dataset_name = Column(String(100), primary_key=True)
+    rolled_up_at = Column(DateTime)
+    # The resolutions dat_master_grid holds for the dataset
+    grid_resolutions = Column(ARRAY(Integer))
+
+    def __repr__(self):
+        return '<RolledUpDataset %r>' % self.dataset_name
+
+    @classmethod
+    def mark(cls, dataset_name, grid_resolutions, caller_session):
+        row = caller_session.query(cls).get(dataset_name)
+        if row is None:
+            row = cls(dataset_name=dataset_name)
+            caller_session.add(row)
+        row.rolled_up_at = datetime.now()
+        row.grid_resolutions = grid_resolutions
+
+    @classmethod
+    def remove(cls, dataset_name, caller_session):
+        caller_session.execute(cls.__table__.delete()
+                               .where(cls.__table__.c.dataset_name == dataset_name))
+
+    @classmethod
+    def covers(cls, dataset_names, caller_session, grid_resolution=None):
+        """
+        :param dataset_names: Datasets a query counts, or None for every approved dataset
+        :param grid_resolution: Also require dat_master_grid to hold them at this resolution
+        :return: True when all of them have been rolled up
+        """
+        q = '''
+            SELECT COUNT(*)
+            FROM meta_master AS m
+            LEFT JOIN meta_rollup AS r
+              ON r.dataset_name = m.dataset_name
+            WHERE (r.dataset_name IS NULL
+        '''
+        params = {}
+        if grid_resolution is not None:
+            q += " OR NOT (:resolution = ANY(COALESCE(r.grid_resolutions, '{}')))"
+            params['resolution'] = grid_resolution
+        q += ')'
+        if dataset_names is None:
+            q += " AND m.approved_status = 'true'"
+        else:
+            if not dataset_names:
+                return True
+            q += ' AND m.dataset_name IN :names'
+            params['names'] = tuple(dataset_names)
+        return caller_session.execute(q, params).scalar() == 0
+
+
+class ReadyDataset(Base):
+    """
+    Catalog of the datasets /timeseries shows by default:
+    approved datasets whose most recent ingest succeeded.
+    The add and update tasks maintain it as they finish.
+    """
+    __tablename__ = 'meta_ready'
+    dataset_name = Column(String(100), primary_key=True)
+    ready_since = Column(DateTime)
+
+    # Approved datasets whose latest ingest task succeeded, going by celery's results
+    CELERY_READY = '''
+        SELECT DISTINCT m.dataset_name
+        FROM meta_master AS m
+        LEFT JOIN celery_taskmeta AS c
+          ON c.id = (
+            SELECT id FROM celery_taskmeta
+            WHERE task_id = ANY(m.result_ids)
+            ORDER BY date_done DESC
+            LIMIT 1
+          )
+        WHERE m.approved_status = 'true'
+        AND c.status = 'SUCCESS'
+    '''
+
+    def __repr__(self):
+        return '<ReadyDataset %r>' % self.dataset_name
+
+    @classmethod
+    def mark_ready(cls, dataset_name, caller_session):
+        cls._fill(caller_session)
+        if caller_session.query(cls).get(dataset_name) is None:
+            caller_session.add(cls(dataset_name=dataset_name, ready_since=datetime.now()))
+
+    @classmethod
+    def mark_not_ready(cls, dataset_name, caller_session):
+        cls._fill(caller_session)
+        caller_session.execute(cls.__table__.delete()
+                               .where(cls.__table__.c.dataset_name == dataset_name))
+
+    @classmethod
+    def catalog(cls, caller_session):
+        """
+        :return: (names, complete) where names lists the ready datasets and
+                 complete is True when every approved dataset is ready.
+                 Only approved datasets get ingested, so when complete is True,
+                 dat_master holds only ready datasets and queries can skip filtering on them.
+        """
+        q = '''
+            SELECT m.dataset_name, r.dataset_name IS NOT NULL
+            FROM meta_master AS m
+            LEFT JOIN meta_ready AS r
+              ON r.dataset_name = m.dataset_name
+            WHERE m.approved_status = 'true'
+        '''
+        rows = list(caller_session.execute(q))
+        names = [name for name, ready in rows if ready]
+        if rows and not names and not cls.is_filled(caller_session):
+            # Upgraded from a version without the catalog, and it hasn't been rebuilt yet.
+            names = [row[0] for row in caller_session.execute(cls.CELERY_READY)]
+        return names, len(names) == len(rows)
+
+    @classmethod
+    def is_filled(cls, caller_session):
+        return caller_session.query(cls.dataset_name).first() is not None
+
+    @classmethod
+    def _fill(cls, caller_session):
+        # Before the first change to an empty catalog, take in the datasets
+        # ingested before it existed. Otherwise they'd drop out of it for good.
+        if not cls.is_filled(caller_session):
+            cls.rebuild(caller_session)
+
+    @classmethod
+    def rebuild(cls, caller_session):
+        """
+        Fill the catalog from the celery task results,
+        for datasets ingested before it existed.
+        The caller is responsible for committing.
+        """
+        caller_session.execute(cls.__table__.delete())
+        ins = '''
+            INSERT INTO meta_ready (dataset_name, ready_since)
+            SELECT ready.dataset_name, NOW()
+            FROM ({}) AS ready
+        '''.format(cls.CELERY_READY)
+        caller_session.execute(ins)
+
+
 class ShapeMetadata(Base):
     __tablename__ = 'meta_shape'
     dataset_name = Column(String, primary_key=True)
@@ -121,6 +428,52 @@ class ShapeMetadata(Base):
             dataset['date_added'] = str(dataset['date_added'])
         return listing
 
+    @classmethod
+    def find_intersecting(cls, geojson_fragment, caller_session, count=True):
+        """
+        Find the shape datasets with geometries that intersect a query geometry.
+
+        Candidates come from a bounding box check against meta_shape.
+        All of them are then checked in one UNION ALL statement
+        that parses the query geometry just once.
+
+        :param geojson_fragment: GeoJSON geometry, as returned by api.extract_first_geometry_fragment
+        :param count: Whether to count the intersecting geometries. Without counts,
+                      each dataset only needs to be probed for one intersecting geometry.
+        :return: list of (dataset_name, num_geoms) pairs, with num_geoms None when count is False
+        """
+        candidates_query = text('''
+            SELECT m.dataset_name
+            FROM meta_shape AS m
+            WHERE m.bbox && ST_GeomFromGeoJSON(:geojson)
+        ''')
+        candidates = [row.dataset_name for row in
+                      caller_session.execute(candidates_query, {'geojson': geojson_fragment})]
+        if not candidates:
+            return []
+
+        if count:
+            probe = '''(SELECT count(g.geom) FROM "{table}" AS g, q
+                         WHERE ST_Intersects(g.geom, q.geom))'''
+        else:
+            probe = '''(SELECT CASE WHEN EXISTS (
+                             SELECT 1 FROM "{table}" AS g, q
+                             WHERE ST_Intersects(g.geom, q.geom)) THEN 1 ELSE 0 END)'''
+        branches = []
+        params = {'geojson': geojson_fragment}
+        for i, name in enumerate(candidates):
+            params['name_%d' % i] = name
+            branches.append('SELECT CAST(:name_{i} AS TEXT) AS dataset_name, {probe} AS num_geoms'
+                            .format(i=i, probe=probe.format(table=name.replace('"', '""'))))
+        intersections_query = text('''
+            WITH q AS (SELECT ST_GeomFromGeoJSON(:geojson) AS geom)
+            {branches}
+        '''.format(branches='\nUNION ALL\n'.join(branches)))
+
+        rows = caller_session.execute(intersections_query, params)
+        return [(row.dataset_name, row.num_geoms if count else None)
+                for row in rows if row.num_geoms > 0]
+
     @classmethod
     def get_metadata_with_etl_result(cls, table_name, caller_session):
         query = '''
@@ -171,6 +524,57 @@ class ShapeMetadata(Base):
         return box
 
 
+class DatasetGeneration(Base):
+    """
+    A counter per dataset that goes up every time the dataset's data changes.
+    The API folds generations into its cache keys, so updating one dataset
+    only retires the cached responses that read from it.
+
+    Point datasets are keyed by dataset_name.
+    Weather tables are keyed by their table name without the 'dat_' prefix,
+    like 'weather_observations_hourly' and 'weather_stations'.
+    """
+    __tablename__ = 'meta_generation'
+    dataset_name = Column(String(100), primary_key=True)
+    generation = Column(BigInteger, nullable=False, default=0)
+    last_update = Column(DateTime)
+
+    def __repr__(self):
+        return '<DatasetGeneration %r (%r)>' % (self.dataset_name, self.generation)
+
+    @classmethod
+    def bump(cls, dataset_name, caller_session):
+        """
+        Increment the generation of a dataset, starting it at 1 if it has none yet.
+        The caller is responsible for committing.
+        """
+        table = cls.__table__
+        now = datetime.now()
+        upd = table.update()\
+            .where(table.c.dataset_name == dataset_name)\
+            .values(generation=table.c.generation + 1, last_update=now)
+        if caller_session.execute(upd).rowcount == 0:
+            caller_session.execute(table.insert().values(dataset_name=dataset_name,
+                                                         generation=1,
+                                                         last_update=now))
+
+    @classmethod
+    def get_all(cls, caller_session):
+        """
+        :return: dict of dataset_name -> (generation, last_update)
+        """
+        rows = caller_session.query(cls.dataset_name, cls.generation, cls.last_update)
+        return {name: (generation, last_update) for name, generation, last_update in rows}
+
+    @classmethod
+    def get(cls, dataset_name, caller_session):
+        """
+        :return: The dataset's generation, or 0 if it has never been bumped
+        """
+        row = caller_session.query(cls).get(dataset_name)
+        return row.generation if row else 0
+
+
 def get_uuid():
     return unicode(uuid4())
 
@@ -2,18 +2,30 @@ import os
 from urlparse import urlparse
 import sys
 from plenario.celery_app import celery_app
-from plenario.models import MetaTable, MasterTable, ShapeMetadata
+from plenario.models import MetaTable, MasterTable, MasterDailyCount, \
+    MasterGridCount, RolledUpDataset, ShapeMetadata, DatasetGeneration, ReadyDataset
 from plenario.database import task_session as session, task_engine as engine, \
     Base
 from plenario.utils.etl import PlenarioETL
 from plenario.utils.shape_etl import ShapeETL
 from plenario.utils.weather import WeatherETL
+from plenario.utils.schema import schema_registry
+from plenario.utils.artifacts import shape_exports
+from plenario.utils.columnar import CONTENT_TYPES as COLUMNAR_CONTENT_TYPES
 from raven.handlers.logging import SentryHandler
 from raven.conf import setup_logging
-from plenario.settings import CELERY_SENTRY_URL
+from plenario.settings import CELERY_SENTRY_URL, DATA_DIR
 from sqlalchemy import Table
 from sqlalchemy.exc import NoSuchTableError, InternalError
 from datetime import datetime, timedelta
+import time
+from werkzeug.urls import url_encode
+
+# Where query jobs write their results, and how long (in seconds) to keep them
+JOB_DIR = os.path.join(DATA_DIR, 'query_jobs')
+JOB_MAX_AGE = 60*60*24
+# Set in the environ of requests replayed by a job
+JOB_ENVIRON_KEY = 'plenario.query_job'
 
 if CELERY_SENTRY_URL:
     handler = SentryHandler(CELERY_SENTRY_URL)
@@ -28,6 +40,7 @@ def delete_dataset(self, source_url_hash):
         dat_table.drop(engine, checkfirst=True)
     except NoSuchTableError:
         pass
+    schema_registry.invalidate('dat_%s' % md.dataset_name)
     master_table = MasterTable.__table__
     delete = master_table.delete()\
         .where(master_table.c.dataset_name == md.dataset_name)
@@ -35,6 +48,11 @@ def delete_dataset(self, source_url_hash):
     try:
         conn.execute(delete)
         session.delete(md)
+        MasterDailyCount.remove(md.dataset_name, session)
+        MasterGridCount.remove(md.dataset_name, session)
+        RolledUpDataset.remove(md.dataset_name, session)
+        ReadyDataset.mark_not_ready(md.dataset_name, session)
+        DatasetGeneration.bump(md.dataset_name, session)
         session.commit()
     except InternalError, e:
         raise delete_dataset.retry(exc=e)
@@ -54,9 +72,27 @@ def add_dataset(self, source_url_hash, s3_path=None, data_types=None):
             .where(MetaTable.source_url_hash == source_url_hash)\
             .values(result_ids=ids))
     etl = PlenarioETL(md.as_dict(), data_types=data_types)
-    etl.add(s3_path=s3_path)
+    try:
+        etl.add(s3_path=s3_path)
+    except:
+        _finish_ingest(md, succeeded=False)
+        raise
+    _finish_ingest(md, succeeded=True)
     return 'Finished adding {0} ({1})'.format(md.human_name, md.source_url_hash)
 
+def _finish_ingest(md, succeeded):
+    """
+    Keep meta_ready in step with the outcome of the latest ingest.
+    A failed ingest can leave partial rows behind, so it bumps the generation too.
+    """
+    session.rollback()
+    if succeeded and md.approved_status == 'true':
+        ReadyDataset.mark_ready(md.dataset_name, session)
+    else:
+        ReadyDataset.mark_not_ready(md.dataset_name, session)
+        DatasetGeneration.bump(md.dataset_name, session)
+    session.commit()
+
 @celery_app.task(bind=True)
 def add_shape(self, table_name):
 
@@ -73,7 +109,9 @@ def add_shape(self, table_name):
 def delete_shape(self, table_name):
     shape_meta = session.query(ShapeMetadata).get(table_name)
     shape_meta.remove_table(caller_session=session)
+    DatasetGeneration.bump(table_name, session)
     session.commit()
+    shape_exports.remove(table_name)
     return 'Removed {}'.format(table_name)
 
 @celery_app.task
@@ -98,9 +136,72 @@ def update_dataset(self, source_url_hash, s3_path=None):
             .where(MetaTable.source_url_hash == source_url_hash)\
             .values(result_ids=ids))
     etl = PlenarioETL(md.as_dict())
-    etl.update(s3_path=s3_path)
+    try:
+        etl.update(s3_path=s3_path)
+    except:
+        _finish_ingest(md, succeeded=False)
+        raise
+    _finish_ingest(md, succeeded=True)
     return 'Finished updating {0} ({1})'.format(md.human_name, md.source_url_hash)
 
+_job_app = None
+
+@celery_app.task(bind=True)
+def run_query_job(self, path, args):
+    """
+    Run an API request in the background and write its response to a file in JOB_DIR.
+    See api.queueable.
+
+    :param path: Request path, like '/v1/api/detail/'
+    :param args: List of (name, value) query parameters
+    :return: dict with the status_code and content_type of the response and the filename it was written to
+    """
+    global _job_app
+    if _job_app is None:
+        # plenario imports this module while it sets itself up, so wait until now to build an app.
+        from plenario import create_app
+        _job_app = create_app()
+
+    if not os.path.isdir(JOB_DIR):
+        try:
+            os.makedirs(JOB_DIR)
+        except OSError:
+            pass
+    _remove_old_job_files()
+
+    with _job_app.test_request_context(path, query_string=url_encode(args),
+                                       environ_base={JOB_ENVIRON_KEY: True}):
+        resp = _job_app.full_dispatch_request()
+        content_type = resp.headers.get('Content-Type', 'application/json')
+        ext = 'csv' if content_type.startswith('text/csv') else 'json'
+        if content_type.startswith('application/x-ndjson'):
+            ext = 'ndjson'
+        for data_type, columnar_type in COLUMNAR_CONTENT_TYPES.items():
+            if content_type.startswith(columnar_type):
+                ext = data_type
+        filename = '{}.{}'.format(self.request.id, ext)
+        # Write the response as it is produced, without holding it in memory.
+        with open(os.path.join(JOB_DIR, filename), 'wb') as f:
+            for chunk in resp.iter_encoded():
+                f.write(chunk)
+        resp.close()
+
+    return {
+        'status_code': resp.status_code,
+        'content_type': content_type,
+        'filename': filename,
+    }
+
+def _remove_old_job_files():
+    cutoff = time.time() - JOB_MAX_AGE
+    for name in os.listdir(JOB_DIR):
+        path = os.path.join(JOB_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
 @celery_app.task
 def update_metar():
     print "update_metar()"
@@ -0,0 +1,167 @@
+"""
+On-disk cache of exported shape datasets.
+
+Exporting a shape dataset with ogr2ogr can take minutes for big layers
+like census blocks, so each export is written once per dataset generation
+and served from disk after that. The least recently used exports are
+evicted once the cache grows past its size limit. Only one ogr2ogr runs
+per export at a time, across threads and worker processes. Anyone else
+asking for it waits for that run to finish.
+"""
+import fcntl
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from plenario.settings import DATA_DIR
+from plenario.utils.ogr2ogr import OgrExport
+
+SHAPE_EXPORT_DIR = os.path.join(DATA_DIR, 'shape_exports')
+SHAPE_EXPORT_FORMATS = ['json', 'kml', 'shapefile']
+# Evict exports once the cache takes up more than this many bytes.
+SHAPE_EXPORT_MAX_BYTES = 5 * 1024 ** 3
+# Lock files (and temporary files) start with a dot, so eviction skips them.
+LOCK_PREFIX = '.lock-'
+
+
+class ArtifactCache(object):
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, dataset_name, generation, export_format):
+        return os.path.join(self.root, '{}.{}.{}'.format(dataset_name, generation, export_format))
+
+    def get(self, dataset_name, generation, export_format):
+        """
+        :return: Path to the export of this generation of the dataset, writing it first if need be.
+        :raises OgrError: if ogr2ogr fails
+        """
+        path = self.path(dataset_name, generation, export_format)
+        if self._touch(path):
+            return path
+        with self._build_lock(path):
+            # Whoever held the lock may have just built it.
+            if self._touch(path):
+                return path
+            return self.build(dataset_name, generation, export_format)
+
+    def build(self, dataset_name, generation, export_format):
+        """
+        Export the dataset and add it to the cache,
+        dropping any exports of older generations.
+        """
+        self._makedirs()
+
+        # Write under a temporary name and move it into place in one step,
+        # so nobody ever serves a half-written export.
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.export-')
+        os.close(fd)
+        # OgrExport expects there to be nothing at the path yet.
+        os.remove(tmp_path)
+        try:
+            OgrExport(export_format=export_format, table_name=dataset_name, export_path=tmp_path).write_file()
+            path = self.path(dataset_name, generation, export_format)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+        self.remove(dataset_name, keep_generation=generation)
+        self.evict(keep=path)
+        return path
+
+    def remove(self, dataset_name, keep_generation=None):
+        """
+        Drop the exports of a dataset, except those of keep_generation.
+        """
+        prefix = dataset_name + '.'
+        keep_prefix = '{}.{}.'.format(dataset_name, keep_generation)
+        for name in self._listdir():
+            # Lock files of old generations go too.
+            export_name = name[len(LOCK_PREFIX):] if name.startswith(LOCK_PREFIX) else name
+            if export_name.startswith(prefix) and not export_name.startswith(keep_prefix):
+                # Dataset names can share a prefix, like foo and foo.bar,
+                # so check that the rest of the name is generation.format
+                rest = export_name[len(prefix):].split('.')
+                if len(rest) == 2 and rest[0].isdigit():
+                    self._unlink(os.path.join(self.root, name))
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used exports until the cache fits in max_bytes.
+        """
+        with self._lock:
+            entries = []
+            for name in self._listdir():
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(self.root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                self._unlink(path)
+                total -= size
+
+    @contextmanager
+    def _build_lock(self, path):
+        """
+        Hold an exclusive lock on building the export at path.
+        """
+        self._makedirs()
+        lock_path = os.path.join(self.root, LOCK_PREFIX + os.path.basename(path))
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _touch(path):
+        """
+        Mark an export as recently used.
+        :return: False if it isn't there, which includes having just been evicted
+        """
+        try:
+            os.utime(path, None)
+            return True
+        except OSError:
+            return False
+
+    def _makedirs(self):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # Someone else got there first.
+                pass
+
+    def _listdir(self):
+        try:
+            return os.listdir(self.root)
+        except OSError:
+            return []
+
+    @staticmethod
+    def _unlink(path):
+        # Files that are being downloaded stay readable until they are closed.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+shape_exports = ArtifactCache(SHAPE_EXPORT_DIR, SHAPE_EXPORT_MAX_BYTES)
@@ -0,0 +1,91 @@
+"""
+Canonical cache keys for API queries.
+
+Two requests that ask for the same data should map to the same key,
+in every process on every machine. So the key is a SHA-1 digest of a
+normalized form of the query rather than Python's (per-process salted) hash().
+"""
+import json
+from hashlib import sha1
+
+from dateutil.parser import parse
+
+# Fields whose values we compare as dates rather than as strings
+DATE_FIELDS = ['obs_date', 'date', 'datetime']
+
+
+def cache_key(path, args, defaults=None, generations=None):
+    """
+    :param path: Request path, like '/v1/api/detail/'
+    :param args: MultiDict of query parameters
+    :param defaults: dict of parameters the endpoint fills in when the request leaves them out
+    :param generations: (dataset_name, generation) pairs for the datasets the query reads.
+                        Bumping any of them moves the query to a new key.
+    :return: str key, stable across processes
+    """
+    query = canonical_query(args, defaults)
+    payload = [query, sorted([name, gen] for name, gen in (generations or []))]
+    digest = sha1(json.dumps(payload, separators=(',', ':'))).hexdigest()
+    return '%s:%s' % (path.rstrip('/'), digest)
+
+
+def canonical_query(args, defaults=None):
+    """
+    Normalize query parameters so equivalent queries compare equal.
+
+    - every value of a repeated parameter (like center[]) is kept, in order
+    - dates are rewritten in ISO 8601
+    - the members of __in lists are sorted
+    - GeoJSON is reduced to its first geometry with sorted keys
+    - defaults are filled in for parameters the request leaves out
+
+    :return: Sorted list of [key, [values]] pairs
+    """
+    params = {}
+    for key, values in args.lists():
+        params[key] = [canonical_value(key, v) for v in values]
+    for key, value in (defaults or {}).items():
+        # Endpoints treat a blank value the same as a missing one.
+        if not any(params.get(key, [])):
+            params[key] = [canonical_value(key, value)]
+    return sorted([key, values] for key, values in params.items())
+
+
+def canonical_value(key, value):
+    parts = key.split('__')
+    field = parts[0]
+    operator = parts[1] if len(parts) > 1 else 'eq'
+
+    if operator == 'in':
+        return ','.join(sorted(set(v.strip() for v in value.split(','))))
+    if operator == 'within':
+        return canonical_geojson(value)
+    if field in DATE_FIELDS and not operator.startswith('time_of_day'):
+        try:
+            return parse(value).isoformat()
+        except (ValueError, OverflowError, TypeError):
+            return value
+    if key == 'data_type':
+        return value.lower()
+    return value
+
+
+def canonical_geojson(value):
+    """
+    The API only looks at the first geometry of a GeoJSON document,
+    so that is all the key needs to capture.
+    """
+    try:
+        geo = json.loads(value)
+    except ValueError:
+        return value
+    if not isinstance(geo, dict):
+        return value
+    if 'features' in geo:
+        try:
+            geo = geo['features'][0]['geometry']
+        except (IndexError, KeyError, TypeError):
+            return value
+    elif 'geometry' in geo:
+        geo = geo['geometry']
+    return json.dumps(geo, sort_keys=True, separators=(',', ':'))
@@ -0,0 +1,192 @@
+"""
+Response caching that runs each query once, however many requests want it.
+
+With a plain cache, every request that arrives between a popular entry
+expiring and being written back runs the same query. Here only one of
+them does. Requests in the same process wait on a lock, and requests in
+other processes wait on a lock held in the shared cache backend.
+
+Entries also outlive their timeout by stale_timeout. An expired entry is
+still served while a single request refreshes it, so nobody waits at all.
+"""
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import update_wrapper
+
+# How long to sleep between checks for another worker's result
+POLL_INTERVAL = 0.05
+
+
+class CoalescingCache(object):
+
+    def __init__(self, cache, stale_timeout, lock_timeout, timer=None):
+        """
+        :param cache: Flask-Cache (or werkzeug) cache to store entries and locks in
+        :param stale_timeout: Seconds an expired entry is still served while it is refreshed
+        :param lock_timeout: Seconds to wait on another worker before running the query anyway
+        :param timer: Optional callable returning a context manager to time cache reads and writes with,
+                      given the name of the phase ('cache')
+        """
+        self.cache = cache
+        self.stale_timeout = stale_timeout
+        self.lock_timeout = lock_timeout
+        self.timer = timer or _untimed
+        self._locks_lock = threading.Lock()
+        self._locks = {}
+
+    def cached(self, timeout, key_prefix, unless=None):
+        """
+        Decorate a view like Flask-Cache's cached().
+
+        :param timeout: Seconds before an entry is refreshed
+        :param key_prefix: Callable returning the cache key for the current request
+        :param unless: Callable returning True when the response should bypass the cache
+        """
+        def decorator(f):
+            def wrapped_function(*args, **kwargs):
+                if unless is not None and unless():
+                    return f(*args, **kwargs)
+                compute = lambda: f(*args, **kwargs)
+                return self.get_or_compute(key_prefix(), compute, timeout)
+            return update_wrapper(wrapped_function, f)
+        return decorator
+
+    def get_or_compute(self, key, compute, timeout):
+        entry = self._get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if time.time() < expires_at:
+                return value
+            # Stale. One request refreshes it while everyone else gets the old value.
+            with self._holding(key, blocking=False) as held:
+                if held:
+                    return self._compute(key, compute, timeout)
+            return value
+
+        # Missing. Wait for whoever is already computing it,
+        # or compute it ourselves if they take longer than lock_timeout.
+        with self._holding(key, blocking=True):
+            entry = self._get(key)
+            if entry is not None:
+                return entry[1]
+            return self._compute(key, compute, timeout)
+
+    def _compute(self, key, compute, timeout):
+        value = compute()
+        # Only keep successful responses. Errors, and 202s pointing at a
+        # background job, describe this one request rather than the data.
+        if getattr(value, 'status_code', 200) == 200:
+            self._set(key, value, timeout)
+        return value
+
+    @contextmanager
+    def _holding(self, key, blocking):
+        """
+        Hold the lock on key, both in this process and in the cache backend.
+        Yields whether the lock was taken. When blocking, it always is,
+        unless another thread or worker holds it for longer than lock_timeout.
+        """
+        local = self._local_lock(key)
+        if not self._acquire_local_lock(local, blocking):
+            self._release_local_lock(key)
+            yield False
+            return
+        try:
+            token = self._acquire_shared_lock(key, blocking)
+            try:
+                yield token is not None or blocking
+            finally:
+                if token is not None:
+                    self._release_shared_lock(key, token)
+        finally:
+            local.release()
+            self._release_local_lock(key)
+
+    def _local_lock(self, key):
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _acquire_local_lock(self, lock, blocking):
+        """
+        :return: Whether lock was taken. Gives up after lock_timeout.
+        """
+        if lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        # Python 2 locks can't be acquired with a timeout.
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            if lock.acquire(False):
+                return True
+        return False
+
+    def _release_local_lock(self, key):
+        # Forget locks nobody is waiting on, so the dict doesn't grow forever.
+        with self._locks_lock:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _acquire_shared_lock(self, key, blocking):
+        """
+        :return: Token to release the lock with, or None if it wasn't taken
+        """
+        lock_key = self._lock_key(key)
+        token = uuid.uuid4().hex
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                if self.cache.add(lock_key, token, timeout=self.lock_timeout):
+                    return token
+            except Exception:
+                # No shared lock is better than no response.
+                return None
+            if not blocking or time.time() > deadline:
+                return None
+            # Another worker is computing it. Stop waiting once it's written.
+            if self._get(key) is not None:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+    def _release_shared_lock(self, key, token):
+        lock_key = self._lock_key(key)
+        try:
+            # Don't release a lock that timed out and was taken by someone else.
+            if self.cache.get(lock_key) == token:
+                self.cache.delete(lock_key)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _lock_key(key):
+        return 'lock:%s' % key
+
+    def _get(self, key):
+        """
+        :return: (expires_at, value) or None
+        """
+        try:
+            with self.timer('cache'):
+                return self.cache.get(key)
+        except Exception:
+            return None
+
+    def _set(self, key, value, timeout):
+        try:
+            with self.timer('cache'):
+                self.cache.set(key, (time.time() + timeout, value),
+                               timeout=timeout + self.stale_timeout)
+        except Exception:
+            pass
+
+
+@contextmanager
+def _untimed(phase):
+    yield
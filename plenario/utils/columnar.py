@@ -0,0 +1,151 @@
+"""
+Arrow and Parquet encoders for API responses.
+
+Both formats are typed and column oriented, so pandas and Spark can load
+them without parsing text. Rows are gathered into record batches of
+BATCH_ROWS as they come off the cursor, with column types taken from
+the table the rows come from. The encoders yield the bytes of each batch
+as soon as it is written, so a streamed response never holds more than
+one batch. (Parquet's footer comes at the very end.)
+
+pyarrow is optional. Without it, COLUMNAR_TYPES is empty and the
+API doesn't offer these formats.
+"""
+from datetime import date, datetime
+
+from sqlalchemy import types
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Rows per record batch (and Parquet row group)
+BATCH_ROWS = 64 * 1024
+
+COLUMNAR_TYPES = ['arrow', 'parquet'] if pa is not None else []
+
+CONTENT_TYPES = {
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+def arrow_type(sql_type):
+    """
+    :param sql_type: SQLAlchemy column type, or a Python type for computed columns
+    :return: The pyarrow type to store the column as.
+             Anything without a natural match (like geometries) is stored as a string.
+    """
+    if sql_type in (int, long) or isinstance(sql_type, types.Integer):
+        return pa.int64()
+    if sql_type is float or isinstance(sql_type, (types.Float, types.Numeric)):
+        return pa.float64()
+    if sql_type is bool or isinstance(sql_type, types.Boolean):
+        return pa.bool_()
+    if sql_type is datetime or isinstance(sql_type, types.DateTime):
+        return pa.timestamp('us')
+    if sql_type is date or isinstance(sql_type, types.Date):
+        return pa.date32()
+    return pa.string()
+
+
+def encode_rows(columns, rows, data_type):
+    """
+    :param columns: list of (name, SQLAlchemy or Python type) pairs
+    :param rows: iterable of rows, each a sequence of values in the order of columns
+    :param data_type: 'arrow' or 'parquet'
+    :return: generator of chunks of the encoded document, about one per record batch
+    """
+    schema = _schema(columns)
+
+    def batches():
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_ROWS:
+                yield _batch(schema, zip(*batch))
+                batch = []
+        if batch:
+            yield _batch(schema, zip(*batch))
+
+    return _write(schema, batches(), data_type)
+
+
+def encode_columns(columns, arrays, data_type):
+    """
+    Like encode_rows, for data that is already laid out by column.
+
+    :param arrays: list of sequences (or NumPy arrays), one per column
+    """
+    schema = _schema(columns)
+    return _write(schema, [_batch(schema, arrays)], data_type)
+
+
+def _schema(columns):
+    return pa.schema([pa.field(name, arrow_type(sql_type)) for name, sql_type in columns])
+
+
+def _batch(schema, arrays):
+    return pa.RecordBatch.from_arrays(
+        [pa.array(_coerce(values, field.type), type=field.type) for field, values in zip(schema, arrays)],
+        schema.names)
+
+
+def _coerce(values, arrow_type):
+    # String columns hold anything we couldn't match a type to.
+    if arrow_type == pa.string():
+        return [v if v is None or isinstance(v, basestring) else unicode(v) for v in values]
+    # Numeric columns come back as Decimals.
+    if arrow_type == pa.float64():
+        return [v if v is None else float(v) for v in values]
+    return values
+
+
+def _write(schema, batches, data_type):
+    sink = _Sink()
+    if data_type == 'parquet':
+        writer = pq.ParquetWriter(sink, schema)
+        write = lambda batch: writer.write_table(pa.Table.from_batches([batch]))
+    else:
+        writer = pa.RecordBatchStreamWriter(sink, schema)
+        write = writer.write_batch
+    for batch in batches:
+        write(batch)
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.drain()
+
+
+class _Sink(object):
+    """
+    Write-only file that hands over whatever was written to it since it was last drained.
+    """
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = memoryview(data).tobytes()
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        chunk = ''.join(self._chunks)
+        self._chunks = []
+        return chunk
@@ -16,8 +16,10 @@ from boto.s3.connection import S3Connection, S3ResponseError
 from boto.s3.key import Key
 
 from plenario.database import task_session as session, task_engine as engine
-from plenario.models import MetaTable, MasterTable
+from plenario.models import MetaTable, MasterTable, MasterDailyCount, \
+    MasterGridCount, RolledUpDataset, DatasetGeneration
 from plenario.utils.helpers import slugify, iter_column
+from plenario.utils.schema import schema_registry
 from plenario.settings import AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET, DATA_DIR
 
 COL_TYPES = {
@@ -158,7 +160,9 @@ class PlenarioETL(object):
         self._update_master()
         self._update_meta(added=True)
         self._update_geotags()
+        self._update_rollup()
         self._cleanup_temp_tables()
+        self._bump_generation()
     
     def update(self, s3_path=None):
         if s3_path and s3_key:
@@ -180,7 +184,9 @@ class PlenarioETL(object):
            #    self._update_master_current_flag()
         self._update_meta()
         self._update_geotags()
+        self._update_rollup()
         self._cleanup_temp_tables()
+        self._bump_generation()
 
     def _download_csv(self):
         """
@@ -292,6 +298,8 @@ class PlenarioETL(object):
                                    *cols, extend_existing=True)
             # ... and load it into the database.
             self.dat_table.create(engine, checkfirst=True)
+            # Make sure nobody keeps serving an old reflection of the table.
+            schema_registry.invalidate(self.dat_table.name)
 
     def _make_src_table(self):
         """
@@ -710,6 +718,23 @@ class PlenarioETL(object):
         # self._add_weather_stations()
         self._add_census_block()
 
+    def _update_rollup(self):
+        """
+        Recount the dataset's rows in dat_master_daily and dat_master_grid.
+        Runs after geotagging so the counts pick up census blocks.
+        """
+        MasterDailyCount.rebuild(self.dataset_name, session)
+        resolutions = MasterGridCount.rebuild(self.dataset_name, session)
+        RolledUpDataset.mark(self.dataset_name, resolutions, session)
+        session.commit()
+
+    def _bump_generation(self):
+        """
+        Retire cached API responses that read from this dataset.
+        """
+        DatasetGeneration.bump(self.dataset_name, session)
+        session.commit()
+
     def _update_meta(self, added=False):
         """ 
         Update the meta_master table with obs_from, obs_to, 
@@ -2,6 +2,7 @@ import requests
 import re
 from unicodedata import normalize
 import calendar
+import math
 import string
 from datetime import timedelta
 from csvkit.unicsv import UnicodeCSVReader
@@ -155,6 +156,20 @@ def increment_datetime_aggregate(sourcedate, time_agg):
 
     return sourcedate + delta
 
+def getSizeInDegrees(meters, latitude):
+
+    earth_circumference = 40041000.0 # meters, average circumference
+    degrees_per_meter = 360.0 / earth_circumference
+    
+    degrees_at_equator = meters * degrees_per_meter
+
+    latitude_correction = 1.0 / math.cos(latitude * (math.pi / 180.0))
+    
+    degrees_x = degrees_at_equator * latitude_correction
+    degrees_y = degrees_at_equator
+
+    return degrees_x, degrees_y
+
 def send_mail(subject, recipient, body):
     msg = Message(subject,
               sender=(MAIL_DISPLAY_NAME, MAIL_USERNAME),
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from sqlalchemy import MetaData, Table
+
+from plenario.database import app_engine
+
+# Re-reflect a table at least this often (in seconds),
+# in case it was changed by another process.
+SCHEMA_MAX_AGE = 60*5
+
+
+class SchemaRegistry(object):
+    """
+    Process-wide cache of reflected tables.
+
+    The first lookup of a table reflects it from the database.
+    Later lookups are served from memory until the table is invalidated,
+    its entry is older than max_age, or the caller passes a newer
+    dataset generation than the one the table was reflected at.
+
+    Tables live in the registry's own MetaData,
+    so looking them up never touches Base.metadata.
+    """
+
+    def __init__(self, engine, max_age=SCHEMA_MAX_AGE):
+        self.engine = engine
+        self.max_age = max_age
+        self.metadata = MetaData()
+        self._reflected_at = {}
+        self._generations = {}
+        self._lock = threading.RLock()
+
+    def get(self, table_name, generation=None):
+        """
+        :param table_name: Name of the table in the database, like 'dat_crimes_2001_to_present'
+        :param generation: Current generation of the dataset behind the table, if known.
+                           Lets a change made by another process show up right away.
+        :return: Reflected sqlalchemy Table
+        :raises NoSuchTableError: if the table does not exist
+        """
+        with self._lock:
+            reflected_at = self._reflected_at.get(table_name)
+            if reflected_at is not None \
+                    and time.time() - reflected_at < self.max_age \
+                    and self._generations.get(table_name) == generation:
+                return self.metadata.tables[table_name]
+
+            self._forget(table_name)
+            table = Table(table_name, self.metadata,
+                          autoload=True, autoload_with=self.engine)
+            self._reflected_at[table_name] = time.time()
+            self._generations[table_name] = generation
+            return table
+
+    def invalidate(self, table_name):
+        """
+        Drop a table from the registry so the next lookup reflects it again.
+        Call this after creating, altering or dropping the table.
+        """
+        with self._lock:
+            self._forget(table_name)
+
+    def clear(self):
+        with self._lock:
+            self.metadata.clear()
+            self._reflected_at = {}
+            self._generations = {}
+
+    def _forget(self, table_name):
+        table = self.metadata.tables.get(table_name)
+        if table is not None:
+            self.metadata.remove(table)
+        self._reflected_at.pop(table_name, None)
+        self._generations.pop(table_name, None)
+
+
+schema_registry = SchemaRegistry(app_engine)
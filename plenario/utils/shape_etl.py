@@ -11,8 +11,10 @@ from boto.s3.key import Key
 from plenario.database import session, app_engine as engine
 from plenario.settings import AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_BUCKET
 from plenario.utils.shapefile import import_shapefile, ShapefileError
+from plenario.utils.ogr2ogr import OgrError
+from plenario.utils.artifacts import shape_exports, SHAPE_EXPORT_FORMATS
 
-from plenario.models import ShapeMetadata
+from plenario.models import ShapeMetadata, DatasetGeneration
 
 from plenario.utils.etl import PlenarioETLError
 
@@ -135,8 +137,22 @@ class ShapeETL:
 
         self._ingest_shapefile()
         self.meta.update_after_ingest(session)
+        DatasetGeneration.bump(self.table_name, session)
 
         session.commit()
+        self._export()
+
+    def _export(self):
+        """
+        Write out the exports people can download, so the first download doesn't have to wait on them.
+        """
+        generation = DatasetGeneration.get(self.table_name, session)
+        for export_format in SHAPE_EXPORT_FORMATS:
+            try:
+                shape_exports.build(self.table_name, generation, export_format)
+            except OgrError as e:
+                # The export will be tried again when someone asks for it.
+                print "Failed to export {} as {}.\n{}".format(self.table_name, export_format, e.message)
 
     def _ingest_shapefile(self):
 
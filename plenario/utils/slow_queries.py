@@ -0,0 +1,136 @@
+"""
+Which kinds of SQL the API spends its time on.
+
+Every statement run while serving a request is timed and reduced to a
+fingerprint: the SQL with its literals (dates, GeoJSON, IN lists and so on)
+replaced by placeholders. Two /detail requests that only differ in their
+filter values then count as the same query. Stats are kept per fingerprint
+along with the shape of the API request that produced it (the endpoint and
+the names of its parameters), and statements slower than SLOW_QUERY_MS are
+logged along with the request they came from.
+
+The stats cover the last one to two QueryStats.window seconds
+and the process they were recorded in.
+"""
+import re
+import threading
+import time
+from hashlib import sha1
+
+from flask import request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Log statements slower than this many milliseconds, unless SLOW_QUERY_MS is set
+DEFAULT_SLOW_QUERY_MS = 500
+# Request shapes kept per fingerprint
+MAX_SHAPES = 10
+
+_PARAM = re.compile(r'%\(\w+\)s|%s')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(statement):
+    """
+    :return: statement with its literals replaced by ?, so that statements
+             which only differ in their values come out the same
+    """
+    fp = _STRING.sub('?', statement)
+    fp = _PARAM.sub('?', fp)
+    fp = _NUMBER.sub('?', fp)
+    # IN lists of any length
+    fp = _LIST.sub('(?)', fp)
+    return _SPACE.sub(' ', fp).strip()
+
+
+def request_shape():
+    """
+    :return: The endpoint and parameter names of the current request, like
+             'api.detail?dataset_name&obs_date__ge'
+    """
+    return '%s?%s' % (request.endpoint, '&'.join(sorted(set(request.args.keys()))))
+
+
+class QueryStats(object):
+
+    def __init__(self, window=60*60):
+        """
+        :param window: Seconds after which stats are rotated out
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._current = {}
+        self._previous = {}
+        self._rotated_at = time.time()
+
+    def record(self, statement, ms, shape):
+        fp = fingerprint(statement)
+        key = sha1(fp.encode('utf-8') if isinstance(fp, unicode) else fp).hexdigest()[:12]
+        with self._lock:
+            self._rotate()
+            stat = self._current.get(key)
+            if stat is None:
+                stat = self._current[key] = {
+                    'fingerprint_id': key,
+                    'fingerprint': fp,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'shapes': set(),
+                }
+            stat['count'] += 1
+            stat['total_ms'] += ms
+            stat['max_ms'] = max(stat['max_ms'], ms)
+            if len(stat['shapes']) < MAX_SHAPES:
+                stat['shapes'].add(shape)
+        return key
+
+    def top(self, n=20):
+        """
+        :return: The n fingerprints that took the most time in all, as dicts, slowest first
+        """
+        with self._lock:
+            self._rotate()
+            merged = {}
+            for stats in (self._previous, self._current):
+                for key, stat in stats.items():
+                    m = merged.setdefault(key, dict(stat, count=0, total_ms=0.0, max_ms=0.0, shapes=set()))
+                    m['count'] += stat['count']
+                    m['total_ms'] += stat['total_ms']
+                    m['max_ms'] = max(m['max_ms'], stat['max_ms'])
+                    m['shapes'] |= stat['shapes']
+        for stat in merged.values():
+            stat['mean_ms'] = stat['total_ms'] / stat['count']
+            stat['shapes'] = sorted(stat['shapes'])
+        return sorted(merged.values(), key=lambda s: s['total_ms'], reverse=True)[:n]
+
+    def _rotate(self):
+        now = time.time()
+        if now - self._rotated_at > self.window:
+            self._previous = self._current if now - self._rotated_at < 2 * self.window else {}
+            self._current = {}
+            self._rotated_at = now
+
+
+query_stats = QueryStats()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and context is not None:
+        context._query_started_at = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, '_query_started_at', None)
+    if started_at is None or not has_request_context():
+        return
+    ms = (time.time() - started_at) * 1000
+    shape = request_shape()
+    key = query_stats.record(statement, ms, shape)
+    if ms > current_app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS):
+        print 'Slow query {} took {:.0f}ms for {} {}'.format(key, ms, request.method, request.full_path)
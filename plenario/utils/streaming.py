@@ -0,0 +1,235 @@
+"""
+Generator-based encoders for API responses.
+
+Each encoder takes an iterable of rows and yields chunks of the encoded
+document as they fill up, so a response can be written out while the
+database cursor is still being read and nothing ever holds the full result.
+"""
+import csv
+import json
+import threading
+import zlib
+import Queue
+from cStringIO import StringIO
+
+# Brotli is optional. Without it, responses are only ever gzipped.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Flush to the client roughly every 64KB.
+CHUNK_SIZE = 64 * 1024
+
+
+def _buffered(pieces):
+    """
+    Group small string pieces into chunks of about CHUNK_SIZE bytes.
+    """
+    buff = []
+    size = 0
+    for piece in pieces:
+        buff.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buff)
+            buff = []
+            size = 0
+    if buff:
+        yield ''.join(buff)
+
+
+def iter_json(objects, meta, default=None):
+    """
+    Encode an API response of the form {"objects": [...], "meta": {...}}.
+
+    :param objects: iterable of JSON serializable objects
+    :param meta: callable returning the meta dict. It is called once every
+                 object has been written, so it can report totals.
+    :param default: passed through to json.dumps to handle dates and such.
+    """
+    def pieces():
+        yield '{"objects": ['
+        for i, obj in enumerate(objects):
+            if i:
+                yield ', '
+            yield json.dumps(obj, default=default)
+        yield '], "meta": '
+        yield json.dumps(meta(), default=default)
+        yield '}'
+    return _buffered(pieces())
+
+
+def iter_geojson(features, default=None):
+    """
+    Encode a GeoJSON FeatureCollection from an iterable of Feature dicts.
+    """
+    def pieces():
+        yield '{"type": "FeatureCollection", "features": ['
+        for i, feature in enumerate(features):
+            if i:
+                yield ', '
+            yield json.dumps(feature, default=default)
+        yield ']}'
+    return _buffered(pieces())
+
+
+def iter_ndjson(objects, default=None, trailer=None):
+    """
+    Encode newline-delimited JSON: one object per line, with no envelope around them.
+
+    :param trailer: optional callable, called once every object has been written.
+                    If it returns an object, that goes on a last line of its own.
+    """
+    def pieces():
+        for obj in objects:
+            yield json.dumps(obj, default=default) + '\n'
+        last = trailer() if trailer is not None else None
+        if last is not None:
+            yield json.dumps(last, default=default) + '\n'
+    return _buffered(pieces())
+
+
+def iter_csv(header, rows):
+    """
+    Encode a header and an iterable of rows (lists of values) as CSV.
+    """
+    def pieces():
+        outp = StringIO()
+        writer = csv.writer(outp)
+        writer.writerow(_encode_row(header))
+        for row in rows:
+            writer.writerow(_encode_row(row))
+            # Hand back whatever the writer produced and reuse the buffer.
+            yield outp.getvalue()
+            outp.seek(0)
+            outp.truncate()
+        yield outp.getvalue()
+    return _buffered(pieces())
+
+
+def _encode_row(row):
+    # The csv module in Python 2 can't cope with unicode.
+    return [v.encode('utf-8') if isinstance(v, unicode) else v for v in row]
+
+
+# COPY statements for the formats iter_copy can produce.
+# row_to_json escapes every control character, so with control characters
+# for the CSV quote and delimiter each JSON document is written out verbatim.
+COPY_FORMATS = {
+    'csv': "COPY ({}) TO STDOUT WITH CSV HEADER",
+    'ndjson': "COPY (SELECT row_to_json(r) FROM ({}) r) TO STDOUT "
+              "WITH CSV QUOTE E'\\x01' DELIMITER E'\\x02'",
+}
+
+
+def iter_copy(engine, query, params=None, data_type='csv'):
+    """
+    Run COPY (query) TO STDOUT and yield its output as Postgres produces it.
+    This skips building a Python object per row,
+    which makes it much faster than reading the rows through SQLAlchemy.
+
+    psycopg2 can only copy into a file object, so the copy runs on a thread
+    of its own and hands chunks over through a short queue. If the consumer
+    stops early (say the client went away) the copy is abandoned.
+
+    :param engine: SQLAlchemy engine to take a connection from
+    :param query: SELECT statement in psycopg2's paramstyle
+    :param params: parameters for query
+    :param data_type: 'csv' for CSV with a header, or 'ndjson' for a JSON object per row
+    """
+    chunks = Queue.Queue(maxsize=8)
+    cancelled = threading.Event()
+    done = object()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        raise IOError('COPY cancelled')
+
+    class Writer(object):
+        # psycopg2 writes a row at a time. Hand them over in CHUNK_SIZE batches.
+        def __init__(self):
+            self.buff = []
+            self.size = 0
+
+        def write(self, data):
+            self.buff.append(data)
+            self.size += len(data)
+            if self.size >= CHUNK_SIZE:
+                self.flush()
+
+        def flush(self):
+            if self.buff:
+                put(''.join(self.buff))
+                self.buff = []
+                self.size = 0
+
+    def copy():
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            sql = cursor.mogrify(query, params)
+            writer = Writer()
+            cursor.copy_expert(COPY_FORMATS[data_type].format(sql), writer)
+            writer.flush()
+            conn.rollback()
+            put(done)
+        except Exception as e:
+            # The connection may be stuck partway through the COPY,
+            # so don't hand it back to the pool.
+            conn.invalidate()
+            try:
+                put(e)
+            except IOError:
+                pass
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+
+def iter_gzip(chunks):
+    """
+    Gzip a stream of chunks.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_brotli(chunks):
+    """
+    Brotli compress a stream of chunks. Needs the brotli package.
+    """
+    compressor = brotli.Compressor(quality=5)
+    for chunk in chunks:
+        compressed = compressor.process(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.finish()
+
+
+# Encoders by Content-Encoding
+ENCODERS = {'gzip': iter_gzip}
+if brotli is not None:
+    ENCODERS['br'] = iter_brotli
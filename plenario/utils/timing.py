@@ -0,0 +1,166 @@
+"""
+Where the time goes in an API request.
+
+A RequestTimer lives on flask.g for the length of a request and adds up the
+time spent in each phase (SQL, fetching rows, serializing, cache lookups).
+Phases can nest. Each phase only counts its own time, not that of the
+phases inside it, so the phases add up to the request.
+
+Finished requests are folded into per-endpoint histograms (EndpointStats)
+that the admin timing page reads. They cover the process they were recorded
+in, so with several workers each keeps its own.
+"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (in milliseconds) of the histogram buckets. The last bucket has no bound.
+BUCKETS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class RequestTimer(object):
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.totals = OrderedDict()
+        # (phase, started_at, seconds taken by nested phases)
+        self._stack = []
+
+    def start(self, phase):
+        self._stack.append([phase, time.time(), 0.0])
+
+    def stop(self, phase):
+        if phase not in [name for name, _, _ in self._stack]:
+            return
+        # Close anything left open inside this phase too.
+        while self._stack:
+            name, started_at, nested = self._stack.pop()
+            elapsed = time.time() - started_at
+            self.totals[name] = self.totals.get(name, 0.0) + elapsed - nested
+            if self._stack:
+                self._stack[-1][2] += elapsed
+            if name == phase:
+                break
+
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    def milliseconds(self):
+        """
+        :return: dict of phase -> milliseconds, with the total under 'total'
+        """
+        timing = OrderedDict((phase, round(seconds * 1000, 1)) for phase, seconds in self.totals.items())
+        timing['total'] = round(self.elapsed() * 1000, 1)
+        return timing
+
+    def server_timing(self):
+        """
+        :return: Value for a Server-Timing header, durations in milliseconds
+        """
+        return ', '.join('%s;dur=%s' % (phase, ms) for phase, ms in self.milliseconds().items())
+
+
+def start_timer():
+    """
+    Start timing the current request.
+    """
+    g.timer = RequestTimer()
+    return g.timer
+
+
+def current_timer():
+    """
+    :return: The RequestTimer of the current request, or None outside of one
+    """
+    if not has_request_context():
+        return None
+    return getattr(g, 'timer', None)
+
+
+@contextmanager
+def timed(phase):
+    """
+    Count the time spent in the block towards phase, if the request is being timed.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    timer.start(phase)
+    try:
+        yield
+    finally:
+        timer.stop(phase)
+
+
+def timed_iter(iterable, phase):
+    """
+    Count the time spent getting each item out of iterable towards phase.
+    """
+    it = iter(iterable)
+    while True:
+        with timed(phase):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+# Time every statement run during a request, whichever engine runs it.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = current_timer()
+    if timer is not None:
+        timer.start('sql')
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = current_timer()
+    if timer is not None:
+        timer.stop('sql')
+
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # endpoint -> phase -> {'count', 'total', 'buckets'}
+        self._stats = {}
+
+    def record(self, endpoint, timer):
+        durations = list(timer.totals.items()) + [('total', timer.elapsed())]
+        with self._lock:
+            phases = self._stats.setdefault(endpoint, {})
+            for phase, seconds in durations:
+                stat = phases.setdefault(phase, {'count': 0, 'total': 0.0,
+                                                 'buckets': [0] * (len(BUCKETS) + 1)})
+                ms = seconds * 1000
+                stat['count'] += 1
+                stat['total'] += ms
+                stat['buckets'][bucket_index(ms)] += 1
+
+    def snapshot(self):
+        """
+        :return: Sorted list of (endpoint, [(phase, count, mean ms, buckets)])
+        """
+        with self._lock:
+            return [(endpoint, [(phase, s['count'], s['total'] / s['count'], list(s['buckets']))
+                                for phase, s in sorted(phases.items())])
+                    for endpoint, phases in sorted(self._stats.items())]
+
+
+def bucket_index(ms):
+    for i, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS)
+
+
+endpoint_stats = EndpointStats()
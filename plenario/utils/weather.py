@@ -18,15 +18,27 @@ import calendar
 from plenario.database import task_session as session, task_engine as engine, \
     Base
 from plenario.settings import DATA_DIR
+from plenario.models import DatasetGeneration
+from plenario.utils.schema import schema_registry
 import sqlalchemy
 from sqlalchemy import Table, Column, String, Date, DateTime, Integer, Float, \
-    VARCHAR, BigInteger, and_, select, text, distinct, func
+    VARCHAR, BigInteger, Index, and_, select, text, distinct, func
 from sqlalchemy.dialects.postgresql import ARRAY
 from geoalchemy2 import Geometry
 from uuid import uuid4
 
 from weather_metar import getMetar, getMetarVals, getAllCurrentWeather, getCurrentWeather
 
+def bump_generation(table_name):
+    """
+    Retire cached API responses that read from a weather table.
+    Generations are keyed by table name without the 'dat_' prefix.
+    """
+    if table_name.startswith('dat_'):
+        table_name = table_name[len('dat_'):]
+    DatasetGeneration.bump(table_name, session)
+    session.commit()
+
 # from http://stackoverflow.com/questions/7490660/converting-wind-direction-in-angles-to-text-words
 def degToCardinal(num):
     val=int((num/22.5)+.5)
@@ -188,6 +200,10 @@ class WeatherETL(object):
             self._update(span='hourly')
             # self._add_location(span='hourly') # XXX mcc: hmm
         #self._cleanup_temp_tables()
+        if (not no_daily):
+            bump_generation(self.daily_table.name)
+        if (not no_hourly):
+            bump_generation(self.hourly_table.name)
 
     def _metar_do_etl(self,  weather_stations_list = None, banned_weather_stations_list = None):
         # Below code hits the METAR server
@@ -209,6 +225,7 @@ class WeatherETL(object):
         self._load_metar(t_metars)
         self._update_metar()
         self._metar_cleanup_temp_tables()
+        bump_generation(self.metar_table.name)
 
     def _cleanup_temp_tables(self):
         for span in ['daily', 'hourly']:
@@ -394,9 +411,12 @@ class WeatherETL(object):
     def make_tables(self):
         self._make_daily_table()
         self._make_hourly_table()
+        schema_registry.invalidate(self.daily_table.name)
+        schema_registry.invalidate(self.hourly_table.name)
 
     def metar_make_tables(self):
         self._make_metar_table()
+        schema_registry.invalidate(self.metar_table.name)
             
     ########################################
     ########################################
@@ -1192,6 +1212,9 @@ class WeatherETL(object):
                             Column('max2_direction_cardinal', String(3)), # e.g. NNE, NNW
                             Column('longitude', Float),
                             Column('latitude', Float),
+                            # Sort key for paging through /v1/api/weather/daily/
+                            Index('ix_%s_weather_observations_daily_date_wban_code' % name,
+                                  'date', 'wban_code'),
                             keep_existing=True) 
 
     def _get_hourly_table(self, name='dat'):
@@ -1224,6 +1247,9 @@ class WeatherETL(object):
                 Column('hourly_precip', Float, index=True),
                 Column('longitude', Float),
                 Column('latitude', Float),
+                # Sort key for paging through /v1/api/weather/hourly/
+                Index('ix_%s_weather_observations_hourly_datetime_wban_code' % name,
+                      'datetime', 'wban_code'),
                 keep_existing=True)
 
     def _get_metar_table(self, name='dat'):
@@ -1253,6 +1279,9 @@ class WeatherETL(object):
                 Column('precip_24hr', Float, index=True),
                 Column('longitude', Float),
                 Column('latitude', Float),
+                # Sort key for paging through /v1/api/weather/metar/
+                Index('ix_%s_weather_observations_metar_datetime_wban_code' % name,
+                      'datetime', 'wban_code'),
                 keep_existing=True)
 
     
@@ -1474,6 +1503,7 @@ class WeatherStationsETL(object):
         except:
             print 'weather stations already exist, updating instead'
             self._update_stations()
+        bump_generation(self.station_table.name)
 
     def update(self):
         self._extract()
@@ -1481,6 +1511,7 @@ class WeatherStationsETL(object):
         # Doing this just so self.station_table is defined
         self._make_station_table()
         self._update_stations()
+        bump_generation(self.station_table.name)
 
     def _extract(self):
         """ Download CSV of station info from NOAA """
@@ -1544,6 +1575,7 @@ class WeatherStationsETL(object):
                 Column('begin', Date),
                 Column('end', Date))
         self.station_table.create(engine, checkfirst=True)
+        schema_registry.invalidate(self.station_table.name)
 
     def _load(self):
         names = [c.name for c in self.station_table.columns]
@@ -1,8 +1,11 @@
 from flask import make_response, request, redirect, url_for, render_template, current_app, g, \
     Blueprint, flash, session as flask_session
-from plenario.models import MasterTable, MetaTable, User, ShapeMetadata
+from plenario.models import MasterTable, MetaTable, User, ShapeMetadata, \
+    DatasetGeneration
 from plenario.database import session, Base, app_engine as engine
 from plenario.utils.helpers import get_socrata_data_info, iter_column, send_mail, slugify
+from plenario.utils.timing import endpoint_stats, BUCKETS
+from plenario.utils.slow_queries import query_stats, DEFAULT_SLOW_QUERY_MS
 from plenario.tasks import update_dataset as update_dataset_task, \
     delete_dataset as delete_dataset_task, add_dataset as add_dataset_task, \
     add_shape as add_shape_task, delete_shape as delete_shape_task
@@ -192,6 +195,8 @@ def approve_dataset(source_url_hash):
     upd = { 'approved_status': 'true' }
 
     meta.approved_status = 'true'
+    # Retire cached copies and validators of the dataset list.
+    DatasetGeneration.bump(meta.dataset_name, session)
     session.commit()
 
     # Email the user who submitted that their dataset has been approved.
@@ -387,6 +392,19 @@ def shape_status():
     return render_template('admin/shape-status.html', shape=shape_meta)
 
 
+@views.route('/admin/api-timing')
+@login_required
+def api_timing():
+    return render_template('admin/api-timing.html', stats=endpoint_stats.snapshot(), buckets=BUCKETS)
+
+
+@views.route('/admin/slow-queries')
+@login_required
+def slow_queries():
+    return render_template('admin/slow-queries.html', queries=query_stats.top(),
+                           threshold=current_app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS))
+
+
 @views.route('/admin/dataset-status/')
 @login_required
 def dataset_status():
@@ -552,6 +570,7 @@ def edit_dataset(source_url_hash):
         session.query(MetaTable)\
             .filter(MetaTable.source_url_hash == meta.source_url_hash)\
             .update(upd)
+        DatasetGeneration.bump(meta.dataset_name, session)
         session.commit()
 
         
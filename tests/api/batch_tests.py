@@ -0,0 +1,78 @@
+import unittest
+import json
+
+import plenario.api
+from plenario import create_app
+from init_db import init_master_meta_user
+
+DATES = {'obs_date__ge': '2014-09-01', 'obs_date__le': '2014-09-30'}
+
+
+class BatchTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_master_meta_user()
+        cls.app = create_app().test_client()
+
+    def setUp(self):
+        # Make one dataset blow up inside its endpoint.
+        self.detail_aggregate_query = plenario.api.detail_aggregate_query
+
+        def detail_aggregate_query(params):
+            if params.get('dataset_name') == 'broken':
+                raise RuntimeError('broken dataset')
+            return self.detail_aggregate_query(params)
+        plenario.api.detail_aggregate_query = detail_aggregate_query
+
+    def tearDown(self):
+        plenario.api.detail_aggregate_query = self.detail_aggregate_query
+
+    def post(self, queries):
+        resp = self.app.post('/v1/api/batch', data=json.dumps({'queries': queries}),
+                             content_type='application/json')
+        return resp, json.loads(resp.data)
+
+    def test_failed_queries_do_not_sink_the_batch(self):
+        resp, body = self.post([
+            {'id': 'counts', 'endpoint': 'timeseries', 'params': dict(DATES, agg='week')},
+            {'id': 'bad', 'endpoint': 'detail-aggregate',
+             'params': dict(DATES, dataset_name='crimes', data_type='xml')},
+            {'id': 'broken', 'endpoint': 'detail-aggregate',
+             'params': dict(DATES, dataset_name='broken')},
+        ])
+        self.assertEqual(resp.status_code, 200)
+        results = body['objects']
+        self.assertEqual(results['counts']['status_code'], 200)
+        self.assertEqual(results['counts']['response']['meta']['status'], 'ok')
+        self.assertEqual(results['bad']['status_code'], 400)
+        self.assertEqual(results['bad']['response']['meta']['message'],
+                         "'xml' is an invalid output format")
+        self.assertEqual(results['broken']['status_code'], 500)
+        self.assertIn('broken dataset', results['broken']['response'])
+
+    def test_unnamed_queries_are_keyed_by_position(self):
+        resp, body = self.post([
+            {'endpoint': 'timeseries', 'params': DATES},
+            {'endpoint': 'timeseries', 'params': dict(DATES, agg='month')},
+        ])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sorted(body['objects']), ['0', '1'])
+
+    def test_duplicate_ids_are_rejected(self):
+        resp, body = self.post([
+            {'id': 'counts', 'endpoint': 'timeseries', 'params': DATES},
+            {'id': 'counts', 'endpoint': 'timeseries', 'params': dict(DATES, agg='month')},
+        ])
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(body['meta']['message'], "Query 1 reuses the id 'counts'")
+
+    def test_ids_that_clash_with_positions_are_rejected(self):
+        resp, body = self.post([
+            {'endpoint': 'timeseries', 'params': DATES},
+            {'id': '0', 'endpoint': 'timeseries', 'params': DATES},
+        ])
+        self.assertEqual(resp.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import json
+
+from werkzeug.datastructures import MultiDict
+
+from plenario.utils.cache_keys import cache_key
+
+
+class CacheKeyTests(unittest.TestCase):
+
+    def test_equivalent_dates_share_a_key(self):
+        a = MultiDict([('dataset_name', 'crimes'), ('obs_date__ge', '2014-1-1')])
+        b = MultiDict([('obs_date__ge', '2014-01-01'), ('dataset_name', 'crimes')])
+        self.assertEqual(cache_key('/v1/api/detail/', a), cache_key('/v1/api/detail', b))
+
+    def test_in_lists_are_sorted(self):
+        a = MultiDict([('dataset_name__in', 'b,a,c')])
+        b = MultiDict([('dataset_name__in', 'a,c,b')])
+        self.assertEqual(cache_key('/v1/api/timeseries/', a), cache_key('/v1/api/timeseries/', b))
+
+    def test_repeated_args_are_kept(self):
+        a = MultiDict([('center[]', '41.88'), ('center[]', '-87.64')])
+        b = MultiDict([('center[]', '41.88'), ('center[]', '-87.00')])
+        self.assertNotEqual(cache_key('/v1/api/grid/', a), cache_key('/v1/api/grid/', b))
+
+    def test_geojson_key_order_does_not_matter(self):
+        geom = {'type': 'Polygon', 'coordinates': [[[0, 0], [0, 1], [1, 1], [0, 0]]]}
+        feature = {'type': 'Feature', 'properties': {}, 'geometry': geom}
+        a = MultiDict([('location_geom__within', json.dumps(feature))])
+        b = MultiDict([('location_geom__within', json.dumps(geom, sort_keys=True))])
+        self.assertEqual(cache_key('/v1/api/detail/', a), cache_key('/v1/api/detail/', b))
+
+    def test_defaults_fill_missing_params(self):
+        defaults = {'obs_date__ge': '2014-01-01'}
+        a = MultiDict([('dataset_name', 'crimes')])
+        b = MultiDict([('dataset_name', 'crimes'), ('obs_date__ge', '2014-1-1')])
+        self.assertEqual(cache_key('/v1/api/detail/', a, defaults),
+                         cache_key('/v1/api/detail/', b))
+
+    def test_generations_change_the_key(self):
+        args = MultiDict([('dataset_name', 'crimes')])
+        old = cache_key('/v1/api/detail/', args, generations=[('crimes', 1)])
+        new = cache_key('/v1/api/detail/', args, generations=[('crimes', 2)])
+        self.assertNotEqual(old, new)
+
+    def test_generation_order_does_not_matter(self):
+        args = MultiDict([('dataset_name__in', 'crimes,311')])
+        a = cache_key('/v1/api/timeseries/', args, generations=[('crimes', 1), ('311', 4)])
+        b = cache_key('/v1/api/timeseries/', args, generations=[('311', 4), ('crimes', 1)])
+        self.assertEqual(a, b)
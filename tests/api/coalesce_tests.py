@@ -0,0 +1,109 @@
+import threading
+import time
+import unittest
+
+from plenario.utils.coalesce import CoalescingCache
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class DictCache(object):
+    """
+    Just enough of a cache backend, without the timeouts.
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+    def add(self, key, value, timeout=None):
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = value
+            return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class CoalescingCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = DictCache()
+        self.cache = CoalescingCache(self.backend, stale_timeout=60, lock_timeout=5)
+        self.calls = 0
+
+    def slow_compute(self):
+        self.calls += 1
+        time.sleep(0.2)
+        return 'fresh'
+
+    def test_concurrent_misses_compute_once(self):
+        results = []
+
+        def fetch():
+            results.append(self.cache.get_or_compute('k', self.slow_compute, 60))
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, ['fresh'] * 5)
+
+    def test_fresh_entry_is_served(self):
+        self.backend.set('k', (time.time() + 60, 'cached'))
+        self.assertEqual(self.cache.get_or_compute('k', self.slow_compute, 60), 'cached')
+        self.assertEqual(self.calls, 0)
+
+    def test_stale_entry_is_served_while_refreshing(self):
+        self.backend.set('k', (time.time() - 1, 'stale'))
+        # Someone else is already refreshing it.
+        self.backend.add('lock:k', 'token')
+        self.assertEqual(self.cache.get_or_compute('k', self.slow_compute, 60), 'stale')
+        self.assertEqual(self.calls, 0)
+
+    def test_stale_entry_is_refreshed(self):
+        self.backend.set('k', (time.time() - 1, 'stale'))
+        self.assertEqual(self.cache.get_or_compute('k', self.slow_compute, 60), 'fresh')
+        self.assertEqual(self.backend.get('k')[1], 'fresh')
+        self.assertIsNone(self.backend.get('lock:k'))
+
+    def test_only_successful_responses_are_stored(self):
+        queued = FakeResponse(202)
+        self.assertIs(self.cache.get_or_compute('k', lambda: queued, 60), queued)
+        self.assertIsNone(self.backend.get('k'))
+        ok = FakeResponse(200)
+        self.cache.get_or_compute('k', lambda: ok, 60)
+        self.assertIs(self.backend.get('k')[1], ok)
+
+    def test_waiters_give_up_on_a_stuck_leader(self):
+        cache = CoalescingCache(self.backend, stale_timeout=60, lock_timeout=0.2)
+        stuck = threading.Event()
+        release = threading.Event()
+
+        def stuck_compute():
+            stuck.set()
+            release.wait(5)
+            return 'late'
+
+        leader = threading.Thread(target=cache.get_or_compute, args=('k', stuck_compute, 60))
+        leader.start()
+        stuck.wait(1)
+        started = time.time()
+        try:
+            self.assertEqual(cache.get_or_compute('k', lambda: 'fresh', 60), 'fresh')
+            self.assertLess(time.time() - started, 2)
+        finally:
+            release.set()
+            leader.join()
@@ -0,0 +1,93 @@
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+
+import numpy
+from sqlalchemy import types
+
+from plenario.utils import columnar
+from plenario.utils.columnar import pa, arrow_type, encode_rows, encode_columns
+
+if pa is not None:
+    import pyarrow.parquet as pq
+
+COLUMNS = [
+    ('id', types.Integer()),
+    ('amount', types.Numeric()),
+    ('arrest', types.Boolean()),
+    ('obs_date', types.DateTime()),
+    ('day', types.Date()),
+    ('description', types.String()),
+    ('location', types.NullType()),
+]
+ROWS = [
+    (1, Decimal('1.5'), True, datetime(2014, 9, 1, 12, 30), date(2014, 9, 1), u'theft', 'POINT(-87.6 41.9)'),
+    (2, None, False, datetime(2014, 9, 2), date(2014, 9, 2), None, None),
+    (3, Decimal('10'), None, None, None, u'caf\xe9', 7),
+]
+
+
+def read(data, data_type):
+    if data_type == 'parquet':
+        return pq.read_table(pa.BufferReader(data))
+    return pa.RecordBatchStreamReader(pa.BufferReader(data)).read_all()
+
+
+@unittest.skipIf(pa is None, 'pyarrow is not installed')
+class ColumnarTests(unittest.TestCase):
+    def setUp(self):
+        self.batch_rows = columnar.BATCH_ROWS
+
+    def tearDown(self):
+        columnar.BATCH_ROWS = self.batch_rows
+
+    def test_arrow_types(self):
+        self.assertEqual([arrow_type(t) for _, t in COLUMNS], [
+            pa.int64(), pa.float64(), pa.bool_(), pa.timestamp('us'),
+            pa.date32(), pa.string(), pa.string()])
+        # Computed columns are described with Python types.
+        self.assertEqual([arrow_type(t) for t in (int, float, bool, datetime, date, unicode)], [
+            pa.int64(), pa.float64(), pa.bool_(), pa.timestamp('us'), pa.date32(), pa.string()])
+
+    def test_schema_and_values_survive(self):
+        for data_type in ('arrow', 'parquet'):
+            table = read(''.join(encode_rows(COLUMNS, iter(ROWS), data_type)), data_type)
+            self.assertEqual(table.schema.names, [name for name, _ in COLUMNS])
+            self.assertEqual([f.type for f in table.schema],
+                             [arrow_type(t) for _, t in COLUMNS])
+            values = table.to_pydict()
+            self.assertEqual(values['id'], [1, 2, 3])
+            self.assertEqual(values['amount'], [1.5, None, 10.0])
+            self.assertEqual(values['arrest'], [True, False, None])
+            self.assertEqual(values['obs_date'], [datetime(2014, 9, 1, 12, 30), datetime(2014, 9, 2), None])
+            self.assertEqual(values['day'], [date(2014, 9, 1), date(2014, 9, 2), None])
+            self.assertEqual(values['description'], [u'theft', None, u'caf\xe9'])
+            self.assertEqual(values['location'], [u'POINT(-87.6 41.9)', None, u'7'])
+
+    def test_rows_are_written_a_batch_at_a_time(self):
+        columnar.BATCH_ROWS = 2
+        rows = [(i, datetime(2014, 9, 1)) for i in range(5)]
+        chunks = list(encode_rows([('id', int), ('obs_date', datetime)], iter(rows), 'arrow'))
+        # Three batches, plus the end of the stream
+        self.assertEqual(len(chunks), 4)
+        table = read(''.join(chunks), 'arrow')
+        self.assertEqual(table.to_pydict()['id'], range(5))
+
+    def test_empty_result_still_has_a_schema(self):
+        for data_type in ('arrow', 'parquet'):
+            table = read(''.join(encode_rows(COLUMNS, iter([]), data_type)), data_type)
+            self.assertEqual(table.num_rows, 0)
+            self.assertEqual(table.schema.names, [name for name, _ in COLUMNS])
+
+    def test_columns_from_numpy(self):
+        dates = [datetime(2014, 9, 1), datetime(2014, 9, 8)]
+        counts = numpy.array([[3, 0], [1, 4]], dtype=numpy.int64)
+        columns = [('temporal_group', datetime), ('crimes', int), ('potholes', int)]
+        for data_type in ('arrow', 'parquet'):
+            body = encode_columns(columns, [dates, counts[:, 0], counts[:, 1]], data_type)
+            values = read(''.join(body), data_type).to_pydict()
+            self.assertEqual(values, {'temporal_group': dates, 'crimes': [3, 1], 'potholes': [0, 4]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+import json
+import zlib
+
+from flask import Flask, Response, make_response
+
+import plenario.api
+from plenario.api import compressed, make_cache_key, MIN_COMPRESS_SIZE
+from plenario.utils.streaming import ENCODERS
+
+BODY = json.dumps({'objects': [{'id': i, 'description': 'row %d' % i} for i in range(500)]})
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class CompressionTests(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+
+        def json_response(body, status=200):
+            resp = make_response(body, status)
+            resp.headers['Content-Type'] = 'application/json'
+            return resp
+
+        @app.route('/big')
+        @compressed
+        def big():
+            return json_response(BODY)
+
+        @app.route('/small')
+        @compressed
+        def small():
+            return json_response('{"objects": []}')
+
+        @app.route('/error')
+        @compressed
+        def error():
+            return json_response(BODY, 400)
+
+        @app.route('/image')
+        @compressed
+        def image():
+            resp = make_response(BODY)
+            resp.headers['Content-Type'] = 'image/png'
+            return resp
+
+        @app.route('/stream')
+        @compressed
+        def stream():
+            return Response((BODY[i:i + 1000] for i in range(0, len(BODY), 1000)),
+                            mimetype='application/json')
+
+        self.app = app.test_client()
+
+    def get(self, path, accept=None):
+        headers = {'Accept-Encoding': accept} if accept else {}
+        return self.app.get(path, headers=headers)
+
+    def test_gzip(self):
+        resp = self.get('/big', 'gzip')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gunzip(resp.data), BODY)
+
+    def test_no_accept_encoding(self):
+        resp = self.get('/big')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(resp.data, BODY)
+
+    def test_refused_encodings_are_not_used(self):
+        resp = self.get('/big', 'gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp = self.get('/big', 'br;q=0, gzip;q=0.5')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_brotli_is_preferred(self):
+        if 'br' not in ENCODERS:
+            self.skipTest('brotli is not installed')
+        resp = self.get('/big', 'gzip, deflate, br')
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+
+    def test_left_alone(self):
+        self.assertTrue(len('{"objects": []}') < MIN_COMPRESS_SIZE)
+        for path in ('/small', '/error', '/image'):
+            resp = self.get(path, 'gzip')
+            self.assertNotIn('Content-Encoding', resp.headers, path)
+            # Even uncompressed, the response depends on Accept-Encoding.
+            self.assertIn('Accept-Encoding', resp.headers['Vary'], path)
+
+    def test_streamed_response(self):
+        resp = self.get('/stream', 'gzip')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(gunzip(resp.data), BODY)
+
+
+class EncodingCacheKeyTests(unittest.TestCase):
+    def setUp(self):
+        self.dataset_versions = plenario.api.dataset_versions
+        plenario.api.dataset_versions = lambda: {}
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        plenario.api.dataset_versions = self.dataset_versions
+
+    def key(self, accept):
+        headers = {'Accept-Encoding': accept} if accept else {}
+        with self.app.test_request_context('/v1/api/timeseries/?agg=week', headers=headers):
+            return make_cache_key()
+
+    def test_encodings_are_cached_apart(self):
+        self.assertNotEqual(self.key(None), self.key('gzip'))
+        self.assertEqual(self.key(None), self.key('identity'))
+        self.assertEqual(self.key('gzip'), self.key('gzip, deflate'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from datetime import datetime
+
+from flask import Flask, make_response
+
+import plenario.api
+from plenario.api import conditional
+
+
+class ConditionalTests(unittest.TestCase):
+    def setUp(self):
+        self.dataset_versions = plenario.api.dataset_versions
+        self.versions = {'crimes': (1, datetime(2015, 3, 1, 12, 0))}
+        plenario.api.dataset_versions = lambda: self.versions
+
+        self.calls = []
+        app = Flask(__name__)
+
+        @app.route('/counts')
+        @conditional
+        def counts():
+            self.calls.append('counts')
+            return 'counts'
+
+        @app.route('/broken')
+        @conditional
+        def broken():
+            return make_response('broken', 400)
+
+        self.app = app.test_client()
+
+    def tearDown(self):
+        plenario.api.dataset_versions = self.dataset_versions
+
+    def test_first_request_gets_validators(self):
+        resp = self.app.get('/counts')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers.get('ETag'))
+        self.assertTrue(resp.headers.get('Last-Modified'))
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.app.get('/counts').headers['ETag']
+        resp = self.app.get('/counts', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        # The view never ran for the second request.
+        self.assertEqual(self.calls, ['counts'])
+
+    def test_stale_etag_gets_the_body(self):
+        resp = self.app.get('/counts', headers={'If-None-Match': '"not-the-etag"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, 'counts')
+
+    def test_new_generation_changes_the_etag(self):
+        etag = self.app.get('/counts').headers['ETag']
+        self.versions = {'crimes': (2, datetime(2015, 3, 2, 12, 0))}
+        resp = self.app.get('/counts', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.app.get('/counts').headers['Last-Modified']
+        resp = self.app.get('/counts', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app.get('/counts', headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_etag_wins_over_date(self):
+        last_modified = self.app.get('/counts').headers['Last-Modified']
+        resp = self.app.get('/counts', headers={'If-None-Match': '"not-the-etag"',
+                                                'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_no_last_modified_without_update_times(self):
+        self.versions = {'crimes': (1, None)}
+        resp = self.app.get('/counts')
+        self.assertNotIn('Last-Modified', resp.headers)
+        resp = self.app.get('/counts', headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_errors_get_no_validators(self):
+        resp = self.app.get('/broken')
+        self.assertEqual(resp.status_code, 400)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertNotIn('Last-Modified', resp.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
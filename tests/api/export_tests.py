@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+import csv
+import json
+import zlib
+import gzip
+from StringIO import StringIO
+
+from plenario import create_app
+from plenario.database import app_engine as engine
+from plenario.utils.streaming import iter_gzip
+from init_db import init_master_meta_user
+
+# Values that trip up hand-rolled CSV: delimiters, quotes, line breaks, non-ASCII text and NULL
+ROWS = [
+    (1, u'plain'),
+    (2, u'comma, inside'),
+    (3, u'"quoted" and ""doubled""'),
+    (4, u'line\nbreak'),
+    (5, u'caf\xe9'),
+    (6, None),
+]
+
+
+class ExportTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        init_master_meta_user()
+        engine.execute('DROP TABLE IF EXISTS dat_export_fixture;')
+        engine.execute('CREATE TABLE dat_export_fixture (id INTEGER PRIMARY KEY, description TEXT);')
+        for row in ROWS:
+            engine.execute('INSERT INTO dat_export_fixture (id, description) VALUES (%s, %s)', *row)
+        cls.app = create_app().test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        engine.execute('DROP TABLE IF EXISTS dat_export_fixture;')
+
+    def get(self, query=''):
+        resp = self.app.get('/v1/api/export/export_fixture' + query)
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    @staticmethod
+    def csv_rows(data):
+        # COPY writes NULL as an empty unquoted field, which reads back as ''.
+        rows = list(csv.reader(StringIO(data)))
+        return rows[0], [(int(r[0]), r[1].decode('utf-8') or None) for r in rows[1:]]
+
+    def test_csv_survives_quoting(self):
+        resp = self.get()
+        self.assertEqual(resp.mimetype, 'text/csv')
+        header, rows = self.csv_rows(resp.data)
+        self.assertEqual(header, ['id', 'description'])
+        self.assertEqual(sorted(rows), ROWS)
+
+    def test_gzip_matches_plain_csv(self):
+        plain = self.get().data
+        resp = self.get('?gzip=true')
+        self.assertEqual(resp.mimetype, 'application/gzip')
+        self.assertIn('export_fixture.csv.gz', resp.headers['Content-Disposition'])
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(resp.data)).read(), plain)
+
+    def test_ndjson_rows_are_whole_documents(self):
+        resp = self.get('?data_type=ndjson')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(sorted((r['id'], r['description']) for r in rows), ROWS)
+
+    def test_filters_apply(self):
+        header, rows = self.csv_rows(self.get('?id__in=2,4').data)
+        self.assertEqual(sorted(rows), [ROWS[1], ROWS[3]])
+
+    def test_unknown_dataset(self):
+        resp = self.app.get('/v1/api/export/no_such_dataset')
+        self.assertEqual(resp.status_code, 404)
+
+
+class GzipStreamTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        chunks = ['id,description\n'] + ['%d,row %d\n' % (i, i) for i in range(1000)] + ['']
+        compressed = ''.join(iter_gzip(iter(chunks)))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), ''.join(chunks))
+
+    def test_empty_stream_is_valid_gzip(self):
+        compressed = ''.join(iter_gzip(iter([])))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import json
+import base64
+
+from flask import Flask, make_response
+
+from plenario.api import make_page_token, parse_page_token, is_integer, \
+    link_next_page, ndjson_trailer
+from plenario.utils.streaming import iter_ndjson
+
+
+class PageTokenTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        token = make_page_token([42])
+        self.assertEqual(parse_page_token(token), [42])
+        self.assertEqual(parse_page_token(make_page_token(['2014-09-01', '14819'])),
+                         ['2014-09-01', '14819'])
+
+    def test_garbage_is_not_a_token(self):
+        for token in ('not base64!', base64.urlsafe_b64encode('not json'),
+                      base64.urlsafe_b64encode(json.dumps({'id': 1})), u'\xe9'):
+            self.assertIsNone(parse_page_token(token))
+
+    def test_only_integers_are_row_ids(self):
+        self.assertTrue(is_integer(42))
+        self.assertTrue(is_integer(42L))
+        for value in (True, 4.2, '42', None):
+            self.assertFalse(is_integer(value))
+
+
+class NdjsonResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+
+    def lines(self, objects, trailer):
+        return [json.loads(line) for line in ''.join(iter_ndjson(objects, trailer=trailer)).splitlines()]
+
+    def test_trailer_follows_the_rows(self):
+        lines = self.lines(iter([{'id': 1}, {'id': 2}]), lambda: {'next_page_token': 'abc'})
+        self.assertEqual(lines, [{'id': 1}, {'id': 2}, {'next_page_token': 'abc'}])
+
+    def test_trailer_is_asked_for_after_the_rows(self):
+        seen = []
+
+        def objects():
+            for i in range(3):
+                seen.append(i)
+                yield {'id': i}
+        lines = self.lines(objects(), lambda: {'rows_before_trailer': len(seen)})
+        self.assertEqual(lines[-1], {'rows_before_trailer': 3})
+
+    def test_only_streamed_responses_get_a_trailer(self):
+        with self.app.test_request_context('/v1/api/detail/?data_type=ndjson'):
+            self.assertIsNone(ndjson_trailer(lambda: 'abc'))
+        with self.app.test_request_context('/v1/api/detail/?data_type=ndjson&stream=true'):
+            self.assertEqual(ndjson_trailer(lambda: 'abc')(), {'next_page_token': 'abc'})
+            # The last page has no token, and so no trailer line.
+            trailer = ndjson_trailer(lambda: None)
+            self.assertEqual(self.lines(iter([{'id': 1}]), trailer), [{'id': 1}])
+
+    def test_link_to_the_next_page(self):
+        with self.app.test_request_context('/v1/api/detail/?dataset_name=crimes&data_type=ndjson&offset=10'):
+            resp = make_response('')
+            link_next_page(resp, 'abc')
+            link = resp.headers['Link']
+        self.assertTrue(link.startswith('<http://localhost/v1/api/detail/?'))
+        self.assertTrue(link.endswith('>; rel="next"'))
+        self.assertIn('page_token=abc', link)
+        self.assertIn('dataset_name=crimes', link)
+        # The token takes over from offset.
+        self.assertNotIn('offset', link)
+
+    def test_no_link_on_the_last_page(self):
+        with self.app.test_request_context('/v1/api/detail/?dataset_name=crimes'):
+            resp = make_response('')
+            link_next_page(resp, None)
+        self.assertNotIn('Link', resp.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
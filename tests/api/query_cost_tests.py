@@ -0,0 +1,100 @@
+import unittest
+import json
+
+import plenario.api
+from plenario import create_app
+from plenario.api import admit_query, skip_cache
+from plenario.tasks import JOB_ENVIRON_KEY
+
+
+class FakeJob(object):
+    id = 'job-1'
+
+
+class FakeJobQueue(object):
+    def __init__(self):
+        self.submitted = []
+
+    def delay(self, path, args):
+        self.submitted.append((path, args))
+        return FakeJob()
+
+
+class QueryCostTests(unittest.TestCase):
+    def setUp(self):
+        self.explain_query = plenario.api.explain_query
+        self.run_query_job = plenario.api.run_query_job
+        self.explained = []
+        self.estimate = (0, 0)
+
+        def explain_query(query):
+            self.explained.append(query)
+            return self.estimate
+        plenario.api.explain_query = explain_query
+        self.queue = plenario.api.run_query_job = FakeJobQueue()
+
+        self.app = create_app()
+        self.app.config['QUERY_ASYNC_COST'] = 1000
+        self.app.config['QUERY_MAX_COST'] = 100000
+
+    def tearDown(self):
+        plenario.api.explain_query = self.explain_query
+        plenario.api.run_query_job = self.run_query_job
+
+    def admit(self, cost, environ=None):
+        self.estimate = (cost, cost / 10)
+        with self.app.test_request_context('/v1/api/detail/?dataset_name=crimes',
+                                           environ_base=environ or {}):
+            return admit_query('query')
+
+    def test_cheap_query_runs(self):
+        self.assertIsNone(self.admit(10))
+        self.assertEqual(self.queue.submitted, [])
+
+    def test_expensive_query_is_refused(self):
+        resp = self.admit(500000)
+        self.assertEqual(resp.status_code, 400)
+        meta = json.loads(resp.data)['meta']
+        self.assertEqual(meta['status'], 'error')
+        self.assertEqual(meta['estimated_cost'], 500000)
+        self.assertEqual(self.queue.submitted, [])
+
+    def test_costly_query_is_queued(self):
+        resp = self.admit(5000)
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(json.loads(resp.data)['objects'][0]['job_id'], 'job-1')
+        path, args = self.queue.submitted[0]
+        self.assertEqual(path, '/v1/api/detail/')
+        self.assertIn(('stream', 'true'), args)
+
+    def test_job_is_not_queued_again(self):
+        self.assertIsNone(self.admit(5000, {JOB_ENVIRON_KEY: True}))
+        self.assertEqual(self.queue.submitted, [])
+
+    def test_checks_are_off_by_default(self):
+        self.app.config['QUERY_ASYNC_COST'] = None
+        self.app.config['QUERY_MAX_COST'] = None
+        self.assertIsNone(self.admit(500000))
+        self.assertEqual(self.explained, [])
+
+
+class SkipCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app()
+
+    def skips(self, query, environ=None):
+        with self.app.test_request_context('/v1/api/detail/' + query, environ_base=environ or {}):
+            return skip_cache()
+
+    def test_plain_request_is_cached(self):
+        self.assertFalse(self.skips('?dataset_name=crimes'))
+
+    def test_requests_that_bypass_the_cache(self):
+        self.assertTrue(self.skips('?dataset_name=crimes&stream=true'))
+        self.assertTrue(self.skips('?dataset_name=crimes&async=true'))
+        # A replayed job mustn't be answered with the 202 that queued it.
+        self.assertTrue(self.skips('?dataset_name=crimes', {JOB_ENVIRON_KEY: True}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import json
+
+import plenario.api
+from plenario import create_app
+
+
+class FakeJobQueue(object):
+    """Stands in for the run_query_job task and remembers what it was asked to run."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def delay(self, path, args):
+        self.submitted.append((path, args))
+        raise AssertionError('%s was queued' % path)
+
+
+class QueryJobTests(unittest.TestCase):
+    def setUp(self):
+        self.run_query_job = plenario.api.run_query_job
+        self.queue = plenario.api.run_query_job = FakeJobQueue()
+        self.app = create_app().test_client()
+
+    def tearDown(self):
+        plenario.api.run_query_job = self.run_query_job
+
+    def assertRejected(self, url, message):
+        resp = self.app.get(url + '&async=true')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn(message, json.loads(resp.data)['meta']['message'])
+        self.assertEqual(self.queue.submitted, [])
+
+    def test_bad_detail_operator_is_not_queued(self):
+        self.assertRejected('/v1/api/detail/?dataset_name=crimes&obs_date__near=2014-01-01',
+                            '"near" is not a valid query operator')
+
+    def test_detail_without_dataset_is_not_queued(self):
+        self.assertRejected('/v1/api/detail/?obs_date__ge=2014-01-01',
+                            "'dataset_name' is required")
+
+    def test_bad_aggregate_data_type_is_not_queued(self):
+        self.assertRejected('/v1/api/detail-aggregate/?dataset_name=crimes&data_type=xml',
+                            "'xml' is an invalid output format")
+
+    def test_bad_aggregate_agg_is_not_queued(self):
+        self.assertRejected('/v1/api/detail-aggregate/?dataset_name=crimes&agg=decade',
+                            "'decade' is an invalid temporal aggregation")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import unittest
+import json
+from datetime import datetime, timedelta
+
+import plenario.api
+from plenario import create_app
+from plenario.api import rollup_counts, rollup_grid, rollups_cover
+from plenario.database import session, app_engine as engine
+from plenario.models import MetaTable, MasterDailyCount, MasterGridCount, RolledUpDataset, \
+    ReadyDataset
+from init_db import init_master_meta_user
+
+DATASETS = ['rollup_a', 'rollup_b']
+DATES = {'obs_date__ge': '2014-09-01', 'obs_date__le': '2014-10-01'}
+LOCATIONS = [(-87.63, 41.88), (-87.70, 41.95)]
+# The latest ingest task of each dataset: rollup_a's succeeded and rollup_b's failed
+TASKS = {'rollup_a': (900001, 'SUCCESS'), 'rollup_b': (900002, 'FAILURE')}
+
+
+def fixture_rows():
+    """
+    :return: {dataset_name: [(obs_date, census_block, (lon, lat) or None)]}
+
+    rollup_a piles its rows onto two spots on a handful of days, so its grid
+    rollup is much smaller than its rows. rollup_b scatters a few rows across
+    the city, one per day, so every grid resolution would be as big as its rows.
+    """
+    rows = {'rollup_a': [], 'rollup_b': []}
+    for day in (1, 3, 9, 30):
+        for loc in LOCATIONS:
+            for i in range(5):
+                # Some rows fall exactly on midnight, which matters for obs_date__le.
+                hour = 0 if i == 0 else 13
+                rows['rollup_a'].append((datetime(2014, 9, day, hour, 45 if hour else 0),
+                                         'b%d' % (i % 2), loc))
+    rows['rollup_a'] += [
+        (datetime(2014, 8, 31, 23, 0), 'b0', LOCATIONS[0]),
+        (datetime(2014, 10, 1, 0, 0), 'b0', LOCATIONS[0]),
+        (datetime(2014, 10, 1, 12, 0), 'b1', LOCATIONS[0]),
+    ]
+    for i in range(6):
+        loc = (-87.6 - i * 0.05, 41.8 + i * 0.03) if i else None
+        rows['rollup_b'].append((datetime(2014, 9, 2) + timedelta(days=i * 4, hours=i), 'b0', loc))
+    return rows
+
+
+def load_fixture():
+    init_master_meta_user()
+    for name in DATASETS:
+        engine.execute('DROP TABLE IF EXISTS dat_%s;' % name)
+        engine.execute('CREATE TABLE dat_%s (id INTEGER PRIMARY KEY);' % name)
+        for table in ('dat_master', 'dat_master_daily', 'dat_master_grid', 'meta_rollup', 'meta_ready', 'meta_master'):
+            engine.execute('DELETE FROM %s WHERE dataset_name = %%s' % table, name)
+        session.add(MetaTable(dataset_name=name, human_name=name, source_url_hash='%s_hash' % name,
+                              update_freq='daily', business_key='id', observed_date='obs_date',
+                              approved_status='true'))
+    session.commit()
+
+    for name, rows in fixture_rows().items():
+        for row_id, (obs_date, census_block, loc) in enumerate(rows):
+            engine.execute('INSERT INTO dat_%s (id) VALUES (%%s)' % name, row_id)
+            geom = 'ST_SetSRID(ST_MakePoint(%s, %s), 4326)' % loc if loc else 'NULL'
+            engine.execute('INSERT INTO dat_master (dataset_name, dataset_row_id, obs_date, '
+                           'census_block, current_flag, location_geom) '
+                           'VALUES (%s, %s, %s, %s, TRUE, {})'.format(geom),
+                           name, row_id, obs_date, census_block)
+
+
+def roll_up(names=DATASETS):
+    kept = {}
+    for name in names:
+        MasterDailyCount.rebuild(name, session)
+        kept[name] = MasterGridCount.rebuild(name, session)
+        RolledUpDataset.mark(name, kept[name], session)
+    session.commit()
+    return kept
+
+
+def unroll(names=DATASETS):
+    for name in names:
+        RolledUpDataset.remove(name, session)
+    session.commit()
+
+
+class RollupTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_fixture()
+        cls.kept = roll_up()
+        cls.app = create_app().test_client()
+
+    def tearDown(self):
+        # Put back anything a test unrolled.
+        roll_up()
+
+    def get(self, url):
+        plenario.api.cache.clear()
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, 200, resp.data)
+        return json.loads(resp.data)
+
+    def from_both(self, url, names=DATASETS):
+        """
+        :return: (response counted from dat_master, response counted from the rollups)
+        """
+        unroll(names)
+        direct = self.get(url)
+        roll_up(names)
+        return direct, self.get(url)
+
+
+class DailyRollupTests(RollupTestCase):
+
+    def dat_master_counts(self, agg, census_block=None):
+        q = '''
+            SELECT date_trunc(%s, obs_date), COUNT(*), dataset_name
+            FROM dat_master
+            WHERE dataset_name IN %s AND obs_date >= %s AND obs_date <= %s AND current_flag
+        '''
+        params = [agg, tuple(DATASETS), DATES['obs_date__ge'], DATES['obs_date__le']]
+        if census_block:
+            q += ' AND census_block = %s'
+            params.append(census_block)
+        q += ' GROUP BY 1, 3 ORDER BY 1, 3'
+        return [tuple(r) for r in engine.execute(q, *params)]
+
+    def rollup_counts(self, agg, **params):
+        params.update(DATES)
+        params['dataset_name__in'] = ','.join(DATASETS)
+        query = rollup_counts(params, agg)
+        self.assertIsNotNone(query)
+        return sorted((d.replace(tzinfo=None), c, name) for d, c, name in query.all())
+
+    def test_counts_match_dat_master(self):
+        for agg in ('day', 'week', 'month'):
+            expected = [(d.replace(tzinfo=None), c, name) for d, c, name in self.dat_master_counts(agg)]
+            self.assertEqual(self.rollup_counts(agg), sorted(expected), agg)
+
+    def test_census_block_counts_match_dat_master(self):
+        expected = [(d.replace(tzinfo=None), c, name) for d, c, name in self.dat_master_counts('week', 'b1')]
+        self.assertEqual(self.rollup_counts('week', census_block='b1'), sorted(expected))
+
+    def test_timeseries_matches_dat_master(self):
+        for agg in ('day', 'week', 'month'):
+            url = '/v1/api/timeseries/?agg=%s&dataset_name__in=%s&obs_date__ge=%s&obs_date__le=%s' % \
+                (agg, ','.join(DATASETS), DATES['obs_date__ge'], DATES['obs_date__le'])
+            direct, rolled_up = self.from_both(url)
+            self.assertTrue(direct['objects'])
+            self.assertEqual(rolled_up['objects'], direct['objects'], agg)
+
+    def test_detail_aggregate_matches_dat_master(self):
+        url = '/v1/api/detail-aggregate/?agg=week&dataset_name=rollup_a&obs_date__ge=%s&obs_date__le=%s' % \
+            (DATES['obs_date__ge'], DATES['obs_date__le'])
+        direct, rolled_up = self.from_both(url, ['rollup_a'])
+        self.assertEqual(rolled_up['objects'], direct['objects'])
+        self.assertEqual(sum(o['count'] for o in direct['objects']), 41)
+
+    def test_datasets_not_rolled_up_are_counted_from_dat_master(self):
+        unroll(['rollup_b'])
+        both = dict(DATES, dataset_name__in=','.join(DATASETS))
+        self.assertFalse(rollups_cover(both))
+        self.assertIsNone(rollup_counts(both, 'week'))
+        self.assertTrue(rollups_cover(dict(DATES, dataset_name='rollup_a')))
+        self.assertIsNotNone(rollup_counts(dict(DATES, dataset_name='rollup_a'), 'week'))
+
+
+class GridRollupTests(RollupTestCase):
+
+    @staticmethod
+    def cells(grid):
+        cells = []
+        for feature in grid['features']:
+            corners = feature.get('geometry', {}).get('coordinates', [[]])[0]
+            cells.append((feature['properties']['count'],
+                           tuple((round(x, 6), round(y, 6)) for x, y in corners)))
+        return sorted(cells)
+
+    def test_resolutions_are_kept_where_they_save_rows(self):
+        self.assertEqual(self.kept['rollup_a'], list(MasterGridCount.RESOLUTIONS))
+        self.assertEqual(self.kept['rollup_b'], [])
+
+    def test_grid_matches_dat_master(self):
+        params = dict(DATES, dataset_name='rollup_a')
+        for resolution in MasterGridCount.RESOLUTIONS:
+            self.assertIsNotNone(rollup_grid(params, resolution))
+            url = '/v1/api/grid/?dataset_name=rollup_a&obs_date__ge=%s&obs_date__le=%s&resolution=%s' % \
+                (DATES['obs_date__ge'], DATES['obs_date__le'], resolution)
+            direct, rolled_up = self.from_both(url, ['rollup_a'])
+            self.assertEqual(self.cells(rolled_up), self.cells(direct), resolution)
+            self.assertEqual(sum(count for count, _ in self.cells(direct)), 41)
+
+    def test_dropped_resolutions_are_counted_from_dat_master(self):
+        params = dict(DATES, dataset_name='rollup_b')
+        self.assertTrue(rollups_cover(params))
+        self.assertFalse(rollups_cover(params, grid_resolution=500))
+        self.assertIsNone(rollup_grid(params, 500))
+
+    def test_other_resolutions_are_counted_from_dat_master(self):
+        self.assertIsNone(rollup_grid(dict(DATES, dataset_name='rollup_a'), 250))
+
+
+class ReadyCatalogTests(RollupTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(ReadyCatalogTests, cls).setUpClass()
+        # Celery makes this table as it runs its first task.
+        engine.execute('CREATE TABLE IF NOT EXISTS celery_taskmeta (id INTEGER PRIMARY KEY, '
+                       'task_id VARCHAR(155) UNIQUE, status VARCHAR(50), result BYTEA, '
+                       'date_done TIMESTAMP, traceback TEXT);')
+        for name, (task_id, status) in TASKS.items():
+            engine.execute('DELETE FROM celery_taskmeta WHERE id = %s OR task_id = %s',
+                           task_id, '%s_task' % name)
+            engine.execute('INSERT INTO celery_taskmeta (id, task_id, status, date_done) '
+                           'VALUES (%s, %s, %s, NOW())', task_id, '%s_task' % name, status)
+            engine.execute('UPDATE meta_master SET result_ids = %s WHERE dataset_name = %s',
+                           ['%s_task' % name], name)
+
+    def setUp(self):
+        # As left by an upgrade from a version without the catalog
+        engine.execute('DELETE FROM meta_ready;')
+
+    def catalog(self):
+        names, complete = ReadyDataset.catalog(session)
+        return [name for name in names if name in DATASETS], complete
+
+    def test_empty_catalog_goes_by_celery_results(self):
+        self.assertEqual(self.catalog(), (['rollup_a'], False))
+
+    def test_first_change_fills_the_catalog(self):
+        ReadyDataset.mark_not_ready('rollup_b', session)
+        session.commit()
+        self.assertTrue(ReadyDataset.is_filled(session))
+        # rollup_a came in from the celery results, rather than dropping out.
+        self.assertEqual(self.catalog()[0], ['rollup_a'])
+
+        ReadyDataset.mark_ready('rollup_b', session)
+        session.commit()
+        self.assertEqual(sorted(self.catalog()[0]), DATASETS)
+
+    def test_timeseries_counts_ready_datasets(self):
+        url = '/v1/api/timeseries/?agg=week&obs_date__ge=%s&obs_date__le=%s' % \
+            (DATES['obs_date__ge'], DATES['obs_date__le'])
+        direct, rolled_up = self.from_both(url)
+        self.assertEqual(rolled_up['objects'], direct['objects'])
+        counts = {o['dataset_name']: sum(i['count'] for i in o['items']) for o in direct['objects']}
+        self.assertEqual(counts.get('rollup_a'), 41)
+        self.assertNotIn('rollup_b', counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from plenario.utils.slow_queries import fingerprint, QueryStats
+
+
+class FingerprintTests(unittest.TestCase):
+
+    def test_values_are_left_out(self):
+        a = fingerprint("SELECT * FROM dat_master WHERE dataset_name IN (%(dataset_name_1)s, %(dataset_name_2)s) "
+                        "AND ST_Within(location_geom, ST_GeomFromGeoJSON(%(param_1)s)) LIMIT 1000")
+        b = fingerprint("SELECT * FROM dat_master WHERE dataset_name IN (%(dataset_name_1)s) "
+                        "AND ST_Within(location_geom, ST_GeomFromGeoJSON(%(param_1)s)) LIMIT 10")
+        self.assertEqual(a, b)
+        self.assertEqual(a, 'SELECT * FROM dat_master WHERE dataset_name IN (?) '
+                            'AND ST_Within(location_geom, ST_GeomFromGeoJSON(?)) LIMIT ?')
+
+    def test_literals_are_left_out(self):
+        self.assertEqual(fingerprint("SELECT 1 FROM dat_crimes_2001 WHERE obs_date >= '2014-01-01'\n  AND x = 2.5"),
+                         'SELECT ? FROM dat_crimes_2001 WHERE obs_date >= ? AND x = ?')
+
+
+class QueryStatsTests(unittest.TestCase):
+
+    def test_top(self):
+        stats = QueryStats()
+        stats.record('SELECT 1', 5, 'api.detail?dataset_name')
+        stats.record('SELECT 2', 10, 'api.grid?dataset_name')
+        stats.record('SELECT 3', 20, 'api.detail?dataset_name&obs_date__ge')
+        [top] = stats.top(1)
+        self.assertEqual(top['count'], 3)
+        self.assertEqual(top['total_ms'], 35)
+        self.assertEqual(top['max_ms'], 20)
+        self.assertEqual(top['shapes'], ['api.detail?dataset_name',
+                                         'api.detail?dataset_name&obs_date__ge',
+                                         'api.grid?dataset_name'])
+
+    def test_old_stats_are_rotated_out(self):
+        stats = QueryStats(window=60)
+        stats.record('SELECT 1', 5, 'api.detail?dataset_name')
+        stats._rotated_at -= 61
+        self.assertEqual(len(stats.top()), 1)
+        stats._rotated_at -= 61
+        self.assertEqual(stats.top(), [])
@@ -0,0 +1,37 @@
+import unittest
+
+from plenario.api import tile_bounds, WEB_MERCATOR_MAX
+
+# Downtown Chicago in web mercator meters, and the zoom 10 tile it falls in
+CHICAGO = (-9754904.71, 5142736.87)
+CHICAGO_TILE = (10, 262, 380)
+
+
+class TileBoundsTests(unittest.TestCase):
+
+    def test_zoom_zero_is_the_whole_world(self):
+        self.assertEqual(tile_bounds(0, 0, 0),
+                         (-WEB_MERCATOR_MAX, -WEB_MERCATOR_MAX, WEB_MERCATOR_MAX, WEB_MERCATOR_MAX))
+
+    def test_rows_count_down_from_the_top(self):
+        xmin, ymin, xmax, ymax = tile_bounds(1, 0, 0)
+        self.assertEqual((xmin, xmax), (-WEB_MERCATOR_MAX, 0))
+        self.assertEqual((ymin, ymax), (0, WEB_MERCATOR_MAX))
+        self.assertEqual(tile_bounds(1, 1, 1), (0, -WEB_MERCATOR_MAX, WEB_MERCATOR_MAX, 0))
+
+    def test_neighbors_share_edges(self):
+        z, x, y = CHICAGO_TILE
+        bounds = tile_bounds(z, x, y)
+        self.assertAlmostEqual(tile_bounds(z, x + 1, y)[0], bounds[2])
+        self.assertAlmostEqual(tile_bounds(z, x, y + 1)[3], bounds[1])
+
+    def test_point_falls_in_its_tile(self):
+        xmin, ymin, xmax, ymax = tile_bounds(*CHICAGO_TILE)
+        self.assertTrue(xmin <= CHICAGO[0] < xmax)
+        self.assertTrue(ymin < CHICAGO[1] <= ymax)
+        self.assertAlmostEqual(xmax - xmin, 2 * WEB_MERCATOR_MAX / 2 ** 10)
+        self.assertAlmostEqual(ymax - ymin, xmax - xmin)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import csv
+from datetime import datetime, timedelta, tzinfo
+from itertools import groupby
+from operator import itemgetter
+from collections import OrderedDict
+from StringIO import StringIO
+
+from plenario.api import timeseries_matrix
+from plenario.utils.helpers import increment_datetime_aggregate
+from plenario.utils.streaming import iter_csv
+
+
+class UTC(tzinfo):
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=UTC())
+
+
+def old_timeseries_csv(values, from_date, to_date, agg):
+    """
+    What /timeseries?data_type=csv used to do: densify each dataset's counts
+    into JSON objects, then stitch those together column by column.
+    """
+    objects = []
+    for name, g in groupby(sorted(values, key=itemgetter(2)), key=itemgetter(2)):
+        dense_matrix = []
+        cursor = from_date
+        v_index = 0
+        dataset_values = list(g)
+        while cursor <= to_date:
+            if v_index < len(dataset_values) and \
+                    dataset_values[v_index][0].replace(tzinfo=None) == cursor:
+                dense_matrix.append((cursor, dataset_values[v_index][1]))
+                v_index += 1
+            else:
+                dense_matrix.append((cursor, 0))
+            cursor = increment_datetime_aggregate(cursor, agg)
+        items = [{'datetime': k, 'count': v} for k, v in OrderedDict(dense_matrix).items()]
+        objects.append({'dataset_name': name, 'items': items})
+
+    fields = ['temporal_group'] + [o['dataset_name'] for o in objects]
+    csv_resp = []
+    for i, o in enumerate(objects):
+        for j, row in enumerate(o['items']):
+            if i == 0:
+                csv_resp.append([row['datetime']])
+            csv_resp[j].append(row['count'])
+    csv_resp.insert(0, fields)
+    outp = StringIO()
+    csv.writer(outp).writerows(csv_resp)
+    return outp.getvalue()
+
+
+def new_timeseries_csv(values, from_date, to_date, agg):
+    dates, dataset_names, counts = timeseries_matrix(values, from_date, to_date, agg)
+    rows = ([d] + c for d, c in zip(dates, counts.tolist()))
+    return ''.join(iter_csv(['temporal_group'] + dataset_names, rows))
+
+
+class TimeseriesCsvTests(unittest.TestCase):
+
+    def assertSameCsv(self, values, from_date, to_date, agg):
+        self.assertEqual(new_timeseries_csv(values, from_date, to_date, agg),
+                         old_timeseries_csv(values, from_date, to_date, agg))
+
+    def test_weekly_counts_with_gaps(self):
+        # Rows come back ordered by date, as the query sorts them.
+        values = [
+            (utc(2014, 2, 24), 235, 'crimes'),
+            (utc(2014, 2, 24), 653, 'potholes'),
+            (utc(2014, 3, 3), 156, 'crimes'),
+            (utc(2014, 3, 17), 12, 'potholes'),
+            (utc(2014, 3, 24), 9, 'crimes'),
+        ]
+        self.assertSameCsv(values, datetime(2014, 2, 24), datetime(2014, 3, 30), 'week')
+
+    def test_monthly_counts(self):
+        values = [
+            (utc(2014, 1, 1), 5, 'zoning'),
+            (utc(2014, 2, 1), 7, 'business_licenses'),
+            (utc(2014, 2, 1), 1, 'zoning'),
+            (utc(2014, 4, 1), 3, 'business_licenses'),
+        ]
+        self.assertSameCsv(values, datetime(2014, 1, 1), datetime(2014, 6, 1), 'month')
+
+    def test_single_dataset(self):
+        values = [(utc(2014, 9, d), d, 'crimes') for d in (1, 2, 5)]
+        self.assertSameCsv(values, datetime(2014, 9, 1), datetime(2014, 9, 7), 'day')
+
+    def test_layout(self):
+        values = [(utc(2014, 2, 24), 235, 'crimes'), (utc(2014, 3, 3), 624, 'potholes')]
+        rows = list(csv.reader(StringIO(
+            new_timeseries_csv(values, datetime(2014, 2, 24), datetime(2014, 3, 3), 'week'))))
+        self.assertEqual(rows, [
+            ['temporal_group', 'crimes', 'potholes'],
+            ['2014-02-24 00:00:00', '235', '0'],
+            ['2014-03-03 00:00:00', '0', '624'],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
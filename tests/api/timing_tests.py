@@ -0,0 +1,49 @@
+import time
+import unittest
+
+from plenario.utils.timing import RequestTimer, EndpointStats, BUCKETS, bucket_index
+
+
+class RequestTimerTests(unittest.TestCase):
+
+    def test_nested_phases_are_not_counted_twice(self):
+        timer = RequestTimer()
+        timer.start('serialize')
+        timer.start('fetch')
+        time.sleep(0.05)
+        timer.stop('fetch')
+        timer.stop('serialize')
+        self.assertGreaterEqual(timer.totals['fetch'], 0.05)
+        self.assertLess(timer.totals['serialize'], 0.05)
+
+    def test_stopping_a_phase_closes_phases_inside_it(self):
+        timer = RequestTimer()
+        timer.start('fetch')
+        # A statement that failed never reports back.
+        timer.start('sql')
+        timer.stop('fetch')
+        self.assertEqual(set(timer.totals), {'fetch', 'sql'})
+        # Nothing left to close.
+        timer.stop('sql')
+        self.assertEqual(set(timer.totals), {'fetch', 'sql'})
+
+
+class EndpointStatsTests(unittest.TestCase):
+
+    def test_record(self):
+        timer = RequestTimer()
+        timer.totals['sql'] = 0.2
+        stats = EndpointStats()
+        stats.record('api.detail', timer)
+        stats.record('api.detail', timer)
+        [(endpoint, phases)] = stats.snapshot()
+        self.assertEqual(endpoint, 'api.detail')
+        sql = [p for p in phases if p[0] == 'sql'][0]
+        self.assertEqual(sql[1], 2)
+        self.assertAlmostEqual(sql[2], 200)
+        self.assertEqual(sql[3][bucket_index(200)], 2)
+
+    def test_bucket_index(self):
+        self.assertEqual(bucket_index(0), 0)
+        self.assertEqual(bucket_index(BUCKETS[0]), 0)
+        self.assertEqual(bucket_index(BUCKETS[-1] + 1), len(BUCKETS))
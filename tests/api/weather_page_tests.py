@@ -0,0 +1,111 @@
+import unittest
+import json
+import base64
+
+import plenario.api
+from plenario import create_app
+from plenario.database import app_engine as engine
+from plenario.utils.weather import WeatherETL, WeatherStationsETL
+
+STATIONS = ['14819', '94846']
+DATES = ['2014-09-01', '2014-09-02', '2014-09-03']
+
+
+class WeatherPageTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        engine.execute('DROP TABLE IF EXISTS dat_weather_observations_daily, '
+                       'dat_weather_observations_hourly, weather_stations;')
+        WeatherStationsETL()._make_station_table()
+        WeatherETL().make_tables()
+        for wban in STATIONS:
+            engine.execute("INSERT INTO weather_stations (wban_code, station_name, location) "
+                           "VALUES (%s, %s, ST_GeomFromText('POINT(-87.6 41.9)', 4326))", wban, wban)
+        row_id = 0
+        for date in DATES:
+            for wban in STATIONS:
+                row_id += 1
+                engine.execute('INSERT INTO dat_weather_observations_daily (id, wban_code, date) '
+                               'VALUES (%s, %s, %s)', row_id, wban, date)
+
+        # Small pages, so that the fixture spans several of them
+        cls.response_limit = plenario.api.RESPONSE_LIMIT
+        plenario.api.RESPONSE_LIMIT = 4
+        cls.app = create_app().test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        plenario.api.RESPONSE_LIMIT = cls.response_limit
+
+    def get(self, query):
+        resp = self.app.get('/v1/api/weather/daily/?date__ge=2014-09-01' + query)
+        return resp, json.loads(resp.data)
+
+    @staticmethod
+    def observations(body):
+        return [(o['date'], o['wban_code']) for station in body['objects'] for o in station['observations']]
+
+    def test_second_page_follows_first(self):
+        resp, first = self.get('')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(first['meta']['total'], 4)
+        token = first['meta']['next_page_token']
+
+        resp, second = self.get('&page_token=' + token)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(second['meta']['total'], 2)
+        self.assertNotIn('next_page_token', second['meta'])
+
+        seen = self.observations(first) + self.observations(second)
+        self.assertEqual(len(seen), len(DATES) * len(STATIONS))
+        self.assertEqual(len(set(seen)), len(seen))
+
+    def ndjson(self, url):
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        return resp, [json.loads(line) for line in resp.data.splitlines()]
+
+    @staticmethod
+    def ndjson_observations(lines):
+        return [(l['observation']['date'], l['observation']['wban_code']) for l in lines if 'observation' in l]
+
+    def test_ndjson_links_to_the_next_page(self):
+        resp, first = self.ndjson('/v1/api/weather/daily/?date__ge=2014-09-01&data_type=ndjson')
+        self.assertEqual(len(first), 4)
+        link = resp.headers['Link']
+        self.assertTrue(link.endswith('>; rel="next"'))
+        next_url = link[1:link.index('>')]
+        self.assertIn('page_token=', next_url)
+
+        resp, second = self.ndjson(next_url)
+        self.assertEqual(len(second), 2)
+        self.assertNotIn('Link', resp.headers)
+
+        seen = self.ndjson_observations(first + second)
+        self.assertEqual(len(set(seen)), len(DATES) * len(STATIONS))
+
+    def test_streamed_ndjson_ends_with_the_token(self):
+        url = '/v1/api/weather/daily/?date__ge=2014-09-01&data_type=ndjson&stream=true'
+        resp, first = self.ndjson(url)
+        self.assertNotIn('Link', resp.headers)
+        self.assertEqual(len(first), 5)
+        token = first[-1]['next_page_token']
+
+        resp, second = self.ndjson(url + '&page_token=' + token)
+        self.assertEqual(len(second), 2)
+        self.assertNotIn('next_page_token', second[-1])
+
+        seen = self.ndjson_observations(first + second)
+        self.assertEqual(len(set(seen)), len(DATES) * len(STATIONS))
+
+    def test_token_with_wrong_types_is_rejected(self):
+        for values in ([1, 'x'], ['2014-09-01', 14819], ['not a date', '14819']):
+            token = base64.urlsafe_b64encode(json.dumps(values))
+            resp, body = self.get('&page_token=' + token)
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('is not a valid page_token', body['meta']['message'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from plenario.utils.artifacts import ArtifactCache
+
+
+class ArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = ArtifactCache(self.root, max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_export(self, dataset_name, generation, export_format, size, mtime):
+        path = self.cache.path(dataset_name, generation, export_format)
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_evicts_least_recently_used(self):
+        old = self.make_export('zips', 1, 'json', 6, mtime=100)
+        new = self.make_export('streets', 1, 'json', 6, mtime=200)
+        self.cache.evict()
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_evict_spares_kept_export(self):
+        old = self.make_export('zips', 1, 'json', 6, mtime=100)
+        new = self.make_export('streets', 1, 'json', 6, mtime=200)
+        self.cache.evict(keep=old)
+        self.assertTrue(os.path.exists(old))
+        self.assertFalse(os.path.exists(new))
+
+    def test_remove_keeps_current_generation(self):
+        stale = self.make_export('zips', 1, 'kml', 1, mtime=100)
+        current = self.make_export('zips', 2, 'kml', 1, mtime=100)
+        other = self.make_export('zips_2010', 1, 'kml', 1, mtime=100)
+        self.cache.remove('zips', keep_generation=2)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(current))
+        self.assertTrue(os.path.exists(other))
+
+    def test_evicted_export_is_rebuilt(self):
+        built = []
+
+        def build(dataset_name, generation, export_format):
+            built.append(dataset_name)
+            return self.make_export(dataset_name, generation, export_format, 1, mtime=100)
+
+        self.cache.build = build
+        os.remove(self.make_export('zips', 1, 'json', 1, mtime=100))
+        self.assertEqual(self.cache.get('zips', 1, 'json'), self.cache.path('zips', 1, 'json'))
+        self.assertEqual(built, ['zips'])
+
+    def test_concurrent_misses_build_once(self):
+        built = []
+
+        def build(dataset_name, generation, export_format):
+            built.append(dataset_name)
+            time.sleep(0.2)
+            return self.make_export(dataset_name, generation, export_format, 1, mtime=100)
+
+        self.cache.build = build
+        threads = [threading.Thread(target=self.cache.get, args=('zips', 1, 'json')) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(built, ['zips'])
+
+    def test_remove_drops_old_lock_files(self):
+        with self.cache._build_lock(self.cache.path('zips', 1, 'json')):
+            pass
+        self.cache.remove('zips', keep_generation=2)
+        self.assertEqual(os.listdir(self.root), [])
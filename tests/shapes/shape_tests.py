@@ -5,6 +5,7 @@ from plenario.utils.shape_etl import ShapeETL
 from plenario.utils.etl import PlenarioETL
 from plenario.utils.shapefile import Shapefile
 from plenario import create_app
+from plenario.api import extract_first_geometry_fragment
 from init_db import init_master_meta_user, init_census
 from plenario.database import session, app_engine as engine
 from plenario.models import MetaTable, ShapeMetadata
@@ -101,6 +102,33 @@ class ShapeTests(unittest.TestCase):
         self.assertEqual(datasets_to_num_geoms[fixtures['zips'].table_name], 3)
         self.assertEqual(datasets_to_num_geoms[fixtures['streets'].table_name], 2)
 
+    def test_find_intersecting_in_one_statement(self):
+        rect_path = os.path.join(FIXTURE_PATH, 'university_village_rectangle.json')
+        with open(rect_path, 'r') as rect_json:
+            fragment = extract_first_geometry_fragment(rect_json.read())
+
+        counted = dict(ShapeMetadata.find_intersecting(fragment, caller_session=session))
+        self.assertEqual(counted[fixtures['zips'].table_name], 3)
+        self.assertEqual(counted[fixtures['streets'].table_name], 2)
+        # The dummy dataset has no table, so it must never become a candidate.
+        self.assertNotIn(self.dummy_name, counted)
+
+        # Without counts we get the same datasets, just no numbers.
+        listed = dict(ShapeMetadata.find_intersecting(fragment, caller_session=session, count=False))
+        self.assertEqual(sorted(listed), sorted(counted))
+        self.assertTrue(all(num_geoms is None for num_geoms in listed.values()))
+
+        resp = self.app.get('/v1/api/shapes/intersections/' + urllib.quote(fragment) + '?count=false')
+        self.assertEqual(resp.status_code, 200)
+        objects = json.loads(resp.data)['objects']
+        self.assertEqual(sorted(obj['dataset_name'] for obj in objects), sorted(counted))
+        self.assertTrue(all('num_geoms' not in obj for obj in objects))
+
+    def test_find_intersecting_far_away(self):
+        # A point in the middle of the Atlantic touches none of the fixtures.
+        fragment = extract_first_geometry_fragment(json.dumps({'type': 'Point', 'coordinates': [-40, 30]}))
+        self.assertEqual(ShapeMetadata.find_intersecting(fragment, caller_session=session), [])
+
     def test_export_geojson(self):
         # Do we at least get some json back?
         resp = self.app.get('/v1/api/shapes/{}?data_type=json'.format(fixtures['city'].table_name))